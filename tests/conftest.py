@@ -0,0 +1,7 @@
+"""The modules import each other as siblings of treadmill-haproxy"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'treadmill-haproxy'))
@@ -0,0 +1,132 @@
+"""Tests of configurator"""
+
+import json
+import os
+
+import pytest
+
+import configurator
+import haproxy_cmd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _service(port, slots=None):
+    """Config of a service listening on port"""
+    service = {
+        'treadmill': {'appname': 'proid.app{}'.format(port),
+                      'manifest': 'manifest.yaml', 'endpoint': 'http'},
+        'haproxy': {'listen': ['mode http'], 'server': ['check'],
+                    'port': port},
+    }
+    if slots is not None:
+        service['haproxy']['slots'] = slots
+    return service
+
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch):
+    """Returns a function that builds a Configurator from a config dict.
+    haproxy accepts every config"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(haproxy_cmd, 'check_config', lambda path: True)
+
+    def _make(config, shard=None):
+        conf_file = tmp_path / 'config.json'
+        conf_file.write_text(json.dumps(config))
+        return configurator.Configurator(
+            str(tmp_path), str(conf_file), str(tmp_path / 'haproxy.cfg'),
+            shard)
+    return _make
+
+
+@pytest.fixture
+def slotted(make_config):
+    """A configurator running a service with two slots and one without"""
+    config = make_config({'services': {'web': _service(8000, slots=2),
+                                       'plain': _service(9000)}})
+    config.parse_config()
+    config.config_write()
+    config.config_loaded()
+    return config
+
+
+def test_slots_enabled_at_runtime(slotted):
+    """Servers take free slots without a reload"""
+    assert slotted.add_server('web', 'a', '10.0.0.1:80', ['check']) == 'slot1'
+    assert slotted.add_server('web', 'b', '10.0.0.2:80', ['check']) == 'slot2'
+    slotted.config_write()
+    assert not slotted.reload_required()
+
+    assert slotted.delete_server('web', 'a') == 'slot1'
+    assert slotted.add_server('web', 'c', '10.0.0.3:80', ['check']) == 'slot1'
+
+
+def test_slots_exhausted(slotted):
+    """A server beyond the slots doubles them and needs a reload. The new
+    slots are only used through the runtime API once haproxy loaded them"""
+    slotted.add_server('web', 'a', '10.0.0.1:80', ['check'])
+    slotted.add_server('web', 'b', '10.0.0.2:80', ['check'])
+    assert slotted.add_server('web', 'c', '10.0.0.3:80', ['check']) is None
+    assert slotted.add_server('web', 'd', '10.0.0.4:80', ['check']) is None
+    assert slotted.delete_server('web', 'd') is None
+    slotted.config_write()
+    assert slotted.reload_required()
+    assert slotted.reload_reasons() == ['slots_exhausted']
+    assert 'server slot4 ' in slotted.render()
+
+    slotted.config_loaded()
+    assert not slotted.reload_required()
+    assert slotted.add_server('web', 'e', '10.0.0.5:80', ['check']) == 'slot4'
+
+
+def test_changes_that_cancel_out(slotted):
+    """Servers of listen blocks without slots need a reload, unless they are
+    gone again before it"""
+    assert slotted.add_server('plain', 'a', '10.0.0.1:80', ['check']) is None
+    slotted.config_write()
+    assert slotted.reload_required()
+    assert slotted.reload_reasons() == ['no_slots']
+
+    assert slotted.delete_server('plain', 'a') is None
+    slotted.config_write()
+    assert not slotted.reload_required()
+
+
+def test_bind_sections_only_in_first_shard(make_config):
+    """Sections that bind a port are written into the first shard only"""
+    config = {
+        'haproxy': {
+            'global': ['daemon'],
+            'defaults': ['mode http'],
+            'listen stats': ['stats enable', 'bind *:9000'],
+        },
+        'shards': {'count': 2},
+        'services': {},
+    }
+    headers = []
+    for index in range(2):
+        shard = make_config(config, (index, 2))
+        shard.parse_config()
+        headers.append([line for line in shard.render().splitlines()
+                        if line and not line.startswith('\t')])
+    assert headers == [['global', 'defaults', 'listen stats'],
+                       ['global', 'defaults']]
+
+
+def test_rejected_config_not_loaded(slotted, monkeypatch):
+    """Slots of a config haproxy rejected are not used at runtime after the
+    reload, which loads the last accepted config"""
+    slotted.add_server('web', 'a', '10.0.0.1:80', ['check'])
+    slotted.add_server('web', 'b', '10.0.0.2:80', ['check'])
+    slotted.add_server('web', 'c', '10.0.0.3:80', ['check'])
+    monkeypatch.setattr(haproxy_cmd, 'check_config', lambda path: False)
+    assert not slotted.config_write()
+    slotted.config_loaded()
+    assert slotted.add_server('web', 'd', '10.0.0.4:80', ['check']) is None
+
+    monkeypatch.setattr(haproxy_cmd, 'check_config', lambda path: True)
+    assert slotted.config_write()
+    slotted.config_loaded()
+    assert slotted.delete_server('web', 'd') == 'slot4'
+    assert slotted.add_server('web', 'e', '10.0.0.5:80', ['check']) == 'slot4'
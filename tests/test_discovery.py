@@ -0,0 +1,69 @@
+"""Tests of discovery"""
+
+from twisted.internet import defer
+from twisted.internet import error
+
+import discovery
+
+
+class FakeResolver(object):
+    """Stands in for the reactor's resolver"""
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.lookups = []
+
+    def resolve(self, host, timeout=None):
+        self.lookups.append(host)
+        if host in self.addresses:
+            return defer.succeed(self.addresses[host])
+        return defer.fail(error.DNSLookupError(host))
+
+
+def _discovery(monkeypatch, addresses):
+    resolver = FakeResolver(addresses)
+    monkeypatch.setattr(discovery, 'reactor', resolver)
+    index = discovery.Discovery()
+    index.restore({'proid.app': {
+        '1': {'http': 'good:80'},
+        '2': {'http': 'bad:81'},
+        '3': {'http': '10.0.0.1:82'},
+    }})
+    return index, resolver
+
+
+def test_resolved_addresses(monkeypatch):
+    """Hosts resolve once, IP addresses are taken as they are"""
+    index, resolver = _discovery(monkeypatch, {'good': '10.1.1.1'})
+    index.resolve_async()
+    index.resolve_async()
+    assert index.resolved('good:80') == '10.1.1.1:80'
+    assert index.resolved('10.0.0.1:82') == '10.0.0.1:82'
+    assert index.resolved('bad:81') is None
+    assert resolver.lookups.count('good') == 1
+
+
+def test_failed_lookups_back_off(monkeypatch):
+    """A host that failed is not looked up again before its delay passed,
+    and the delay doubles while it keeps failing"""
+    now = [1000.0]
+    monkeypatch.setattr(discovery.time, 'time', lambda: now[0])
+    index, resolver = _discovery(monkeypatch, {})
+    index.resolve_async()
+    index.resolve_async()
+    assert resolver.lookups.count('bad') == 1
+
+    now[0] += discovery.RETRY_DELAY
+    index.resolve_async()
+    assert resolver.lookups.count('bad') == 2
+    now[0] += discovery.RETRY_DELAY
+    index.resolve_async()
+    assert resolver.lookups.count('bad') == 2
+    now[0] += discovery.RETRY_DELAY
+    index.resolve_async()
+    assert resolver.lookups.count('bad') == 3
+
+    # Once it resolves the failures are forgotten
+    resolver.addresses['bad'] = '10.2.2.2'
+    now[0] += discovery.MAX_RETRY_DELAY
+    index.resolve_async()
+    assert index.resolved('bad:81') == '10.2.2.2:81'
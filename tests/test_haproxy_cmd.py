@@ -0,0 +1,133 @@
+"""Tests of haproxy_cmd"""
+
+import shutil
+import subprocess
+
+import pytest
+
+import haproxy_cmd
+import supervisor
+
+SHARDS = 4
+# Processes per generation with nbproc
+NBPROC = 3
+
+
+@pytest.fixture
+def haproxy(tmp_path):
+    """Returns a function that starts a process named haproxy. They are
+    killed after the test"""
+    binary = tmp_path / 'haproxy'
+    shutil.copy(shutil.which('sleep'), str(binary))
+    procs = []
+
+    def _start():
+        proc = subprocess.Popen([str(binary), '60'])
+        procs.append(proc)
+        return proc
+
+    yield _start
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+
+def _write_pids(path, *procs):
+    with open(path, 'w') as pid_file:
+        pid_file.write('\n'.join(str(proc.pid) for proc in procs))
+
+
+def test_old_generations_of_own_shard(tmp_path, monkeypatch, haproxy):
+    """Only the old processes of this shard's pid file are counted, the
+    haproxy processes of the other shards are not"""
+    monkeypatch.setattr(haproxy_cmd, '_GENERATIONS', [])
+    monkeypatch.setattr(haproxy_cmd, '_MASTER', None)
+    pidfiles = [supervisor.shard_path(str(tmp_path / 'haproxy.pid'), index)
+                for index in range(SHARDS)]
+    first = [haproxy() for _ in pidfiles]
+    for pidfile, proc in zip(pidfiles, first):
+        _write_pids(pidfile, proc)
+
+    monkeypatch.setattr(haproxy_cmd, 'PIDFILE', pidfiles[0])
+    assert len(haproxy_cmd.haproxy_procs()) == 1
+    assert haproxy_cmd.old_generations() == 0
+
+    # A reload replaces the processes of shard 0, the old one finishes its
+    # connections
+    _write_pids(pidfiles[0], haproxy())
+    assert haproxy_cmd.old_generations() == 1
+
+    # Reloads of the other shards do not count either
+    for pidfile in pidfiles[1:]:
+        _write_pids(pidfile, haproxy())
+    assert haproxy_cmd.old_generations() == 1
+
+    first[0].kill()
+    first[0].wait()
+    assert haproxy_cmd.old_generations() == 0
+
+
+def test_old_generations_with_nbproc(tmp_path, monkeypatch, haproxy):
+    """Every process of a generation counts once, a generation lingers until
+    its last process stopped"""
+    monkeypatch.setattr(haproxy_cmd, '_GENERATIONS', [])
+    monkeypatch.setattr(haproxy_cmd, '_MASTER', None)
+    pidfile = str(tmp_path / 'haproxy.pid')
+    monkeypatch.setattr(haproxy_cmd, 'PIDFILE', pidfile)
+    first = [haproxy() for _ in range(NBPROC)]
+    _write_pids(pidfile, *first)
+    assert len(haproxy_cmd.haproxy_procs()) == NBPROC
+    assert haproxy_cmd.old_generations() == 0
+
+    second = [haproxy() for _ in range(NBPROC)]
+    _write_pids(pidfile, *second)
+    assert haproxy_cmd.old_generations() == 1
+    _write_pids(pidfile, *[haproxy() for _ in range(NBPROC)])
+    assert haproxy_cmd.old_generations() == 2
+
+    for proc in second + first[1:]:
+        proc.kill()
+        proc.wait()
+    assert haproxy_cmd.old_generations() == 1
+    first[0].kill()
+    first[0].wait()
+    assert haproxy_cmd.old_generations() == 0
+
+
+def test_old_worker_generations():
+    """The master's old workers are counted by reload"""
+    reply = '\n'.join([
+        '#<PID>          <type>          <relative PID>  <reloads>       '
+        '<uptime>        <version>',
+        '100             master          0               3               '
+        '0d00h05m00s     2.0.14',
+        '# workers',
+        '301             worker          1               0               '
+        '0d00h00m10s     2.0.14',
+        '302             worker          2               0               '
+        '0d00h00m10s     2.0.14',
+        '# old workers',
+        '201             worker          [was: 1]        1               '
+        '0d00h01m00s     2.0.14',
+        '202             worker          [was: 2]        1               '
+        '0d00h01m00s     2.0.14',
+        '101             worker          [was: 1]        3               '
+        '0d00h05m00s     2.0.14',
+        '',
+    ])
+    assert haproxy_cmd._old_workers(reply) == 2
+
+
+def test_takeover_leaves_old_processes_running(tmp_path, monkeypatch,
+                                               haproxy):
+    """The new processes stop the old ones through -sf once they are bound,
+    nothing is signalled before"""
+    monkeypatch.setattr(haproxy_cmd, '_MASTER', None)
+    pidfile = str(tmp_path / 'haproxy.pid')
+    monkeypatch.setattr(haproxy_cmd, 'PIDFILE', pidfile)
+    procs = [haproxy() for _ in range(NBPROC)]
+    _write_pids(pidfile, *procs)
+
+    cmd = haproxy_cmd._takeover('haproxy.cfg')
+    assert cmd[cmd.index('-sf') + 1:] == [str(proc.pid) for proc in procs]
+    assert all(proc.poll() is None for proc in procs)
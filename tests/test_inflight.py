@@ -0,0 +1,96 @@
+"""Tests of the requests in flight"""
+
+import json
+
+import inflight
+
+
+def test_schedule_resolved_by_id():
+    """Schedules resolve once the instance the backend named is serving"""
+    pending = inflight.InFlight()
+    entries = pending.schedule(2, now=0)
+    pending.scheduled(entries, ['1', '2'])
+    assert pending.pending() == 2
+
+    assert pending.resolve({'2'}, lambda instance: True, now=30) == [30]
+    assert pending.pending() == 1
+    assert pending.resolve({'1', '2'}, lambda instance: True, now=40) == [40]
+    assert pending.pending() == 0
+
+
+def test_schedule_partly_failed():
+    """Entries beyond the ids the backend returned were not scheduled, those
+    of a failed request are dropped"""
+    pending = inflight.InFlight()
+    pending.scheduled(pending.schedule(3, now=0), ['1'])
+    assert pending.pending() == 1
+    pending.failed(pending.schedule(2, now=0))
+    assert pending.pending() == 1
+
+
+def test_schedule_resolved_without_id():
+    """Without ids, newly serving instances resolve the oldest schedules"""
+    pending = inflight.InFlight()
+    pending.resolve({'old'}, lambda instance: True, now=0)
+    pending.scheduled(pending.schedule(1, now=10), [])
+    pending.scheduled(pending.schedule(1, now=20), [])
+
+    # Instances that were already serving resolve nothing
+    assert pending.resolve({'old'}, lambda instance: True, now=25) == []
+    assert pending.resolve({'old', 'new'}, lambda instance: True,
+                           now=30) == [20]
+    assert pending.pending() == 1
+
+
+def test_schedule_expired():
+    """Schedules past their deadline are given up on. Named instances are
+    returned to be deleted"""
+    pending = inflight.InFlight()
+    pending.scheduled(pending.schedule(1, now=0, timeout=60), ['1'])
+    pending.scheduled(pending.schedule(1, now=0, timeout=60), [])
+    pending.scheduled(pending.schedule(1, now=0, timeout=120), ['3'])
+
+    assert pending.expire(now=59) == ([], [])
+    assert pending.expire(now=60) == (['1'], [])
+    assert pending.pending() == 1
+
+
+def test_delete_resolved():
+    """Deletes resolve once the instance left discovery"""
+    pending = inflight.InFlight()
+    pending.delete(['1', '2'], now=0)
+    assert pending.deleting('1')
+    pending.resolve(set(), lambda instance: instance == '2', now=10)
+    assert not pending.deleting('1')
+    assert pending.deletes() == 1
+
+
+def test_delete_retried():
+    """Deletes are sent again after their timeout or a failure, up to
+    DELETE_RETRIES times"""
+    pending = inflight.InFlight()
+    now = 0
+    pending.delete(['1'], now)
+    assert pending.expire(now + 1) == ([], [])
+    pending.delete_failed(['1'])
+    assert pending.expire(now + 1) == ([], ['1'])
+
+    for _ in range(inflight.DELETE_RETRIES):
+        pending.delete(['1'], now)
+        now += inflight.DELETE_TIMEOUT
+    assert pending.expire(now) == ([], [])
+    assert not pending.deleting('1')
+
+
+def test_snapshot_restore():
+    """Requests in flight survive a restart through JSON"""
+    pending = inflight.InFlight()
+    pending.scheduled(pending.schedule(2, now=0), ['1'])
+    pending.delete(['9'], now=0)
+    pending.resolve({'5'}, lambda instance: True, now=0)
+
+    restored = inflight.InFlight()
+    restored.restore(json.loads(json.dumps(pending.snapshot())))
+    assert restored.pending() == 1
+    assert restored.deleting('9')
+    assert restored.resolve({'1', '5'}, lambda instance: True, now=10) == [10]
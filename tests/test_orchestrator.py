@@ -0,0 +1,62 @@
+"""Tests of the orchestrator"""
+
+import orchestrator
+import policy
+
+
+def _orchestrator(**elasticity):
+    """An orchestrator of a service with the given elasticity, with the
+    defaults of the configurator"""
+    elasticity.setdefault('method', 'conn_rate')
+    elasticity.setdefault('min_servers', 0)
+    elasticity.setdefault('max_servers', None)
+    return orchestrator.Orchestrator(
+        'web', {'elasticity': elasticity, 'treadmill': {}}, None, None, None,
+        policy.CompositePolicy())
+
+
+def _saved(**state):
+    """Orchestrator state as saved by snapshot"""
+    saved = _orchestrator().snapshot()
+    saved.update(state)
+    return saved
+
+
+def test_restore_within_config():
+    """The restored target is kept within the bounds of the config the
+    service restarted with, which also sets min_servers"""
+    orch = _orchestrator(min_servers=2, max_servers=5)
+    orch.restore(_saved(target=8, min_servers=0))
+    assert orch.status()['target'] == 5
+    assert orch._elasticity['min_servers'] == 2
+
+    orch = _orchestrator(min_servers=2, max_servers=5)
+    orch.restore(_saved(target=1, min_servers=0))
+    assert orch.status()['target'] == 2
+
+
+def test_restore_held_connections():
+    """With held connections min_servers follows the connections and is
+    restored"""
+    orch = _orchestrator(hold_conns=True, cooldown=60)
+    orch.restore(_saved(target=3, min_servers=3))
+    assert orch.status()['target'] == 3
+    assert orch._elasticity['min_servers'] == 3
+
+
+def test_standby_added_live():
+    """A standby pool added to a running orchestrator is sized with the
+    default launch latency"""
+    orch = _orchestrator()
+    assert orch.standby_size() == 0
+    orch.configure({'method': 'conn_rate', 'standby': {'min': 2}})
+    assert orch._elasticity['launch_latency'] == orchestrator.LAUNCH_LATENCY
+    assert orch.standby_size() == 2
+
+
+def test_predict_added_live():
+    """Forecasts added to a running orchestrator start from their configured
+    launch latency"""
+    orch = _orchestrator()
+    orch.configure({'method': 'conn_rate', 'predict': {'latency': 30}})
+    assert orch._elasticity['launch_latency'] == 30
@@ -0,0 +1,42 @@
+"""Tests of the trace recorder"""
+
+import recorder
+import stats
+
+
+def _record(now, **values):
+    record = dict.fromkeys(recorder.METRICS + recorder.STATE, 0)
+    record.update(time=now, service='web', measure=None)
+    record.update(values)
+    return record
+
+
+def test_every_stats_field_recorded(tmp_path):
+    """Every column a policy can read survives the trace"""
+    path = str(tmp_path / 'trace')
+    writer = recorder.TraceWriter(path)
+    values = {field: index + 1 for index, field in enumerate(stats.FIELDS)}
+    writer.write(_record(1.0, measure=0.5, target=3, **values))
+    writer.close()
+
+    records = list(recorder.read(path))
+    assert len(records) == 1
+    for field, value in values.items():
+        assert records[0][field] == value
+    assert records[0]['target'] == 3
+    assert records[0]['measure'] == 0.5
+
+
+def test_rotation(tmp_path):
+    """Full traces are rotated and only keep of them are kept"""
+    path = str(tmp_path / 'trace')
+    size = recorder.HEADER.size + 2 * recorder.RECORD.size
+    writer = recorder.TraceWriter(path, max_size=size, keep=2)
+    for now in range(7):
+        writer.write(_record(float(now)))
+    writer.close()
+
+    paths = recorder.files(path)
+    assert paths == [path + '.2', path + '.1', path]
+    assert [record['time'] for name in paths
+            for record in recorder.read(name)] == [2.0, 3.0, 4.0, 5.0, 6.0]
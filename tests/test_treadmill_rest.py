@@ -0,0 +1,161 @@
+"""Tests of the REST backend against the treadmill stub"""
+
+import time
+
+import pytest
+from twisted.internet import error
+from twisted.internet import reactor
+from twisted.python import failure
+from twisted.web import server
+
+import treadmill_api
+import treadmill_rest
+import treadmill_stub
+
+
+def _wait(deferred, timeout=5):
+    """Runs the reactor until a Deferred fired. Returns its result or raises
+    its failure"""
+    results = []
+    deferred.addBoth(results.append)
+    deadline = time.time() + timeout
+    while not results and time.time() < deadline:
+        reactor.iterate(0.01)
+    assert results, 'timed out'
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+class Flaky(treadmill_stub.TreadmillStub):
+    """Stub that answers the first requests with an internal error"""
+    def __init__(self, failures):
+        treadmill_stub.TreadmillStub.__init__(self)
+        self.failures = failures
+        self.requests = 0
+
+    def render(self, request):
+        self.requests += 1
+        if self.requests <= self.failures:
+            request.setResponseCode(500)
+            return b'unavailable'
+        return treadmill_stub.TreadmillStub.render(self, request)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def threadpool():
+    """Host lookups run in the threadpool that reactor.run starts. It can not
+    be started again once stopped"""
+    pool = reactor.getThreadPool()
+    pool.start()
+    yield
+    pool.stop()
+
+
+@pytest.fixture
+def serve():
+    """Serves a stub on a free port. Returns a backend for its URL"""
+    ports = []
+    backends = []
+
+    def _serve(stub, **kwargs):
+        port = reactor.listenTCP(0, server.Site(stub), interface='127.0.0.1')
+        ports.append(port)
+        backend = treadmill_rest.RestBackend(
+            'http://127.0.0.1:{}/'.format(port.getHost().port), **kwargs)
+        backends.append(backend)
+        return backend
+
+    yield _serve
+    for backend in backends:
+        _wait(backend._pool.closeCachedConnections())
+    for port in ports:
+        _wait(port.stopListening())
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    path = tmp_path / 'manifest.yml'
+    path.write_text('memory: 100M\ncpu: 10%\n')
+    return str(path)
+
+
+def test_start_discover_stop(serve, manifest):
+    """Containers are scheduled, discovered and deleted through the API"""
+    stub = treadmill_stub.TreadmillStub()
+    backend = serve(stub)
+
+    instances = _wait(backend.start_containers('proid.web', manifest, 2))
+    assert instances == ['0000000001', '0000000002']
+    assert stub.count('proid.web') == 2
+
+    endpoints = _wait(backend.discover('proid.*'))
+    assert endpoints == {'proid.web': {
+        '0000000001': {'http': 'localhost:20000'},
+        '0000000002': {'http': 'localhost:20001'},
+    }}
+
+    _wait(backend.stop_containers('proid.web', ['0000000001']))
+    assert list(_wait(backend.discover('proid.web'))['proid.web']) == [
+        '0000000002']
+
+
+def test_retry_with_backoff(serve):
+    """Idempotent requests are sent again after errors of the API"""
+    stub = Flaky(2)
+    stub.schedule('proid.web', 1)
+    backend = serve(stub, retries=3, backoff=0.01)
+    assert list(_wait(backend.discover('proid.web'))['proid.web']) == [
+        '0000000001']
+    assert stub.requests == 3
+
+
+def test_retries_exhausted(serve):
+    """Requests fail once out of retries"""
+    stub = Flaky(5)
+    backend = serve(stub, retries=2, backoff=0.01)
+    with pytest.raises(treadmill_api.TreadmillError):
+        _wait(backend.discover('proid.web'))
+    assert stub.requests == 3
+
+
+def test_rejected_not_retried(serve):
+    """Requests the API rejected are neither retried nor sent to the
+    fallback"""
+    fallback = treadmill_stub.StubBackend(treadmill_stub.TreadmillStub())
+    backend = serve(treadmill_stub.TreadmillStub(), backoff=0.01,
+                    fallback=fallback)
+    with pytest.raises(treadmill_rest.RequestRejected):
+        _wait(backend._request(b'GET', '/unknown'))
+
+
+def test_unsent_schedule_not_retried(serve, manifest):
+    """Schedules that may have reached the API are not sent again"""
+    stub = Flaky(1)
+    fallback = treadmill_stub.StubBackend(treadmill_stub.TreadmillStub())
+    backend = serve(stub, backoff=0.01, fallback=fallback)
+    with pytest.raises(treadmill_api.TreadmillError):
+        _wait(backend.start_containers('proid.web', manifest, 1))
+    assert stub.requests == 1
+    assert fallback.stub.count('proid.web') == 0
+
+
+def test_fallback(manifest):
+    """Requests that never reached the API go to the fallback"""
+    stub = treadmill_stub.TreadmillStub()
+    port = reactor.listenTCP(0, server.Site(stub), interface='127.0.0.1')
+    url = 'http://127.0.0.1:{}/'.format(port.getHost().port)
+    _wait(port.stopListening())
+
+    fallback = treadmill_stub.StubBackend(treadmill_stub.TreadmillStub())
+    backend = treadmill_rest.RestBackend(url, retries=1, backoff=0.01,
+                                         fallback=fallback)
+    instances = _wait(backend.start_containers('proid.web', manifest, 1))
+    assert instances == ['0000000001']
+    assert fallback.stub.count('proid.web') == 1
+    assert list(_wait(backend.discover('proid.web'))['proid.web']) == [
+        '0000000001']
+
+    without = treadmill_rest.RestBackend(url, retries=0)
+    with pytest.raises(error.ConnectionRefusedError):
+        _wait(without.discover('proid.web'))
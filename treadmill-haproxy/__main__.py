@@ -4,7 +4,9 @@ import logging
 
 import click
 
+import configurator
 from conductor import Conductor
+import supervisor
 
 @click.command()
 @click.option('--socket', default='/run/haproxy/', help='HAProxy socket')
@@ -13,14 +15,32 @@ from conductor import Conductor
               help="Configuration file")
 @click.option('--haproxy-config', 'haproxy_file',
               default='config/haproxy.conf')
+@click.option('--metrics-port', type=int, default=None,
+              help='Serve Prometheus metrics on this port')
+@click.option('--state-file', default=None,
+              help='Save state here and restore it on start')
+@click.option('--shard', type=int, default=None,
+              help='Run the services of one shard, set by the supervisor')
+@click.option('--heartbeat', default=None,
+              help='Touch this file after every loop, set by the supervisor')
 @click.option('--debug', is_flag=True, default=False)
-def main(socket, config_file, haproxy_file, debug):
+def main(socket, config_file, haproxy_file, metrics_port, state_file, shard,
+         heartbeat, debug):
     """Configure logging and start monitering"""
     if debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
-    conductor = Conductor(socket, config_file, haproxy_file)
+    count = configurator.load_json(config_file).get('shards', {}).get(
+        'count', 1)
+    if count > 1 and shard is None:
+        # Every shard runs in a worker process of its own
+        supervisor.Supervisor(count, supervisor.worker_command()).run()
+        return
+    conductor = Conductor(socket, config_file, haproxy_file, metrics_port,
+                          state_file,
+                          (shard, count) if shard is not None else None,
+                          heartbeat)
     conductor.monitor()
 
 
@@ -0,0 +1,104 @@
+"""Balances the weights of a service's servers by their response times"""
+
+import logging
+import math
+
+import haproxy_cmd
+
+# Weight of a server that is as fast as the average of its service, unless
+# the server options set one. Slot servers are written with it.
+BASE_WEIGHT = 100
+# Default share of the way to the target weight moved every loop
+DAMPING = 0.3
+# Default bounds of the weights. haproxy accepts 0 to 256, 0 takes a server
+# out of rotation which is left to the orchestrator.
+MIN_WEIGHT = 10
+MAX_WEIGHT = 256
+# Default distance of a weight from its target, as a share of the weight,
+# below which it is kept
+TOLERANCE = 0.1
+_LOGGER = logging.getLogger(__name__)
+
+
+def base_weight(options):
+    """Returns the weight set in a list of server options, BASE_WEIGHT if
+    there is none"""
+    for option in options:
+        words = option.split()
+        if len(words) == 2 and words[0] == 'weight':
+            return int(words[1])
+    return BASE_WEIGHT
+
+
+def cost(row):
+    """Milliseconds a request takes on a server. The average response time is
+    stretched by the requests queued for the server, each waiting for one of
+    its sessions to finish. None if the server has not answered yet"""
+    if not row['rtime']:
+        return None
+    return row['rtime'] * (1 + row['qcur'] / float(max(row['scur'], 1)))
+
+
+class Balancer(object):
+    """Moves traffic toward the faster servers of a service. Every loop the
+    weight of each serving server is moved part of the way to the base weight
+    scaled by how much faster than average it answers. Weights are set
+    through the runtime API and set again after a reload resets them"""
+    def __init__(self, service_name, service, haproxy, stats):
+        self._service_name = service_name
+        self._settings = service['balance']
+        self._server_options = service['haproxy']['server']
+        self._haproxy = haproxy
+        self._stats = stats
+        # Weight applied to every server by name in haproxy
+        self._weights = {}
+
+    def targets(self, rows, base):
+        """Returns the weight each server of rows should converge to. Servers
+        without response times stay at the base weight"""
+        costs = {server: cost(row) for server, row in rows.items()}
+        measured = [value for value in costs.values() if value]
+        # Nothing to compare a single server with
+        if len(measured) < 2:
+            return {server: base for server in rows}
+        mean = sum(measured) / len(measured)
+        # A base weight below the bounds would invert them
+        low = min(self._settings.get('min_weight', MIN_WEIGHT), base)
+        high = max(self._settings.get('max_weight', MAX_WEIGHT), low)
+        return {server: max(low, min(high, base * mean / value))
+                        if value else base
+                for server, value in costs.items()}
+
+    def balance(self):
+        """Reads the servers from the stats snapshot and sets the weights
+        that changed. Returns the number of servers whose weight was set"""
+        # Drained servers and empty slots get no new connections anyway
+        rows = {server: row for server, row in
+                self._stats.servers(self._service_name).items()
+                if row['status'].startswith('UP')}
+        for server in set(self._weights) - set(rows):
+            del self._weights[server]
+
+        base = base_weight(self._server_options)
+        damping = self._settings.get('damping', DAMPING)
+        tolerance = self._settings.get('tolerance', TOLERANCE)
+        changed = 0
+        for server, target in sorted(self.targets(rows, base).items()):
+            # New servers start at the base weight
+            weight = self._weights.get(server, base)
+            # Close enough weights are left alone, so they do not flap
+            if abs(target - weight) >= max(1, tolerance * weight):
+                step = damping * (target - weight)
+                weight += int(math.copysign(max(1, abs(round(step))), step))
+            # A reload or another process may have reset the weight
+            if weight == rows[server]['weight']:
+                self._weights[server] = weight
+                continue
+            _LOGGER.debug('Weight of %s/%s: %d -> %d', self._service_name,
+                          server, rows[server]['weight'], weight)
+            if haproxy_cmd.runtime_command(
+                    self._haproxy, 'set weight {}/{} {}'.format(
+                        self._service_name, server, weight)):
+                self._weights[server] = weight
+                changed += 1
+        return changed
@@ -1,94 +1,629 @@
 """Starts and runs the orchestrator and watcher for every configured service"""
 
 import atexit
+import fnmatch
+import functools
 import logging
+import os
 import sys
+import time
 
 from haproxyadmin import haproxy
+from twisted.internet import defer
 from twisted.internet import task
 from twisted.internet import reactor
 from twisted.python import log
+from twisted.web import server
 
+import balancer
 import configurator
+import discovery
+import discovery_watch
 import haproxy_cmd
+import metrics
 import orchestrator
+import policy
+import process
+import recorder
+import scheduler
+import state
+import stats
+import supervisor
+import treadmill_api
+import treadmill_rest
 import watcher
 
-LOOP_TIME = 7
+# Seconds between checks for services that are due to run
+TICK_TIME = 1
+# Seconds between full discoveries when discovery is watched
+RECONCILE_TIME = 60
+# Seconds to collect discovery events before committing them
+WAKE_DELAY = 0.1
+# Seconds between checks of the config file for changes
+CONFIG_POLL_TIME = 2
+# Seconds between saves of the state while no servers change
+SAVE_TIME = 30
+# Top-level settings that only apply when the daemon starts
+RESTART_SETTINGS = ('treadmill_api', 'discovery', 'processes', 'master',
+                    'trace', 'shards')
 
 
 class Conductor(object):
     """Launches orchestrators and watchers and starts event loop"""
-    def __init__(self, socket, config_file, haproxy_file):
-        """Parse the config file and create corresponding watchers and pools"""
+    def __init__(self, socket, config_file, haproxy_file, metrics_port=None,
+                 state_file=None, shard=None, heartbeat=None):
+        """Parse the config file and create corresponding watchers and pools.
+        Servers and orchestrator state saved in state_file by a previous run
+        are restored. With a shard, a tuple of index and count, only the
+        services of the shard are run, with a haproxy, socket directory and
+        files of its own. The heartbeat file is touched after every loop"""
+        self._shard = shard
+        self._heartbeat = heartbeat
+        if shard is not None:
+            index = shard[0]
+            socket = supervisor.shard_dir(socket, index)
+            haproxy_file = supervisor.shard_path(haproxy_file, index)
+            if state_file:
+                state_file = supervisor.shard_path(state_file, index)
+            if metrics_port:
+                metrics_port += index
+            haproxy_cmd.use_pidfile(
+                supervisor.shard_path(haproxy_cmd.PIDFILE, index))
+        self._metrics_port = metrics_port
         self._watchers = []
         self._orchestrators = []
+        # Every service with its schedule, watcher and orchestrator
+        self._services = []
+        # Watchers of each treadmill app, to wake on discovery events
+        self._app_watchers = {}
+        # Discovery results shared by every watcher
+        self._discovery = discovery.Discovery()
+        self._last_discovery = 0
+        # Apps with discovery events waiting to be committed
+        self._woken = set()
+        self._wake_call = None
+        # Only one commit writes the config at a time
+        self._commit_lock = defer.DeferredLock()
 
+        self._haproxy_file = haproxy_file
+        self._config_file = config_file
+        self._config_mtime = os.stat(config_file).st_mtime
         # Config parser
         self._configurator = configurator.Configurator(socket, config_file,
-                                                       haproxy_file)
+                                                       haproxy_file, shard)
 
         # Get list of services and their configs
         services = self._configurator.parse_config()
 
+        # Start with the servers of the last run so haproxy serves them right
+        # away. Discovery reconciles them in the first loops.
+        self._state = None
+        saved = None
+        if state_file:
+            self._state = state.StateFile(state_file)
+            saved = state.load(state_file)
+        if saved:
+            self._discovery.restore(saved['discovery'])
+            for service_name, service in services.items():
+                if service_name in saved['servers']:
+                    self._configurator.restore_servers(
+                        service_name, saved['servers'][service_name],
+                        service['haproxy']['server'])
+
+        # Talk to treadmill through the REST API if configured, keeping the
+        # command line as a fallback
+        api = self._configurator.api_settings()
+        if api:
+            fallback = None
+            if api.get('fallback', True):
+                fallback = treadmill_api.CliBackend()
+            treadmill_api.use_backend(treadmill_rest.RestBackend(
+                api['url'], timeout=api.get('timeout', treadmill_rest.TIMEOUT),
+                retries=api.get('retries', treadmill_rest.RETRIES),
+                fallback=fallback))
+
+        # Reload through the master CLI of a master-worker haproxy
+        master = self._configurator.master_settings()
+        if master is not None:
+            master_socket = self._shard_path(
+                master.get('socket', haproxy_cmd.MASTER_SOCKET))
+            if (os.path.dirname(os.path.abspath(master_socket)) ==
+                    os.path.abspath(socket)):
+                raise ValueError('Master socket {} must be outside the stats '
+                                 'socket directory'.format(master_socket))
+            haproxy_cmd.use_master(master_socket,
+                                   self._configurator.stats_sockets()[0])
+
         # Write the initial configuration to file
         self._configurator.config_write()
 
         # If there is an existing HAProxy running that is using the same
         # pid file, take over the existing to avoid conflicts
         if haproxy_cmd.haproxy_proc():
-            haproxy_cmd.restart_haproxy()
+            haproxy_cmd.restart_haproxy(haproxy_file)
         else:
-            haproxy_cmd.start_haproxy()
+            haproxy_cmd.start_haproxy(haproxy_file)
+        # The initial config is already loaded
+        self._configurator.config_loaded()
+
+        # Coalesces reloads from bursts of changes
+        self._scheduler = haproxy_cmd.ReloadScheduler(
+            **self._configurator.reload_settings())
 
         # Instantiate initial connection to haproxy socket only once
-        haproxy_sock = haproxy.HAProxy(socket_dir=socket)
+        self._haproxy = haproxy.HAProxy(socket_dir=socket)
+        # Statistics read once per loop for every orchestrator
+        self._stats = stats.StatsSnapshot(self._haproxy)
+        # Targets of every service with the composite method, computed from
+        # each snapshot at once
+        self._policy = policy.CompositePolicy()
 
-        # Share the single instance of haproxy socket and config parser for
-        # efficiency
         for service_name, service in services.items():
-            self._watchers.append(
-                watcher.Watcher(service_name, service, self._configurator))
+            svc = self._add_service(service_name, service)
+            if (svc['orchestrator'] and saved and
+                    service_name in saved['orchestrators']):
+                svc['orchestrator'].restore(
+                    saved['orchestrators'][service_name])
 
-            # Only create orchestrators when the config is present
-            if 'elasticity' in service:
-                self._orchestrators.append(
-                    orchestrator.Orchestrator(service_name, service,
-                                              haproxy_sock))
+        # Discovery events wake the affected watchers right away. Full
+        # discovery then only runs every reconcile seconds to catch anything
+        # the watch missed.
+        settings = self._configurator.discovery_settings()
+        self._watch = None
+        # Patterns with a discovery watch process
+        self._watched = set()
+        self._reconcile = 0
+        if settings.get('watch'):
+            self._reconcile = settings.get('reconcile', RECONCILE_TIME)
+            self._watch = discovery_watch.DiscoveryWatch(self._discovery,
+                                                         self.wake)
+            if 'file' in settings:
+                self._watch.add_source(
+                    discovery_watch.FileSource(settings['file']))
+            else:
+                self._watch_apps()
+
+        # Orchestrator state is read when the metrics are rendered
+        for field in ('target', 'pending', 'healthy', 'standby', 'draining',
+                      'measure'):
+            metrics.REGISTRY.register(metrics.Gauge(
+                'treadmill_haproxy_service_' + field,
+                'Orchestrator {} of a service'.format(field),
+                functools.partial(self._service_metric, field)))
+
+        # What every orchestrator loop read and decided, for replay.py
+        trace = self._configurator.trace_settings()
+        self._recorder = None
+        if trace:
+            self._recorder = recorder.TraceWriter(
+                self._shard_path(trace['file']),
+                trace.get('max_size', recorder.MAX_SIZE),
+                trace.get('keep', recorder.KEEP))
 
         # Run self._cleanup on exit
         atexit.register(self._cleanup)
 
+    def _shard_path(self, path):
+        """Returns the file of this shard for a file every shard has"""
+        if self._shard is None:
+            return path
+        return supervisor.shard_path(path, self._shard[0])
+
+    def _beat(self):
+        """Tells the supervisor the loop is running"""
+        with open(self._heartbeat, 'a'):
+            os.utime(self._heartbeat, None)
+
+    def _add_service(self, service_name, service):
+        """Creates the watcher, orchestrator and schedule of a service whose
+        listen blocks are in the config. Returns its entry in the services"""
+        # Share the single instance of haproxy socket and config parser for
+        # efficiency
+        watch = watcher.Watcher(service_name, service, self._configurator,
+                                self._haproxy, self._discovery)
+        self._watchers.append(watch)
+        self._app_watchers.setdefault(service['treadmill']['appname'],
+                                      []).append(watch)
+
+        # Only create orchestrators when the config is present
+        orch = None
+        if 'elasticity' in service:
+            orch = orchestrator.Orchestrator(service_name, service,
+                                             self._haproxy,
+                                             self._configurator,
+                                             self._stats, self._policy)
+            self._orchestrators.append(orch)
+
+        svc = {
+            'name': service_name,
+            'app': service['treadmill']['appname'],
+            'service': service,
+            'schedule': self._schedule(service),
+            'watcher': watch,
+            'orchestrator': orch,
+            'balancer': self._balancer(service_name, service),
+        }
+        self._services.append(svc)
+        return svc
+
+    def _balancer(self, service_name, service):
+        """Creates the weight balancer of a service if it is configured"""
+        if 'balance' not in service:
+            return None
+        return balancer.Balancer(service_name, service, self._haproxy,
+                                 self._stats)
+
+    @staticmethod
+    def _schedule(service):
+        """Creates the loop schedule of a service. Services that hold
+        connections never back off beyond HOLD_INTERVAL"""
+        interval = service.get('interval', {})
+        min_interval = interval.get('min', scheduler.MIN_INTERVAL)
+        max_interval = interval.get('max', scheduler.MAX_INTERVAL)
+        if service.get('elasticity', {}).get('hold_conns'):
+            max_interval = min(max_interval, scheduler.HOLD_INTERVAL)
+            min_interval = min(min_interval, max_interval)
+        return scheduler.ServiceSchedule(time.time(), min_interval,
+                                         max_interval)
+
+    def _remove_service(self, service_name):
+        """Stops watching and orchestrating a service and removes its listen
+        blocks. Its containers are left running"""
+        svc = self._service(service_name)
+        self._services.remove(svc)
+        self._watchers.remove(svc['watcher'])
+        self._app_watchers[svc['app']].remove(svc['watcher'])
+        if not self._app_watchers[svc['app']]:
+            del self._app_watchers[svc['app']]
+            self._discovery.unregister(svc['app'])
+        if svc['orchestrator']:
+            svc['orchestrator'].close()
+            self._orchestrators.remove(svc['orchestrator'])
+        self._configurator.remove_service(service_name)
+
+    def _service(self, service_name):
+        """Returns the entry of a service in the services"""
+        return next(svc for svc in self._services
+                    if svc['name'] == service_name)
+
+    def _update_service(self, service_name, old, new):
+        """Applies a changed service config. Changes to the app, endpoint,
+        port or connection holding recreate the service, everything else is
+        applied in place. Returns the entry of the service"""
+        old_elasticity = old.get('elasticity', {})
+        new_elasticity = new.get('elasticity', {})
+        if (('elasticity' in old) != ('elasticity' in new) or
+                old_elasticity.get('hold_conns') !=
+                new_elasticity.get('hold_conns') or
+                (new_elasticity.get('hold_conns') and
+                 old['haproxy'] != new['haproxy']) or
+                old['haproxy']['port'] != new['haproxy']['port'] or
+                ('slots' in old['haproxy']) != ('slots' in new['haproxy']) or
+                old['treadmill']['appname'] != new['treadmill']['appname'] or
+                old['treadmill']['endpoint'] != new['treadmill']['endpoint']):
+            logging.info('Recreating service %s', service_name)
+            self._remove_service(service_name)
+            self._configurator.add_service(service_name, new)
+            return self._add_service(service_name, new)
+
+        logging.info('Updating service %s', service_name)
+        svc = self._service(service_name)
+        service = svc['service']
+        # The watcher and orchestrator hold on to these dicts
+        service['treadmill'].update(new['treadmill'])
+        if old['haproxy'] != new['haproxy']:
+            for cmd in self._configurator.update_service(
+                    service_name, old['haproxy'], new['haproxy']):
+                if not haproxy_cmd.runtime_command(self._haproxy, cmd):
+                    self._configurator.request_reload('runtime_failed')
+            service['haproxy'].clear()
+            service['haproxy'].update(new['haproxy'])
+        if old_elasticity != new_elasticity:
+            svc['orchestrator'].configure(new_elasticity)
+        if old.get('balance') != new.get('balance'):
+            service.pop('balance', None)
+            if 'balance' in new:
+                service['balance'] = new['balance']
+            svc['balancer'] = self._balancer(service_name, service)
+        if old.get('interval') != new.get('interval'):
+            service['interval'] = new.get('interval', {})
+            svc['schedule'] = self._schedule(service)
+        return svc
+
+    def check_config(self):
+        """Applies the config file if it changed since the last check.
+        Returns a Deferred"""
+        try:
+            mtime = os.stat(self._config_file).st_mtime
+        except OSError as err:
+            logging.error('Unable to check config: %s', err)
+            return defer.succeed(None)
+        if mtime == self._config_mtime:
+            return defer.succeed(None)
+        self._config_mtime = mtime
+        return defer.maybeDeferred(self.reload_config).addErrback(
+            self._loop_failed)
+
+    def reload_config(self):
+        """Reads the config file again and applies what changed. Services
+        that were added, removed or changed are updated and committed, the
+        others keep running untouched. Returns a Deferred that fires once
+        the changes were committed"""
+        changes = self._configurator.reload_config()
+        if changes is None:
+            return defer.succeed(None)
+        old, new = changes
+        logging.info('Config file changed, applying')
+
+        for key in RESTART_SETTINGS:
+            if old.get(key) != new.get(key):
+                logging.warning('Changes to %s apply after a restart', key)
+        if old.get('reload') != new.get('reload'):
+            pending = self._scheduler.pending()
+            self._scheduler = haproxy_cmd.ReloadScheduler(
+                **self._configurator.reload_settings())
+            if pending:
+                self._scheduler.request()
+
+        changed = []
+        for service_name in old['services']:
+            if service_name not in new['services']:
+                logging.info('Removing service %s', service_name)
+                self._remove_service(service_name)
+        for service_name, service in new['services'].items():
+            if service_name not in old['services']:
+                logging.info('Adding service %s', service_name)
+                self._configurator.add_service(service_name, service)
+                changed.append(self._add_service(service_name, service))
+            elif service != old['services'][service_name]:
+                changed.append(self._update_service(
+                    service_name, old['services'][service_name], service))
+
+        # New apps are discovered before their first commit and watched
+        apps = set(svc['app'] for svc in changed)
+        if self._watched:
+            for source in self._watch_apps(apps):
+                source.start()
+        refresh = self._discovery.refresh_async(apps)
+        refresh.addCallback(lambda _: self.commit(
+            [svc['watcher'] for svc in changed], write=True))
+        return refresh
+
+    def _watch_apps(self, apps=None):
+        """Adds a discovery watch process for apps, every registered one by
+        default, that no running watch covers. Returns the new sources"""
+        if apps is not None:
+            apps = [app for app in apps
+                    if not any(fnmatch.fnmatchcase(app, pattern)
+                               for pattern in self._watched)]
+        sources = []
+        for pattern in sorted(self._discovery.patterns(apps)):
+            source = discovery_watch.ProcessSource(pattern)
+            self._watch.add_source(source)
+            self._watched.add(pattern)
+            sources.append(source)
+        return sources
+
+    def _service_metric(self, field):
+        """Returns a field of every orchestrator's status for a gauge"""
+        return [({'service': status['service']}, status[field])
+                for status in (orch.status() for orch in self._orchestrators)]
+
     def _cleanup(self):
-        """Ran on exit. Stops haproxy"""
+        """Ran on exit. Saves the state changed since the last save and stops
+        haproxy"""
+        self._save_state()
         haproxy_cmd.stop_haproxy()
+        if self._recorder:
+            self._recorder.close()
 
     def loop(self):
-        """Loop through watchers and run the monitor loop for each"""
-        # Track if any of the services have changes that need to be committed
-        changes = False
-        for watch in self._watchers:
+        """Runs the watcher and orchestrator of every service that is due.
+        Returns a Deferred so the next loop only starts after this one
+        finished"""
+        now = time.time()
+        due = [svc for svc in self._services if svc['schedule'].due(now)]
+
+        # One batched discovery for every due watcher. With a discovery watch
+        # this is only a periodic reconciliation of every app.
+        if self._watch is None:
+            apps = set(svc['app'] for svc in due)
+            if apps:
+                loop = self._discovery.refresh_async(apps)
+            else:
+                loop = defer.succeed(None)
+        elif now - self._last_discovery >= self._reconcile:
+            self._last_discovery = now
+            loop = self._discovery.refresh_async()
+        else:
+            loop = defer.succeed(None)
+
+        # Even without due services a held back reload may be due
+        changed = []
+        loop.addCallback(
+            lambda _: self.commit([svc['watcher'] for svc in due]))
+        loop.addCallback(changed.extend)
+        loop.addCallback(lambda _: self.orchestrate(
+            [svc['orchestrator'] for svc in due if svc['orchestrator']],
+            [svc['balancer'] for svc in due if svc['balancer']]))
+        # Orchestrators ask for a reload when haproxy refused a runtime change
+        loop.addCallback(
+            lambda _: self._commit_lock.run(self._commit_requested))
+        # Errors are logged here, otherwise they stop the looping call
+        loop.addErrback(self._loop_failed)
+        loop.addCallback(lambda _: self._reschedule(due, changed))
+        if self._heartbeat:
+            loop.addCallback(lambda _: self._beat())
+        if due:
+            # Ticks without due services are not loops
+            loop.addCallback(lambda _: metrics.LOOPS.observe(
+                time.time() - now))
+        return loop
+
+    @staticmethod
+    def _reschedule(services, changed):
+        """Schedules the next run of services. Services that changed servers,
+        have pending containers, held connections or a rising measure run
+        again soon, idle ones back off"""
+        now = time.time()
+        for svc in services:
+            busy = svc['watcher'] in changed or bool(
+                svc['orchestrator'] and svc['orchestrator'].busy())
+            svc['schedule'].done(now, busy)
+
+    def wake(self, app):
+        """Called on a discovery event. Commits the app's watchers shortly,
+        so a burst of events ends up in one commit"""
+        self._woken.add(app)
+        if self._wake_call is None:
+            self._wake_call = reactor.callLater(WAKE_DELAY, self._wake)
+
+    def _wake(self):
+        """Commits the watchers of every app woken since the last call"""
+        watchers = []
+        for app in self._woken:
+            watchers.extend(self._app_watchers.get(app, []))
+        self._woken = set()
+        self._wake_call = None
+        self.commit(watchers).addErrback(self._loop_failed)
+
+    def commit(self, watchers=None, write=False):
+        """Runs watchers, every one by default, against the latest discovery
+        and commits their changes. The config is written even without changes
+        if write is set. Returns a Deferred that fires with the watchers that
+        had changes once haproxy was reloaded"""
+        if watchers is None:
+            watchers = self._watchers
+        return self._commit_lock.run(self._commit, watchers, write)
+
+    def _commit(self, watchers, write):
+        """Resolves the discovered hosts, then runs watchers and commits their
+        changes"""
+        # Resolving inside the reactor keeps a slow resolver from stalling it
+        commit = self._discovery.resolve_async()
+        commit.addCallback(lambda _: self._run_watchers(watchers, write))
+        return commit
+
+    def _run_watchers(self, watchers, write):
+        """Runs watchers and commits their changes"""
+        # Track which of the services have changes that need to be committed
+        changes = []
+        for watch in watchers:
             # Check for the return value of the loop. Indicates whether each
             # individual watcher has changes that need to be comitted to the
             # haproxy config
             if watch.loop():
-                changes = True
+                changes.append(watch)
+
+        if changes or write:
+            # Commit once after all services have been processed for
+            # efficiency. The config is always written so a restart keeps the
+            # servers that were applied through the runtime API.
+            logging.debug("Write to config")
+            commit = self._configurator.config_write_async()
+            commit.addCallback(lambda _: self._schedule_reload())
+            commit.addCallback(lambda _: self._reload())
+            # Changed servers are saved right away, the rest on a timer
+            commit.addCallback(lambda _: self._save_state())
+        else:
+            # A reload held back by an earlier loop may be due now
+            commit = defer.maybeDeferred(self._reload)
+        commit.addCallback(lambda _: changes)
+        return commit
 
-        if changes:
-            # Commit once after all services have been processed for efficiency
-            logging.debug("Write to config and restart")
-            self._configurator.config_write()
-            haproxy_cmd.restart_haproxy()
+    def _commit_requested(self):
+        """Writes the config and schedules a reload if one was requested
+        outside of the watchers' commits"""
+        if not self._configurator.reload_reasons():
+            return None
+        commit = self._configurator.config_write_async()
+        commit.addCallback(lambda _: self._schedule_reload())
+        commit.addCallback(lambda _: self._reload())
+        return commit
+
+    def _save_state(self):
+        """Saves the servers, discovery results and orchestrator state for
+        the next run"""
+        if self._state is None:
+            return
+        self._state.save({
+            'discovery': self._discovery.snapshot(),
+            'servers': {svc['name']: self._configurator.server_snapshot(
+                svc['name']) for svc in self._services},
+            'orchestrators': {svc['name']: svc['orchestrator'].snapshot()
+                              for svc in self._services
+                              if svc['orchestrator']},
+        })
+
+    def _schedule_reload(self):
+        """Asks the scheduler for a reload if the committed changes require
+        it. Changes that cancelled out drop the pending reload"""
+        if self._configurator.reload_required():
+            self._scheduler.request()
+        else:
+            self._scheduler.cancel()
 
+    def _reload(self):
+        """Restarts haproxy if the scheduler says a reload is due"""
+        if not self._scheduler.due():
+            return None
+        logging.debug("Restart")
+        for reason in self._configurator.reload_reasons():
+            metrics.RELOADS.inc(reason=reason)
+        self._scheduler.reloaded()
+        # Orchestrators change server states between commits. Write them so
+        # the reload keeps them.
+        reload = self._configurator.config_write_async()
+        reload.addCallback(lambda _: self._configurator.config_loaded())
+        reload.addCallback(
+            lambda _: haproxy_cmd.restart_haproxy_async(self._haproxy_file))
+        return reload
+
+    def orchestrate(self, orchestrators=None, balancers=()):
+        """Runs orchestrators, every one by default, after balancers. Their
+        container requests run concurrently. Returns a Deferred that fires
+        once all of them finished"""
+        if orchestrators is None:
+            orchestrators = self._orchestrators
         # Orchestrator processed after watcher. Pre-existing containers need to
         # be processed by watcher first. If not processed, orchestrator will
         # create more servers thinking that there are not enough.
-        for orch in self._orchestrators:
-            orch.loop()
+        if orchestrators or balancers:
+            self._stats.refresh()
+            self._policy.evaluate(self._stats, time.time())
+        # Traffic moves off slow servers before their response times make
+        # the orchestrators add containers
+        for balance in balancers:
+            balance.balance()
+        loops = [orch.loop() for orch in orchestrators]
+        if self._recorder:
+            now = time.time()
+            for orch in orchestrators:
+                self._recorder.write(orch.trace_record(now))
+        return process.gather(loops)
+
+    @staticmethod
+    def _loop_failed(failure):
+        """Logs a failed loop"""
+        logging.error('Loop failed: %s', failure.getTraceback())
+
+    def start(self):
+        """Schedules the monitor loop and the metrics endpoint on the
+        reactor"""
+        if self._watch:
+            self._watch.start()
+        if self._metrics_port:
+            reactor.listenTCP(self._metrics_port,
+                              server.Site(metrics.MetricsResource()))
+        loop = task.LoopingCall(self.loop)
+        loop.start(TICK_TIME)
+        task.LoopingCall(self.check_config).start(CONFIG_POLL_TIME,
+                                                  now=False)
+        if self._state:
+            task.LoopingCall(self._save_state).start(SAVE_TIME, now=False)
 
     def monitor(self):
         """Begin monitor loop"""
         log.startLogging(sys.stdout)
-        loop = task.LoopingCall(self.loop)
-        loop.start(LOOP_TIME)
+        self.start()
         reactor.run()
@@ -1,12 +1,29 @@
 """Parses configuration files"""
 
 from collections import OrderedDict
+import copy
+import hashlib
 import json
+import logging
+import os
+import tempfile
 
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
+from twisted.internet import defer
+
+import balancer
+import haproxy_cmd
 
 SCHEMA = "config/schema.json"
+# Placeholder address for pre-allocated servers without an instance
+EMPTY_SLOT = '0.0.0.0:0'
+# Seconds between reloads, seconds a change may wait and number of old
+# haproxy processes allowed to linger before reloads are held back
+RELOAD_DEFAULTS = {'min_interval': 10, 'max_delay': 60, 'max_generations': 3}
+# Single threaded single process haproxy unless configured otherwise
+PROCESS_DEFAULTS = {'nbproc': 1, 'nbthread': 1, 'cpu_map': False}
+_LOGGER = logging.getLogger(__name__)
 
 def load_json(filepath):
     """Loads JSON config from file path as an OrderedDict
@@ -14,66 +31,279 @@ def load_json(filepath):
     with open(filepath, 'r') as json_file:
         return json.loads(json_file.read(), object_pairs_hook=OrderedDict)
 
+def _properties(server):
+    """Properties a server is written with. Servers that are not ready start
+    in maintenance, haproxy has no config keyword for drain"""
+    if server.get('state', 'ready') == 'ready':
+        return server['properties']
+    return (server['properties'] + ' disabled').strip()
+
+
+def _weighted(properties):
+    """Adds the balancer's base weight to the properties of a slot server that
+    sets none. haproxy defaults to 1, which would leave a server enabled at
+    runtime with a sliver of the traffic of balanced ones"""
+    if 'weight' in properties.split():
+        return properties
+    return (properties + ' weight {}'.format(balancer.BASE_WEIGHT)).strip()
+
+
+def shard_of(service, info, count):
+    """Returns the shard of count a service runs in. Services name their
+    shard or are hashed to one"""
+    if 'shard' in info:
+        return info['shard'] % count
+    digest = hashlib.md5(service.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def _runtime_change(old, new, keyword):
+    """Returns the new value of a keyword if it is the only option that
+    differs between two lists of options, otherwise None"""
+    changed = set(old) ^ set(new)
+    if any(option.split()[0] != keyword for option in changed):
+        return None
+    values = [option.split()[1] for option in new
+              if option.split()[0] == keyword]
+    return values[0] if len(values) == 1 else None
+
 
 class Configurator(object):
     """Parses user config file and writes to the haproxy config file"""
-    def __init__(self, socket, conf_file, haproxy_conf_file):
-        """Loads the schema and validates the user config against it"""
+    def __init__(self, socket, conf_file, haproxy_conf_file, shard=None):
+        """Loads the schema and validates the user config against it. With
+        a shard, a tuple of index and count, only the services of the shard
+        are parsed"""
+        self._shard = shard
         self._haproxy = {}
         self._haproxy['services'] = {}
         self._socket = socket
+        # Reasons for changes that can not be applied through the runtime API
+        self._reload = set()
+        # Fingerprints of the config last written and the one haproxy runs
+        self._written = None
+        self._running = None
+        # Slots of every listen block in the config last written
+        self._written_slots = {}
 
+        self._conf_file = conf_file
         self._config = load_json(conf_file)
 
         try:
             validate(self._config, load_json(SCHEMA))
         except ValidationError as err:
             print(err.message)
+        # Untouched copy of the config, parsing adds defaults and runtime
+        # state to the services. Reloads of the file are compared to it.
+        self._raw = copy.deepcopy(self._config)
 
         self._haproxy_file = haproxy_conf_file
 
     def parse_config(self):
         """Parses user config file"""
+        self._parse_sections()
+
+        services = {}
+
+        for service, info in self._config['services'].items():
+            if not self.in_shard(service, info):
+                continue
+            services[service] = info
+            self.add_service(service, info)
+
+        return services
+
+    def in_shard(self, service, info):
+        """Returns whether a service belongs to the shard of this
+        configurator. Every service does without shards"""
+        if self._shard is None:
+            return True
+        index, count = self._shard
+        return shard_of(service, info, count) == index
+
+    def _parse_sections(self):
+        """Parses the haproxy sections other than the services"""
         if 'haproxy' in self._config:
             # Haproxy conf must be OrderedDict because the order matters
             # for haproxy config
             self._haproxy['conf'] = OrderedDict()
             for header in self._config['haproxy']:
+                if not self._owns_section(self._config['haproxy'][header]):
+                    continue
                 self._haproxy['conf'][header] = self._config['haproxy'][header]
 
             # Config settings to enable Unix socket
             self._haproxy['conf'].setdefault('global', [])
-            socket = 'stats socket {}/admin.sock mode 600 level admin'
-            self._haproxy['conf']['global'].append(socket.format(self._socket))
+            self._haproxy['conf']['global'].extend(self._process_lines())
             self._haproxy['conf']['global'].append('stats timeout 2m')
 
-        services = {}
+    def _owns_section(self, lines):
+        """Returns whether a haproxy section goes into the config of this
+        shard. Only the first shard can bind the ports of sections like the
+        stats listener, every shard gets the others"""
+        if self._shard is None or self._shard[0] == 0:
+            return True
+        return not any(line.split()[:1] == ['bind'] for line in lines)
 
-        for service, info in self._config['services'].items():
-            services[service] = info
+    def add_service(self, service, info):
+        """Adds the listen blocks of a service and fills in the defaults of
+        its elasticity"""
+        self._config['services'][service] = info
+        if 'elasticity' in info:
+            # Need defaults to prevent errors in pool
+            info['elasticity'].setdefault('min_servers', 0)
+            info['elasticity'].setdefault('max_servers', None)
 
-            if 'elasticity' in info:
-                # Need defaults to prevent errors in pool
-                info['elasticity'].setdefault('min_servers', 0)
-                info['elasticity'].setdefault('max_servers', None)
-
-                if ('hold_conns' in info['elasticity'] and
-                        info['elasticity']['hold_conns']):
-                    self.add_proxy(service, info['haproxy']['listen'],
-                                   info['haproxy']['port'])
-                    # Shutoff time necessary for hold conns algorithm
-                    # Min servers must be 0 for hold conns algorithm to work
-                    info['elasticity']['shutoff_time'] = 0
-                    info['elasticity']['min_servers'] = 0
-                    continue
+            if ('hold_conns' in info['elasticity'] and
+                    info['elasticity']['hold_conns']):
+                self.add_proxy(service, info['haproxy']['listen'],
+                               info['haproxy']['port'],
+                               info['haproxy'].get('slots'),
+                               info['haproxy']['server'])
+                # Shutoff time necessary for hold conns algorithm
+                # Min servers must be 0 for hold conns algorithm to work
+                info['elasticity']['shutoff_time'] = 0
+                info['elasticity']['min_servers'] = 0
+                self._reload.add('services_changed')
+                return
 
-            self.add_listen_block(service, info['haproxy']['listen'],
-                                  info['haproxy']['port'])
+        self.add_listen_block(service, info['haproxy']['listen'],
+                              info['haproxy']['port'],
+                              info['haproxy'].get('slots'),
+                              info['haproxy']['server'])
+        # Only a reload picks up a new listen block
+        self._reload.add('services_changed')
 
-        return services
+    def remove_service(self, service):
+        """Removes the listen blocks of a service"""
+        self._config['services'].pop(service, None)
+        self._haproxy['services'].pop(service, None)
+        self._haproxy['services'].pop(service + '_proxy', None)
+        self._reload.add('services_changed')
+
+    def update_service(self, service, old, new):
+        """Applies a changed haproxy section of a service to its listen block.
+        Returns the runtime commands that make the change in the running
+        haproxy. Changes the runtime API can not make request a reload"""
+        config = self._haproxy['services'][service]
+        commands = []
+        if old['listen'] != new['listen']:
+            config['properties'] = (list(new['listen']) +
+                                    ['bind *:{}'.format(new['port'])])
+            maxconn = _runtime_change(old['listen'], new['listen'], 'maxconn')
+            if maxconn is None:
+                self._reload.add('listen_changed')
+            else:
+                commands.append('set maxconn frontend {} {}'.format(service,
+                                                                    maxconn))
+
+        if old['server'] != new['server']:
+            properties = ' '.join(new['server'])
+            for info in config['servers'].values():
+                info['properties'] = properties
+            config['slot_properties'] = list(new['server'])
+            weight = _runtime_change(old['server'], new['server'], 'weight')
+            if weight is None:
+                self._reload.add('server_changed')
+            else:
+                commands.extend(
+                    'set weight {}/{} {}'.format(service, server, weight)
+                    for server in self._server_names(service))
+
+        if old.get('slots') != new.get('slots'):
+            # Slots in use are kept
+            used = [int(slot[len('slot'):]) for slot in config['slot_map']]
+            config['slots'] = max([new['slots']] + used)
+            self._reload.add('slots_changed')
+        return commands
+
+    def _server_names(self, service):
+        """Names of every server of a listen block in the running haproxy,
+        empty slots included"""
+        config = self._haproxy['services'][service]
+        if config['slots'] is None:
+            return sorted(config['servers'])
+        slots = min(config['slots'], config['loaded'])
+        return ['slot{}'.format(idx) for idx in range(1, slots + 1)]
+
+    def reload_config(self):
+        """Reads the config file again. Returns the config before and after
+        the change as untouched copies, or None if the file is unchanged or
+        invalid. Sections other than the services are applied"""
+        try:
+            config = load_json(self._conf_file)
+            validate(config, load_json(SCHEMA))
+        except (OSError, ValueError) as err:
+            _LOGGER.error('Keeping the running config: %s', err)
+            return None
+        except ValidationError as err:
+            _LOGGER.error('Keeping the running config: %s', err.message)
+            return None
+        if config == self._raw:
+            return None
+
+        old = self._raw
+        self._raw = copy.deepcopy(config)
+        # Running services keep their own dicts, only the settings change
+        config['services'] = self._config['services']
+        self._config = config
+        if old.get('haproxy') != self._raw.get('haproxy'):
+            self._parse_sections()
+            self._reload.add('config_changed')
+        new = copy.deepcopy(self._raw)
+        # Services of other shards are not ours to change
+        for raw in (old, new):
+            raw['services'] = {service: info for service, info
+                               in raw.get('services', {}).items()
+                               if self.in_shard(service, info)}
+        return old, new
 
-    def add_listen_block(self, service, properties, port):
-        """Add a listen block to the config"""
+    def _process_lines(self):
+        """Global lines for the processes and threads of haproxy and their
+        admin sockets. Every process gets a socket of its own in the socket
+        directory so stats can be read and commands sent to all of them"""
+        settings = self.process_settings()
+        lines = []
+        if settings['nbproc'] > 1:
+            lines.append('nbproc {}'.format(settings['nbproc']))
+        if settings['nbthread'] > 1:
+            lines.append('nbthread {}'.format(settings['nbthread']))
+        if settings['cpu_map']:
+            # One cpu per thread of every process, in order
+            for proc in range(1, settings['nbproc'] + 1):
+                for thread in range(1, settings['nbthread'] + 1):
+                    target = str(proc)
+                    if settings['nbthread'] > 1:
+                        target += '/{}'.format(thread)
+                    cpu = (proc - 1) * settings['nbthread'] + thread - 1
+                    lines.append('cpu-map {} {}'.format(target, cpu))
+
+        socket = 'stats socket {} mode 600 level admin'
+        if self.master_settings() is not None:
+            # New workers take the listening sockets over from the old ones
+            socket += ' expose-fd listeners'
+        sockets = self.stats_sockets()
+        if len(sockets) == 1:
+            lines.append(socket.format(sockets[0]))
+            return lines
+        for proc, path in enumerate(sockets, 1):
+            lines.append(socket.format(path) + ' process {}'.format(proc))
+        return lines
+
+    def stats_sockets(self):
+        """Returns the path of the admin socket of every haproxy process.
+        Threads of a process share its socket"""
+        nbproc = self.process_settings()['nbproc']
+        if nbproc == 1:
+            return [os.path.join(self._socket, 'admin.sock')]
+        return [os.path.join(self._socket, 'admin{}.sock'.format(proc))
+                for proc in range(1, nbproc + 1)]
+
+    def add_listen_block(self, service, properties, port, slots=None,
+                         slot_properties=()):
+        """Add a listen block to the config. If slots is given, that many
+        servers are pre-allocated with slot_properties so instances can be
+        swapped in and out through the runtime API without a reload"""
         # Format for port on haproxy config
         bind = 'bind *:{}'
         self._haproxy['services'][service] = {}
@@ -84,8 +314,16 @@ class Configurator(object):
         (self._haproxy['services'][service]
          ['properties'].append(bind.format(port)))
         self._haproxy['services'][service]['servers'] = {}
+        self._haproxy['services'][service]['slots'] = slots
+        # Slots the running haproxy has, the runtime API can only use those
+        self._haproxy['services'][service]['loaded'] = 0
+        # Slot name to instance, only used for slotted listen blocks
+        self._haproxy['services'][service]['slot_map'] = {}
+        self._haproxy['services'][service]['slot_properties'] = list(
+            slot_properties)
 
-    def add_proxy(self, service, properties, port):
+    def add_proxy(self, service, properties, port, slots=None,
+                  slot_properties=()):
         """Adds two listen blocks to the config. First will point to the actual
         server. The second points to the first listen block."""
         proxy_properties = properties
@@ -100,24 +338,115 @@ class Configurator(object):
         # Point the proxy block to the service block
         self.add_server(service + '_proxy', service, '0.0.0.0:' + str(port + 1),
                         ['check'])
-        self.add_listen_block(service, properties, port + 1)
+        self.add_listen_block(service, properties, port + 1, slots,
+                              slot_properties)
 
     def remove_listen_block(self, service):
         """Remove a listen block"""
         del self._haproxy['services'][service]
 
-    def add_server(self, service, instance, address, properties):
-        """Adds a server to a service"""
+    def add_server(self, service, instance, address, properties,
+                   state='ready'):
+        """Adds a server to a service in an haproxy server state. Returns the
+        name of the slot the server was placed in if it can be enabled through
+        the runtime API, otherwise None and a reload is required"""
         self._haproxy['services'][service]['servers'][instance] = {}
         (self._haproxy['services'][service]['servers']
          [instance]['address']) = address
         properties = ' '.join(properties)
         (self._haproxy['services'][service]['servers']
          [instance]['properties']) = properties
+        (self._haproxy['services'][service]['servers']
+         [instance]['state']) = state
+
+        if self._haproxy['services'][service]['slots'] is None:
+            self._reload.add('no_slots')
+            return None
+
+        slot = self._free_slot(service)
+        if slot is None:
+            # Out of slots. Double the block so the next few instances fit
+            # and reload to pick up the new slots.
+            self._haproxy['services'][service]['slots'] *= 2
+            self._reload.add('slots_exhausted')
+            slot = self._free_slot(service)
+            self._assign_slot(service, instance, slot)
+            return None
+
+        self._assign_slot(service, instance, slot)
+        if not self._slot_loaded(service, slot):
+            # Added since the last reload, haproxy does not have it yet
+            self._reload.add('slots_exhausted')
+            return None
+        return slot
+
+    def _free_slot(self, service):
+        """Finds the first slot of a listen block that has no instance"""
+        slot_map = self._haproxy['services'][service]['slot_map']
+        for idx in range(1, self._haproxy['services'][service]['slots'] + 1):
+            slot = 'slot{}'.format(idx)
+            if slot not in slot_map:
+                return slot
+        return None
+
+    def _slot_loaded(self, service, slot):
+        """Returns whether the running haproxy has a slot"""
+        return (int(slot[len('slot'):]) <=
+                self._haproxy['services'][service]['loaded'])
+
+    def _assign_slot(self, service, instance, slot):
+        """Places an instance in a slot"""
+        self._haproxy['services'][service]['slot_map'][slot] = instance
+        self._haproxy['services'][service]['servers'][instance]['slot'] = slot
+
+    def server_snapshot(self, service):
+        """Returns the number of slots and the servers of a listen block with
+        their address, state and slot, to restore them after a restart"""
+        config = self._haproxy['services'][service]
+        return {
+            'slots': config['slots'],
+            'servers': {instance: {'address': info['address'],
+                                   'state': info['state'],
+                                   'slot': info.get('slot')}
+                        for instance, info in config['servers'].items()},
+        }
+
+    def restore_servers(self, service, snapshot, properties):
+        """Adds the servers saved by server_snapshot to a listen block. They
+        keep their slots where possible so a running haproxy that is taken
+        over keeps serving them from the same servers"""
+        config = self._haproxy['services'][service]
+        if config['slots'] is not None and snapshot['slots']:
+            config['slots'] = max(config['slots'], snapshot['slots'])
+        for instance, saved in sorted(snapshot['servers'].items()):
+            config['servers'][instance] = {
+                'address': saved['address'],
+                'properties': ' '.join(properties),
+                'state': saved['state'],
+            }
+            if config['slots'] is None:
+                continue
+            slot = saved['slot']
+            if slot is None or slot in config['slot_map']:
+                slot = self._free_slot(service)
+            if slot is None:
+                config['slots'] *= 2
+                slot = self._free_slot(service)
+            self._assign_slot(service, instance, slot)
 
     def delete_server(self, service, instance):
-        """Deletes a server from a service"""
-        del self._haproxy['services'][service]['servers'][instance]
+        """Deletes a server from a service. Returns the name of the slot that
+        was freed if it can be disabled through the runtime API, otherwise
+        None and a reload is required"""
+        server = self._haproxy['services'][service]['servers'].pop(instance)
+        if 'slot' not in server:
+            self._reload.add('no_slots')
+            return None
+        del self._haproxy['services'][service]['slot_map'][server['slot']]
+        if not self._slot_loaded(service, server['slot']):
+            # Never enabled, the pending reload leaves it out
+            return None
+        return server['slot']
 
     def server_exists(self, service, instance):
         """Checks if a server exists"""
@@ -127,26 +456,179 @@ class Configurator(object):
         """Returns a copy of a service's servers"""
         return self._haproxy['services'][service]['servers'].copy()
 
+    def server_state(self, service, instance):
+        """Returns the haproxy state of a server, ready, drain or maint"""
+        return self._haproxy['services'][service]['servers'][instance]['state']
+
+    def set_server_state(self, service, instance, state):
+        """Changes the state a server is written with. Returns the name of the
+        server in haproxy to change it at runtime, None if the running haproxy
+        does not have it yet"""
+        server = self._haproxy['services'][service]['servers'][instance]
+        server['state'] = state
+        if 'slot' not in server:
+            return instance
+        if not self._slot_loaded(service, server['slot']):
+            return None
+        return server['slot']
+
+    def get_instance(self, service, server_name):
+        """Returns the instance behind a server name in haproxy. None if the
+        server is an empty slot or unknown"""
+        if self._haproxy['services'][service]['slots'] is not None:
+            return self._haproxy['services'][service]['slot_map'].get(
+                server_name)
+        if server_name in self._haproxy['services'][service]['servers']:
+            return server_name
+        return None
+
+    def request_reload(self, reason):
+        """Marks that a full reload is required on the next commit"""
+        self._reload.add(reason)
+
+    def reload_required(self):
+        """Returns whether changes that could not be applied through the
+        runtime API are waiting to be loaded by haproxy. Changes that cancel
+        out, leaving the written config identical to the running one, do not
+        need a reload"""
+        if self._reload and self._written == self._running:
+            self._reload = set()
+        if not self._reload:
+            # The runtime API already brought haproxy in line
+            self._running = self._written
+        return bool(self._reload)
+
+    def reload_reasons(self):
+        """Returns why the pending reload is required"""
+        return sorted(self._reload)
+
+    def config_loaded(self):
+        """Marks the written config as the one haproxy is running. Slots
+        added since, or in a config haproxy rejected, are not loaded"""
+        self._running = self._written
+        self._reload = set()
+        for service, config in self._haproxy['services'].items():
+            config['loaded'] = self._written_slots.get(service, 0)
+
+    def api_settings(self):
+        """Returns the settings of the treadmill REST API backend. None if the
+        command line is used"""
+        return self._config.get('treadmill_api')
+
+    def discovery_settings(self):
+        """Returns the settings of discovery"""
+        return self._config.get('discovery', {})
+
+    def reload_settings(self):
+        """Returns the settings of the reload scheduler"""
+        settings = dict(RELOAD_DEFAULTS)
+        settings.update(self._config.get('reload', {}))
+        return settings
+
+    def process_settings(self):
+        """Returns the number of processes and threads of haproxy and whether
+        they are pinned to cpus"""
+        settings = dict(PROCESS_DEFAULTS)
+        settings.update(self._config.get('processes', {}))
+        return settings
+
+    def master_settings(self):
+        """Returns the settings of master-worker mode. None if haproxy runs
+        without a master"""
+        return self._config.get('master')
+
+    def trace_settings(self):
+        """Returns the settings of the trace recorder. None if nothing is
+        recorded"""
+        return self._config.get('trace')
+
+    def render(self):
+        """Renders the config stored in a dictionary into a single string"""
+        lines = []
+        # Render the haproxy configuration separately
+        if 'conf' in self._haproxy:
+            for header, props in self._haproxy['conf'].items():
+                lines.append(header)
+                for prop in props:
+                    lines.append('\t' + prop)
+
+        # Render the service configs
+        for service, config in self._haproxy['services'].items():
+            # Format for listen block name
+            lines.append('listen {}'.format(service))
+            for prop in config['properties']:
+                lines.append('\t' + prop)
+            server_base = '\tserver {} {} {}'
+            if config['slots'] is not None:
+                # Render every slot so that a restart ends up with the same
+                # servers as the runtime API set up. Empty slots are disabled
+                # until an instance is placed in them.
+                for idx in range(1, config['slots'] + 1):
+                    slot = 'slot{}'.format(idx)
+                    if slot in config['slot_map']:
+                        info = config['servers'][config['slot_map'][slot]]
+                        lines.append(server_base.format(
+                            slot, info['address'],
+                            _weighted(_properties(info))))
+                    else:
+                        lines.append(server_base.format(
+                            slot, EMPTY_SLOT,
+                            _weighted(' '.join(config['slot_properties'] +
+                                               ['disabled']))))
+                continue
+            # Render each server under the appropriate listen block
+            for server, info in config['servers'].items():
+                lines.append(server_base.format(server, info['address'],
+                                                _properties(info)))
+        return '\n'.join(lines) + '\n'
+
+    def _stage(self):
+        """Renders the config into a temporary file next to the haproxy config.
+        Returns the path and fingerprint, or None if the rendered config is
+        identical to the one already written"""
+        config = self.render()
+        fingerprint = hashlib.sha1(config.encode('utf-8')).hexdigest()
+        if fingerprint == self._written:
+            return None
+        # Same directory so the swap is an atomic rename
+        handle, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self._haproxy_file)),
+            prefix='.haproxy-', suffix='.conf')
+        with os.fdopen(handle, 'w') as haproxy_conf:
+            haproxy_conf.write(config)
+        return tmp_path, fingerprint
+
+    def _swap(self, tmp_path, fingerprint, valid):
+        """Moves a validated temporary config into place. Returns whether the
+        config file changed"""
+        if not valid:
+            _LOGGER.error('Generated config is invalid, keeping the old one')
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, self._haproxy_file)
+        self._written = fingerprint
+        self._written_slots = {
+            service: config['slots'] or 0
+            for service, config in self._haproxy['services'].items()}
+        return True
+
     def config_write(self):
-        """Actually write the config stored in a dictionary into the file"""
-        with open(self._haproxy_file, 'w+') as haproxy_conf:
-            # Write the haproxy configuration separately
-            if 'conf' in self._haproxy:
-                for header, props in self._haproxy['conf'].items():
-                    haproxy_conf.write(header + '\n')
-                    for prop in props:
-                        haproxy_conf.write('\t' + prop + '\n')
-
-            # Write the service configs
-            for service, config in self._haproxy['services'].items():
-                # Format for listen block name
-                listen_block = 'listen {}'.format(service)
-                haproxy_conf.write(listen_block + '\n')
-                for prop in config['properties']:
-                    haproxy_conf.write('\t' + prop + '\n')
-                # Write each server under the appropriate listen block
-                for server, info in config['servers'].items():
-                    server_base = '\tserver {} {} {}\n'
-                    haproxy_conf.write(server_base.format(server,
-                                                          info['address'],
-                                                          info['properties']))
+        """Writes the config to file if it changed. The config is validated by
+        haproxy and swapped into place atomically so haproxy never reads a
+        partial file. Returns whether the config file changed"""
+        staged = self._stage()
+        if staged is None:
+            return False
+        tmp_path, fingerprint = staged
+        return self._swap(tmp_path, fingerprint,
+                          haproxy_cmd.check_config(tmp_path))
+
+    def config_write_async(self):
+        """Same as config_write but validates inside the reactor. Returns a
+        Deferred that fires with whether the config file changed"""
+        staged = self._stage()
+        if staged is None:
+            return defer.succeed(False)
+        tmp_path, fingerprint = staged
+        return haproxy_cmd.check_config_async(tmp_path).addCallback(
+            lambda valid: self._swap(tmp_path, fingerprint, valid))
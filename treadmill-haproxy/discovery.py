@@ -0,0 +1,169 @@
+"""Batches Treadmill discovery for every watched app"""
+
+import logging
+import time
+
+from twisted.internet import abstract
+from twisted.internet import defer
+from twisted.internet import reactor
+
+import treadmill_api
+
+# Seconds a host lookup may take. Commits wait for the lookups.
+RESOLVE_TIMEOUT = 2
+# Seconds before a host that failed to resolve is tried again, doubled for
+# every failure in a row up to MAX_RETRY_DELAY
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+_LOGGER = logging.getLogger(__name__)
+
+
+def proid(app):
+    """Returns the proid an app runs under. Treadmill apps are named
+    proid.name"""
+    return app.split('.', 1)[0]
+
+
+class Discovery(object):
+    """Runs one discovery query per proid each loop and keeps the results
+    indexed by app, instance and endpoint for the watchers to read"""
+    def __init__(self):
+        self._apps = set()
+        self._index = {}
+        # IP address of every host in the index that resolved
+        self._resolved = {}
+        # Time and delay of the next try of every host that failed
+        self._failed = {}
+
+    def register(self, app):
+        """Adds an app to the set that is discovered every loop"""
+        self._apps.add(app)
+
+    def unregister(self, app):
+        """Stops discovering an app and drops its results"""
+        self._apps.discard(app)
+        self._index.pop(app, None)
+
+    def patterns(self, apps=None):
+        """Groups apps, every registered one by default, by proid. A proid
+        with a single app is queried by name, otherwise every app under the
+        proid is queried at once with a wildcard. Returns a dict of pattern to
+        the apps it covers"""
+        groups = {}
+        for app in self._apps if apps is None else apps:
+            groups.setdefault(proid(app), []).append(app)
+
+        patterns = {}
+        for owner, apps in groups.items():
+            if len(apps) == 1:
+                patterns[apps[0]] = apps
+            else:
+                patterns[owner + '.*'] = apps
+        return patterns
+
+    def refresh_async(self, apps=None):
+        """Refreshes the index for apps, every registered one by default,
+        running every query at the same time. Returns a Deferred that fires
+        once all queries have finished. Apps whose query failed keep their
+        previous results so their servers are not dropped"""
+        patterns = self.patterns(apps)
+        queries = []
+        for pattern in sorted(patterns):
+            _LOGGER.debug('Discovering %s', pattern)
+            queries.append(treadmill_api.discover_async(pattern))
+
+        def _merge(results):
+            """Updates the index with the results of every query"""
+            # Apps that were not queried keep their results
+            index = dict(self._index)
+            for pattern, (success, result) in zip(sorted(patterns), results):
+                if not success:
+                    _LOGGER.error('%s', result.getErrorMessage())
+                    continue
+                for app in patterns[pattern]:
+                    index[app] = result.get(app, {})
+            self._index = index
+
+        return defer.DeferredList(queries,
+                                  consumeErrors=True).addCallback(_merge)
+
+    def update(self, app, instance, endpoint, address):
+        """Applies a single endpoint change. An address of None removes the
+        endpoint"""
+        instances = self._index.setdefault(app, {})
+        if address is not None:
+            instances.setdefault(instance, {})[endpoint] = address
+            return
+        instances.get(instance, {}).pop(endpoint, None)
+        if instance in instances and not instances[instance]:
+            del instances[instance]
+
+    def snapshot(self):
+        """Returns the results of every app to restore them after a restart"""
+        return self._index
+
+    def restore(self, index):
+        """Restores results saved by snapshot. Apps whose first discovery
+        fails keep them instead of dropping their servers"""
+        self._index = index
+
+    def _hosts(self):
+        """Returns the hosts of every endpoint in the index"""
+        return set(address.rsplit(':', 1)[0]
+                   for instances in self._index.values()
+                   for endpoints in instances.values()
+                   for address in endpoints.values())
+
+    def resolve_async(self):
+        """Resolves the hosts in the index that are not resolved yet with the
+        reactor's resolver. Returns a Deferred that fires once all of them
+        finished. Hosts that fail are tried again after a delay that grows
+        while they keep failing, so an unresponsive resolver does not hold up
+        every commit"""
+        hosts = self._hosts()
+        # Hosts that left the index are forgotten
+        self._resolved = {host: ip for host, ip in self._resolved.items()
+                          if host in hosts}
+        self._failed = {host: retry for host, retry in self._failed.items()
+                        if host in hosts}
+        now = time.time()
+        queries = []
+        for host in sorted(hosts - set(self._resolved)):
+            if abstract.isIPAddress(host) or abstract.isIPv6Address(host):
+                self._resolved[host] = host
+                continue
+            if host in self._failed and self._failed[host][0] > now:
+                continue
+            queries.append(self._resolve(host))
+        return defer.gatherResults(queries)
+
+    def _resolve(self, host):
+        """Resolves a host into the cache. Failures are logged and delay the
+        next try"""
+        def _resolved(ip_addr):
+            self._resolved[host] = ip_addr
+            self._failed.pop(host, None)
+
+        def _failed(failure):
+            delay = RETRY_DELAY
+            if host in self._failed:
+                delay = min(self._failed[host][1] * 2, MAX_RETRY_DELAY)
+            self._failed[host] = (time.time() + delay, delay)
+            _LOGGER.error('Unable to resolve %s, retrying in %ds: %s', host,
+                          delay, failure.getErrorMessage())
+
+        query = reactor.resolve(host, timeout=(RESOLVE_TIMEOUT,))
+        return query.addCallbacks(_resolved, _failed)
+
+    def resolved(self, address):
+        """Returns a host:port address with the host replaced by its IP
+        address. None if the host did not resolve"""
+        host, port = address.rsplit(':', 1)
+        if host not in self._resolved:
+            return None
+        return '{}:{}'.format(self._resolved[host], port)
+
+    def endpoints(self, app):
+        """Returns the endpoints of every instance of an app as a dict keyed by
+        instance and then by name of endpoint"""
+        return self._index.get(app, {})
@@ -0,0 +1,125 @@
+"""Pushes treadmill discovery changes to the watchers as they happen"""
+
+import logging
+import os
+
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds before a discovery watch that exited is started again
+RESTART_DELAY = 5
+# Seconds between checks of a watched file
+POLL_TIME = 0.5
+
+
+def parse_event(line):
+    """Parses a line of discovery watch output into a tuple of app, instance,
+    endpoint and address. The address is None if the endpoint went away"""
+    parts = line.split()
+    name = parts[0]
+    address = parts[1] if len(parts) > 1 and parts[1] != '-' else None
+    app, _, endpoint = name.split(':')
+    app, instance = app.split('#')
+    return app, instance, endpoint, address
+
+
+class DiscoveryWatch(object):
+    """Applies discovery events to the shared Discovery index and wakes
+    whoever handles the app that changed"""
+    def __init__(self, discovery, on_change):
+        self._discovery = discovery
+        self._on_change = on_change
+        self._sources = []
+
+    def add_source(self, source):
+        """Adds a source of discovery lines"""
+        source.watch = self
+        self._sources.append(source)
+
+    def line_received(self, line):
+        """Handles a line of discovery watch output"""
+        line = line.strip()
+        if not line:
+            return
+        try:
+            app, instance, endpoint, address = parse_event(line)
+        except ValueError:
+            _LOGGER.error('Unable to parse discovery event: %s', line)
+            return
+        _LOGGER.debug('Discovery event: %s', line)
+        self._discovery.update(app, instance, endpoint, address)
+        self._on_change(app)
+
+    def start(self):
+        """Starts every source"""
+        for source in self._sources:
+            source.start()
+
+
+class _WatchProtocol(protocol.ProcessProtocol):
+    """Splits the output of a discovery watch process into lines"""
+    def __init__(self, source):
+        self._source = source
+        self._buffer = b''
+
+    def outReceived(self, data):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            self._source.watch.line_received(line.decode('utf-8'))
+
+    def processEnded(self, reason):
+        self._source.ended(reason)
+
+
+class ProcessSource(object):
+    """Runs treadmill admin discovery --watch for a pattern and restarts it
+    if it exits"""
+    def __init__(self, pattern):
+        self._pattern = pattern
+        self.watch = None
+
+    def start(self):
+        """Spawns the watch process"""
+        cmd = ['treadmill', 'admin', 'discovery', '--watch', self._pattern]
+        _LOGGER.info('Watching discovery of %s', self._pattern)
+        reactor.spawnProcess(_WatchProtocol(self), cmd[0], cmd,
+                             env=os.environ)
+
+    def ended(self, reason):
+        """Starts the watch again after RESTART_DELAY"""
+        _LOGGER.error('Discovery watch of %s ended: %s', self._pattern,
+                      reason.getErrorMessage())
+        reactor.callLater(RESTART_DELAY, self.start)
+
+
+class FileSource(object):
+    """Follows a file of discovery lines, like tail -f. Stands in for a
+    discovery watch when running without treadmill"""
+    def __init__(self, path, poll_time=POLL_TIME):
+        self._path = path
+        self._poll_time = poll_time
+        self._offset = 0
+        self._buffer = ''
+        self.watch = None
+
+    def start(self):
+        """Starts following the file"""
+        task.LoopingCall(self.poll).start(self._poll_time)
+
+    def poll(self):
+        """Reads lines appended since the last poll"""
+        try:
+            with open(self._path, 'r') as events:
+                events.seek(self._offset)
+                data = events.read()
+                self._offset = events.tell()
+        except IOError:
+            return
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split('\n')
+        for line in lines:
+            self.watch.line_received(line)
@@ -0,0 +1,228 @@
+"""Stand-in for an haproxy process and its admin socket.
+
+Loads the listen blocks and servers of the generated config, applies runtime
+commands and serves show stat from a synthetic load model. install() points
+haproxy_cmd at it so the conductor can run without haproxy.
+"""
+
+import os
+import socketserver
+import threading
+import time
+
+from twisted.internet import defer
+
+import haproxy_cmd
+
+# Connections per second one server handles and its response time in ms
+# when idle
+CAPACITY = 50
+BASE_RTIME = 20
+# Columns of show stat served, a subset of what haproxy reports
+STAT_FIELDS = ('pxname', 'svname', 'qcur', 'scur', 'smax', 'slim', 'stot',
+               'status', 'weight', 'rate', 'qtime', 'ctime', 'rtime', 'ttime')
+
+
+def parse_config(config_file):
+    """Reads listen blocks from an haproxy config. Returns a dict of listen
+    block to a dict of server name to its state"""
+    proxies = {}
+    proxy = None
+    with open(config_file, 'r') as haproxy_conf:
+        for line in haproxy_conf:
+            if not line.startswith('\t'):
+                parts = line.split()
+                proxy = None
+                if len(parts) == 2 and parts[0] == 'listen':
+                    proxy = proxies.setdefault(parts[1], {})
+                continue
+            parts = line.split()
+            if proxy is None or parts[0] != 'server':
+                continue
+            weight = 1
+            if 'weight' in parts:
+                weight = int(parts[parts.index('weight') + 1])
+            proxy[parts[1]] = {
+                'address': parts[2],
+                'state': 'maint' if 'disabled' in parts else 'ready',
+                'weight': weight,
+            }
+    return proxies
+
+
+class LoadModel(object):
+    """Offered connection rate of every listen block over time. Servers
+    share the load by weight and response time grows with utilisation"""
+    def __init__(self, traces, capacity=CAPACITY, base_rtime=BASE_RTIME):
+        # Listen block to a function of seconds since start to conn/s
+        self._traces = traces
+        self._capacity = capacity
+        self._base_rtime = base_rtime
+        self._start = time.time()
+
+    def demand(self, proxy):
+        """Connections per second offered to a listen block right now"""
+        if proxy not in self._traces:
+            return 0
+        return self._traces[proxy](time.time() - self._start)
+
+    def rows(self, proxy, servers):
+        """Builds show stat rows of a listen block. servers is a dict of
+        server name to its state and whether it is healthy"""
+        rate = self.demand(proxy)
+        up = {name: server for name, server in servers.items()
+              if server['healthy'] and server['state'] == 'ready'}
+        weight = sum(server['weight'] for server in up.values())
+        capacity = len(up) * self._capacity
+        utilisation = min(rate / capacity, 0.99) if capacity else 0.99
+        rtime = int(self._base_rtime / (1 - utilisation))
+        qtime = rtime - self._base_rtime
+        scur = int(rate * rtime / 1000.0)
+
+        rows = []
+        for name, server in sorted(servers.items()):
+            if server['state'] == 'maint':
+                status = 'MAINT'
+            elif not server['healthy']:
+                status = 'DOWN'
+            elif server['state'] == 'drain':
+                status = 'DRAIN'
+            else:
+                status = 'UP'
+            share = (server['weight'] / float(weight)
+                     if name in up and weight else 0)
+            rows.append({'pxname': proxy, 'svname': name, 'status': status,
+                         'weight': server['weight'],
+                         'rate': int(rate * share), 'scur': int(scur * share),
+                         'qcur': 0, 'qtime': qtime if share else 0,
+                         'rtime': rtime if share else 0})
+        rows.append({'pxname': proxy, 'svname': 'FRONTEND', 'status': 'OPEN',
+                     'rate': int(rate), 'scur': scur})
+        rows.append({'pxname': proxy, 'svname': 'BACKEND',
+                     'status': 'UP' if up else 'DOWN', 'weight': weight,
+                     'rate': int(rate), 'scur': scur, 'qtime': qtime,
+                     'rtime': rtime, 'qcur': int(rate * qtime / 1000.0)})
+        return rows
+
+
+class FakeHAProxy(object):
+    """Serves the admin socket of a fake haproxy in a thread. The socket has
+    to answer while the reactor thread is blocked in haproxyadmin"""
+    def __init__(self, socket_dir, config_file, model, alive):
+        self._socket_file = os.path.join(socket_dir, 'admin.sock')
+        self._config_file = config_file
+        self._model = model
+        # Function of a port telling whether a container listens on it
+        self._alive = alive
+        self._lock = threading.Lock()
+        self._proxies = {}
+        self._server = None
+        self.reloads = 0
+
+    def load(self):
+        """Loads the config file, dropping runtime changes like a reload"""
+        with self._lock:
+            self._proxies = parse_config(self._config_file)
+
+    def healthy(self, proxy):
+        """Number of servers of a listen block taking traffic"""
+        with self._lock:
+            return sum(1 for server in self._proxies.get(proxy, {}).values()
+                       if server['state'] == 'ready' and
+                       self._is_alive(server))
+
+    def _is_alive(self, server):
+        """Whether the container behind a server has started"""
+        port = int(server['address'].rsplit(':', 1)[1])
+        return bool(port) and self._alive(port)
+
+    def command(self, line):
+        """Answers a single admin socket command"""
+        parts = line.split()
+        with self._lock:
+            if parts[:2] == ['show', 'info']:
+                return ('Name: HAProxy\nVersion: fake\nNbproc: 1\n'
+                        'Process_num: 1\nPid: {}\n'.format(os.getpid()))
+            if parts[:2] == ['show', 'stat']:
+                return self._show_stat()
+            if parts[:2] == ['set', 'server'] and len(parts) >= 5:
+                return self._set_server(parts[2], parts[3:])
+            if parts[:1] == ['set'] and parts[1:2] == ['weight']:
+                return self._set_server(parts[2], ['weight', parts[3]])
+            if parts[:3] == ['set', 'maxconn', 'frontend']:
+                return '\n'
+        return 'Unknown command.\n'
+
+    def _show_stat(self):
+        """Renders show stat as CSV"""
+        lines = ['# ' + ','.join(STAT_FIELDS)]
+        for proxy, servers in sorted(self._proxies.items()):
+            states = {name: dict(server, healthy=self._is_alive(server))
+                      for name, server in servers.items()}
+            for row in self._model.rows(proxy, states):
+                lines.append(','.join(str(row.get(field, ''))
+                                      for field in STAT_FIELDS))
+        return '\n'.join(lines) + '\n\n'
+
+    def _set_server(self, target, args):
+        """Applies set server addr, state and weight"""
+        proxy, _, name = target.partition('/')
+        server = self._proxies.get(proxy, {}).get(name)
+        if server is None:
+            return 'No such server.\n'
+        if args[0] == 'addr':
+            port = server['address'].rsplit(':', 1)[1]
+            if len(args) > 3:
+                port = args[3]
+            server['address'] = '{}:{}'.format(args[1], port)
+            return 'IP changed\n'
+        if args[0] == 'state':
+            server['state'] = args[1]
+            return '\n'
+        if args[0] == 'weight':
+            server['weight'] = int(args[1])
+            return '\n'
+        return 'Unknown command.\n'
+
+    def serve(self):
+        """Starts serving the admin socket"""
+        fake = self
+
+        class _Handler(socketserver.StreamRequestHandler):
+            """Answers one command per connection like haproxy does"""
+            def handle(self):
+                line = self.rfile.readline().decode('utf-8').strip()
+                self.wfile.write(fake.command(line).encode('utf-8'))
+
+        if os.path.exists(self._socket_file):
+            os.remove(self._socket_file)
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self._socket_file, _Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        """Stops serving the admin socket"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _reload(self, *_):
+        """Reloads the config like a restart"""
+        self.reloads += 1
+        self.load()
+
+    def install(self):
+        """Points the process control of haproxy_cmd at this fake"""
+        haproxy_cmd.haproxy_proc = lambda: None
+        haproxy_cmd.old_generations = lambda: 0
+        haproxy_cmd.check_config = lambda config_file: True
+        haproxy_cmd.check_config_async = (
+            lambda config_file: defer.succeed(True))
+        haproxy_cmd.start_haproxy = lambda config_file: self.load()
+        haproxy_cmd.restart_haproxy = self._reload
+        haproxy_cmd.restart_haproxy_async = (
+            lambda config_file: defer.succeed(self._reload()))
+        haproxy_cmd.stop_haproxy = lambda: None
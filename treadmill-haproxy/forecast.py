@@ -0,0 +1,53 @@
+"""Short horizon forecasts of a metric"""
+
+
+class Holt(object):
+    """Holt's double exponential smoothing for irregularly spaced samples.
+    The trend is kept per second so the forecast does not depend on the
+    loop interval"""
+    def __init__(self, alpha=0.5, beta=0.3):
+        self._alpha = alpha
+        self._beta = beta
+        self._level = None
+        self._trend = 0.0
+        self._last = None
+
+    def update(self, value, now):
+        """Adds a sample taken at time now"""
+        if self._level is None:
+            self._level = float(value)
+            self._last = now
+            return
+        elapsed = now - self._last
+        if elapsed <= 0:
+            return
+        level = (self._alpha * value + (1 - self._alpha) *
+                 (self._level + self._trend * elapsed))
+        self._trend = (self._beta * (level - self._level) / elapsed +
+                       (1 - self._beta) * self._trend)
+        self._level = level
+        self._last = now
+
+    def forecast(self, horizon):
+        """Predicted value horizon seconds after the last sample"""
+        if self._level is None:
+            return 0
+        return self._level + self._trend * horizon
+
+
+def linear(samples, horizon):
+    """Fits a least squares line through samples of time and value and
+    predicts the value horizon seconds after the last sample"""
+    samples = list(samples)
+    if not samples:
+        return 0
+    if len(samples) == 1:
+        return samples[0][1]
+    count = float(len(samples))
+    mean_t = sum(t for t, _ in samples) / count
+    mean_v = sum(v for _, v in samples) / count
+    spread = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not spread:
+        return mean_v
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in samples) / spread
+    return mean_v + slope * (samples[-1][0] + horizon - mean_t)
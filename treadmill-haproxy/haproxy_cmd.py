@@ -2,58 +2,359 @@
 
 import logging
 import psutil
+import re
 import signal
+import socket
 import subprocess
+import time
 
+from haproxyadmin.exceptions import HAProxyBaseError
+from twisted.internet import defer
+from twisted.internet import endpoints
+from twisted.internet import protocol
+from twisted.internet import reactor
+
+import metrics
+import process
+
+HAPROXY = '/usr/sbin/haproxy'
 PIDFILE = '/run/haproxy/haproxy.pid'
+# Default master CLI socket in master-worker mode. It has to be outside the
+# stats socket directory, haproxyadmin takes every socket in there for a
+# stats socket.
+MASTER_SOCKET = '/run/haproxy-master.sock'
+# Seconds to wait for the master CLI
+MASTER_TIMEOUT = 5
+# Informational replies to runtime commands that are not errors
+RUNTIME_INFO = ('IP changed', 'no need to change')
 _LOGGER = logging.getLogger(__name__)
 
-def haproxy_proc():
-    """Reads the haproxy.pid file and creates a psutil Process"""
-    with open(PIDFILE, 'r') as pid_file:
+# Master CLI socket and the stats socket new workers take the listening
+# sockets over from. None unless master-worker mode is used.
+_MASTER = None
+_TRANSFER = None
+# Every set of pids read from PIDFILE, one per generation. The ones that
+# left it and still run are the old generations of this haproxy, other
+# haproxy instances on the host, like the ones of other shards, are never in
+# it.
+_GENERATIONS = []
+
+
+def use_master(master_socket, transfer_socket):
+    """Runs haproxy in master-worker mode. Reloads go through the master CLI
+    on master_socket and new workers take the listening sockets over from the
+    old ones through transfer_socket, so no connection is refused"""
+    global _MASTER, _TRANSFER
+    _MASTER = master_socket
+    _TRANSFER = transfer_socket
+
+def use_pidfile(pidfile):
+    """Keeps the pids of haproxy in pidfile instead of PIDFILE, for one
+    haproxy per shard"""
+    global PIDFILE
+    PIDFILE = pidfile
+
+def _master_command(cmd):
+    """Sends a command to the master CLI. Returns the reply"""
+    master = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    master.settimeout(MASTER_TIMEOUT)
+    try:
+        master.connect(_MASTER)
+        master.sendall((cmd + '\n').encode('utf-8'))
+        reply = []
+        # The master closes the connection after answering
+        while True:
+            data = master.recv(4096)
+            if not data:
+                break
+            reply.append(data)
+    finally:
+        master.close()
+    return b''.join(reply).decode('utf-8')
+
+
+class _MasterProtocol(protocol.Protocol):
+    """Sends one command to the master CLI and collects the reply"""
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._reply = []
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.write((self._cmd + '\n').encode('utf-8'))
+
+    def dataReceived(self, data):
+        self._reply.append(data)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.done.callback(b''.join(self._reply).decode('utf-8'))
+
+
+def _master_command_async(cmd):
+    """Same as _master_command inside the reactor. Returns a Deferred that
+    fires with the reply"""
+    proto = _MasterProtocol(cmd)
+    endpoint = endpoints.UNIXClientEndpoint(reactor, _MASTER,
+                                            timeout=MASTER_TIMEOUT)
+    return endpoints.connectProtocol(endpoint, proto).addCallback(
+        lambda _: proto.done)
+
+def _old_workers(reply):
+    """Counts the generations of old workers in the reply to show proc. The
+    workers of a generation, one per process with nbproc, went through the
+    same number of reloads"""
+    generations = set()
+    reloads = None
+    old = False
+    for line in reply.splitlines():
+        if line.startswith('#<'):
+            # Header like #<PID> <type> <relative PID> <reloads> <uptime>
+            columns = re.findall(r'<([^>]+)>', line)
+            if 'reloads' in columns:
+                reloads = columns.index('reloads')
+        elif line.startswith('#'):
+            old = line.strip() == '# old workers'
+        elif old and line.strip():
+            # Old workers have a relative pid like [was: 1]
+            fields = re.sub(r'\[was: *', '[was:', line).split()
+            generations.add(fields[0] if reloads is None else fields[reloads])
+    return len(generations)
+
+def haproxy_procs():
+    """Reads the haproxy.pid file and creates a psutil Process for every
+    running haproxy process. With nbproc the file holds one pid per line"""
+    procs = []
+    try:
+        with open(PIDFILE, 'r') as pid_file:
+            pids = [int(pid) for pid in pid_file.read().split()]
+    except FileNotFoundError:
+        return procs
+    if pids and set(pids) not in _GENERATIONS:
+        _GENERATIONS.append(set(pids))
+    for pid in pids:
         try:
-            proc = psutil.Process(int(pid_file.read().strip()))
-        except (psutil.NoSuchProcess, FileNotFoundError):
-            return None
+            proc = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            continue
         if proc.is_running():
-            return proc
-        return None
+            procs.append(proc)
+    return procs
 
-def start_haproxy():
-    "Starts HAProxy"
+def haproxy_proc():
+    """Returns a psutil Process of the first running haproxy process. None if
+    haproxy is not running"""
+    procs = haproxy_procs()
+    return procs[0] if procs else None
+
+@metrics.timed
+def old_generations():
+    """Counts generations of haproxy processes of this PIDFILE that are still
+    finishing connections from before a reload. With nbproc a generation has
+    several processes"""
+    if _MASTER:
+        # The master keeps track of the workers of every generation
+        try:
+            return _old_workers(_master_command('show proc'))
+        except OSError as err:
+            _LOGGER.error('Master CLI failed: %s', err)
+            return 0
+    current = set(proc.pid for proc in haproxy_procs())
+    count = 0
+    for pids in list(_GENERATIONS):
+        if pids & current:
+            continue
+        if any(_running(pid) for pid in pids - current):
+            count += 1
+        else:
+            _GENERATIONS.remove(pids)
+    return count
+
+def _running(pid):
+    """Returns whether a haproxy process runs under pid"""
+    try:
+        # The name guards against a reused pid
+        return psutil.Process(pid).name() == 'haproxy'
+    except psutil.NoSuchProcess:
+        return False
+
+def _haproxy_cmd(config_file, old_pids=()):
+    """Command line that starts HAProxy. Takes over from old_pids if given"""
     # Base command
-    cmd = ['/usr/sbin/haproxy']
+    cmd = [HAPROXY]
     # Config file
-    cmd += ['-f', '/home/vagrant/treadmill-haproxy/config/haproxy.conf']
+    cmd += ['-f', config_file]
     # Store pid
     cmd += ['-p', PIDFILE]
     # daemon
     cmd += ['-D']
-    subprocess.call(cmd)
+    if _MASTER:
+        # Master-worker with its CLI. The master runs this command line again
+        # on every reload, the new workers take the listening sockets over
+        # from the old ones.
+        cmd += ['-W', '-S', _MASTER, '-x', _TRANSFER]
+    # Restart
+    if old_pids:
+        cmd += ['-sf'] + [str(pid) for pid in old_pids]
+    return cmd
+
+def _check_cmd(config_file):
+    """Command line that validates a config file"""
+    return [HAPROXY, '-c', '-q', '-f', config_file]
+
+@metrics.timed
+def check_config(config_file):
+    """Returns whether haproxy accepts a config file"""
+    return subprocess.call(_check_cmd(config_file)) == 0
+
+@metrics.timed
+def check_config_async(config_file):
+    """Validates a config file inside the reactor. Returns a Deferred that
+    fires with whether haproxy accepts it"""
+    return process.call(_check_cmd(config_file), control=True).addCallback(
+        lambda code: code == 0)
+
+@metrics.timed
+def start_haproxy(config_file):
+    "Starts HAProxy"
+    subprocess.call(_haproxy_cmd(config_file))
 
+@metrics.timed
 def stop_haproxy():
     """Stops HAProxy if process actually exists"""
-    proc = haproxy_proc()
-    if proc:
-        proc.send_signal(signal.SIGUSR1)
-    else:
+    procs = haproxy_procs()
+    if not procs:
         _LOGGER.error('HAProxy is not running')
-
-def restart_haproxy():
-    """Restarts HAProxy if process actually exists"""
-    proc = haproxy_proc()
-    if proc:
+    for proc in procs:
         proc.send_signal(signal.SIGUSR1)
-    else:
+
+def _takeover(config_file):
+    """Returns the command that starts new HAProxy processes. Through -sf
+    they tell the running ones to finish their connections once they are
+    bound, so the ports are never left without a listener"""
+    procs = haproxy_procs()
+    if not procs:
         _LOGGER.error('HAProxy is not running')
-    # Base command
-    cmd = ['/usr/sbin/haproxy']
-    # Config file
-    cmd += ['-f', '/home/vagrant/treadmill-haproxy/config/haproxy.conf']
-    # Store pid
-    cmd += ['-p', PIDFILE]
-    # daemon
-    cmd += ['-D']
-    # Restart
-    cmd += ['-sf', str(proc.pid)]
-    subprocess.call(cmd)
+    return _haproxy_cmd(config_file, [proc.pid for proc in procs])
+
+@metrics.timed
+def restart_haproxy(config_file):
+    """Restarts HAProxy if process actually exists. In master-worker mode the
+    running master reloads instead"""
+    if _MASTER and haproxy_proc():
+        try:
+            _master_command('reload')
+            return
+        except OSError as err:
+            _LOGGER.error('Master CLI failed, restarting: %s', err)
+    subprocess.call(_takeover(config_file))
+
+@metrics.timed
+def restart_haproxy_async(config_file):
+    """Restarts HAProxy inside the reactor. In master-worker mode the running
+    master reloads instead. Returns a Deferred that fires once the restart was
+    issued"""
+    if not (_MASTER and haproxy_proc()):
+        return process.call(_takeover(config_file), control=True)
+
+    def _failed(failure):
+        """Restarts if the master can not be reached"""
+        _LOGGER.error('Master CLI failed, restarting: %s',
+                      failure.getErrorMessage())
+        return process.call(_takeover(config_file), control=True)
+
+    return _master_command_async('reload').addErrback(_failed)
+
+@metrics.timed
+def runtime_command(haproxy, cmd):
+    """Sends a command to every process behind the admin socket. Returns
+    False if the socket could not be reached or haproxy rejected the command"""
+    _LOGGER.debug('Runtime command: %s', cmd)
+    try:
+        results = haproxy.command(cmd)
+    except (HAProxyBaseError, OSError) as err:
+        _LOGGER.error('Runtime command failed: %s', err)
+        return False
+    for _, output in results:
+        for line in output:
+            # Successful state changes are silent and address changes report
+            # what they changed. Anything else is an error message.
+            if line and not line.startswith(RUNTIME_INFO):
+                _LOGGER.error('Runtime command rejected: %s', line)
+                return False
+    return True
+
+@metrics.timed
+def enable_server(haproxy, backend, server, address, state='ready'):
+    """Points a pre-allocated server at an ip:port address and takes it out
+    of maintenance into state, ready or drain. The runtime API only accepts
+    IP addresses"""
+    ip_addr, port = address.rsplit(':', 1)
+    cmd = 'set server {}/{} addr {} port {}'.format(backend, server, ip_addr,
+                                                   port)
+    if not runtime_command(haproxy, cmd):
+        return False
+    return set_server_state(haproxy, backend, server, state)
+
+@metrics.timed
+def disable_server(haproxy, backend, server):
+    """Puts a pre-allocated server into maintenance"""
+    return set_server_state(haproxy, backend, server, 'maint')
+
+@metrics.timed
+def set_server_state(haproxy, backend, server, state):
+    """Sets a server to ready, drain or maint. Drained servers are health
+    checked but get no new connections"""
+    return runtime_command(haproxy,
+                           'set server {}/{} state {}'.format(backend, server,
+                                                              state))
+
+
+class ReloadScheduler(object):
+    """Coalesces reload requests. A reload happens at most once every
+    min_interval seconds and is held back while max_generations old haproxy
+    processes are still alive, but a pending change never waits longer than
+    max_delay seconds"""
+    def __init__(self, min_interval, max_delay, max_generations):
+        self._min_interval = min_interval
+        self._max_delay = max_delay
+        self._max_generations = max_generations
+
+        self._last_reload = 0
+        # Time of the oldest change waiting for a reload
+        self._pending_since = None
+
+    def request(self):
+        """Marks that a reload is needed"""
+        if self._pending_since is None:
+            self._pending_since = time.time()
+
+    def cancel(self):
+        """Drops a pending reload that is no longer needed"""
+        self._pending_since = None
+
+    def pending(self):
+        """Returns whether a reload is waiting"""
+        return self._pending_since is not None
+
+    def due(self):
+        """Returns whether the pending reload should happen now"""
+        if self._pending_since is None:
+            return False
+        now = time.time()
+        if now - self._pending_since >= self._max_delay:
+            _LOGGER.info('Reload waited %ds, forcing',
+                         now - self._pending_since)
+            return True
+        if now - self._last_reload < self._min_interval:
+            return False
+        generations = old_generations()
+        if generations >= self._max_generations:
+            _LOGGER.info('Holding reload, %d old haproxy processes alive',
+                         generations)
+            return False
+        return True
+
+    def reloaded(self):
+        """Records that a reload happened"""
+        self._last_reload = time.time()
+        self._pending_since = None
@@ -0,0 +1,126 @@
+"""Time windowed metric history with constant time aggregations"""
+
+from array import array
+import bisect
+import collections
+import math
+
+# Samples kept per history. Fixes the memory used by every service.
+CAPACITY = 128
+# Upper bounds of the buckets used for approximate percentiles. Each bucket
+# is 25% wider than the last, so a percentile is off by at most 25%.
+BUCKETS = [0.0] + [1.25 ** idx for idx in range(80)]
+
+
+class MetricHistory(object):
+    """Ring buffer of timestamped samples covering the last window seconds.
+
+    Keeps a monotonic deque for the sliding max, a time decayed EWMA and a
+    bucketed histogram for percentiles, so every aggregation costs the same
+    no matter how many samples are held. At most capacity samples are kept,
+    if samples arrive faster than capacity per window the oldest go first.
+    """
+    def __init__(self, window, capacity=CAPACITY, half_life=None):
+        self._window = window
+        self._capacity = capacity
+        # Seconds for the weight of a sample in the EWMA to halve
+        self._half_life = half_life or window / 4.0
+
+        self._values = array('d', [0.0] * capacity)
+        self._times = array('d', [0.0] * capacity)
+        # Sequence number of the next sample and number of samples held.
+        # Sample seq is stored at seq % capacity.
+        self._seq = 0
+        self._count = 0
+        # Sequence numbers of samples in decreasing order of value. The front
+        # is the max of the window.
+        self._max = collections.deque()
+        self._buckets = array('l', [0] * (len(BUCKETS) + 1))
+        self._ewma = None
+        self._last = None
+
+    def __len__(self):
+        return self._count
+
+    def _oldest(self):
+        """Sequence number of the oldest sample held"""
+        return self._seq - self._count
+
+    def _evict(self):
+        """Drops the oldest sample"""
+        seq = self._oldest()
+        pos = seq % self._capacity
+        self._buckets[bisect.bisect_left(BUCKETS, self._values[pos])] -= 1
+        if self._max and self._max[0] == seq:
+            self._max.popleft()
+        self._count -= 1
+
+    def expire(self, now):
+        """Drops samples older than the window"""
+        while (self._count and
+               self._times[self._oldest() % self._capacity] <
+               now - self._window):
+            self._evict()
+
+    def push(self, value, now):
+        """Adds a sample taken at time now"""
+        self.expire(now)
+        if self._count == self._capacity:
+            self._evict()
+
+        pos = self._seq % self._capacity
+        self._values[pos] = value
+        self._times[pos] = now
+        self._buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        # Samples smaller than the new one can never be the max again
+        while (self._max and
+               self._values[self._max[-1] % self._capacity] <= value):
+            self._max.pop()
+        self._max.append(self._seq)
+        self._seq += 1
+        self._count += 1
+
+        if self._ewma is None:
+            self._ewma = float(value)
+        else:
+            decay = 0.5 ** (max(now - self._last[0], 0) / self._half_life)
+            self._ewma = decay * self._ewma + (1 - decay) * value
+        self._last = (now, value)
+
+    def max(self):
+        """Largest sample in the window. 0 if there are none"""
+        if not self._max:
+            return 0
+        return self._values[self._max[0] % self._capacity]
+
+    def ewma(self):
+        """Time decayed moving average of every sample seen. 0 if there are
+        none"""
+        return self._ewma or 0
+
+    def last(self):
+        """Most recent sample as a tuple of time and value. None if there are
+        none"""
+        return self._last
+
+    def percentile(self, percent):
+        """Approximate percentile of the window. Returns the upper bound of
+        the bucket holding it, capped by the max. 0 if there are no samples"""
+        if not self._count:
+            return 0
+        rank = max(int(math.ceil(percent / 100.0 * self._count)), 1)
+        seen = 0
+        for idx, count in enumerate(self._buckets):
+            seen += count
+            if seen >= rank:
+                if idx < len(BUCKETS):
+                    return min(BUCKETS[idx], self.max())
+                break
+        return self.max()
+
+    def samples(self):
+        """Yields every sample in the window, oldest first, as tuples of time
+        and value"""
+        for seq in range(self._oldest(), self._seq):
+            pos = seq % self._capacity
+            yield self._times[pos], self._values[pos]
@@ -0,0 +1,140 @@
+"""Container requests that have not taken effect yet"""
+
+import logging
+
+# Default seconds a scheduled container has to become healthy before it is
+# given up on
+LAUNCH_TIMEOUT = 600
+# Seconds a deleted container has to leave discovery before the delete is
+# sent again
+DELETE_TIMEOUT = 120
+# Deletes sent again before a container is given up on
+DELETE_RETRIES = 3
+_LOGGER = logging.getLogger(__name__)
+
+
+class InFlight(object):
+    """Registry of schedule and delete requests by instance id. A schedule is
+    resolved once its instance is serving in haproxy and a delete once its
+    instance left discovery. Requests past their deadline are retried or
+    given up on, so the pending count never drifts"""
+    def __init__(self):
+        # Schedules in submit order. The instance is None until the backend
+        # reported it, or for good if the backend does not report ids.
+        self._schedules = []
+        # Deletes by instance
+        self._deletes = {}
+        # Instances serving at the last resolve
+        self._serving = set()
+
+    def schedule(self, count, now, timeout=LAUNCH_TIMEOUT):
+        """Records a request for count containers. Returns its entries to be
+        passed to scheduled or failed"""
+        entries = [{'instance': None, 'submitted': now,
+                    'deadline': now + timeout} for _ in range(count)]
+        self._schedules.extend(entries)
+        return entries
+
+    def scheduled(self, entries, instances):
+        """Assigns the instance ids the backend returned to the entries of a
+        request. Entries beyond the returned ids were not scheduled, unless
+        the backend returned no ids at all"""
+        if not instances:
+            return
+        for entry, instance in zip(entries, instances):
+            entry['instance'] = instance
+        self.failed(entries[len(instances):])
+
+    def failed(self, entries):
+        """Drops entries of a schedule request that failed"""
+        for entry in entries:
+            if entry in self._schedules:
+                self._schedules.remove(entry)
+
+    def delete(self, instances, now):
+        """Records a delete request. Retried deletes keep their attempts"""
+        for instance in instances:
+            entry = self._deletes.setdefault(instance, {'attempts': 0})
+            entry['attempts'] += 1
+            entry['submitted'] = now
+            entry['deadline'] = now + DELETE_TIMEOUT
+
+    def delete_failed(self, instances):
+        """Makes a failed delete request due for a retry"""
+        for instance in instances:
+            if instance in self._deletes:
+                self._deletes[instance]['deadline'] = 0
+
+    def deleting(self, instance):
+        """Returns whether a delete of an instance is in flight"""
+        return instance in self._deletes
+
+    def resolve(self, serving, exists, now):
+        """Resolves schedules whose instance is serving and deletes whose
+        instance no longer exists. Newly serving instances the backend did
+        not report resolve the oldest schedule without an id. Returns the
+        seconds every resolved schedule took"""
+        latencies = []
+        named = set(entry['instance'] for entry in self._schedules)
+        for entry in list(self._schedules):
+            if entry['instance'] in serving:
+                self._schedules.remove(entry)
+                latencies.append(now - entry['submitted'])
+        unknown = sorted(serving - self._serving - named)
+        for entry in [entry for entry in self._schedules
+                      if entry['instance'] is None][:len(unknown)]:
+            self._schedules.remove(entry)
+            latencies.append(now - entry['submitted'])
+        self._serving = set(serving)
+
+        for instance in list(self._deletes):
+            if not exists(instance):
+                del self._deletes[instance]
+        return latencies
+
+    def expire(self, now):
+        """Gives up on schedules and deletes past their deadline. Returns the
+        instances of expired schedules, which are to be deleted, and the
+        deletes to send again"""
+        abandoned = []
+        for entry in list(self._schedules):
+            if entry['deadline'] <= now:
+                _LOGGER.warning('Instance %s not healthy after %ds, giving up',
+                                entry['instance'], now - entry['submitted'])
+                self._schedules.remove(entry)
+                if entry['instance'] is not None:
+                    abandoned.append(entry['instance'])
+
+        retries = []
+        for instance, entry in list(self._deletes.items()):
+            if entry['deadline'] > now:
+                continue
+            if entry['attempts'] > DELETE_RETRIES:
+                _LOGGER.error('Instance %s not deleted after %d attempts, '
+                              'giving up', instance, entry['attempts'])
+                del self._deletes[instance]
+            else:
+                retries.append(instance)
+        return abandoned, retries
+
+    def pending(self):
+        """Number of scheduled containers that are not serving yet"""
+        return len(self._schedules)
+
+    def deletes(self):
+        """Number of deleted containers still in discovery"""
+        return len(self._deletes)
+
+    def snapshot(self):
+        """Returns the requests in flight to restore them after a restart"""
+        return {
+            'schedules': self._schedules,
+            'deletes': self._deletes,
+            'serving': sorted(self._serving),
+        }
+
+    def restore(self, saved):
+        """Restores requests saved by snapshot"""
+        self._schedules = saved['schedules']
+        self._deletes = saved['deletes']
+        self._serving = set(saved['serving'])
@@ -0,0 +1,163 @@
+"""Counters, gauges and histograms of the control loop, served in the
+Prometheus text format"""
+
+import functools
+import time
+
+from twisted.internet import defer
+from twisted.web import resource
+
+# Upper bounds in seconds of the buckets of every histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(labels):
+    """Formats a dict of labels"""
+    if not labels:
+        return ''
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                              .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in sorted(labels.items())]
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter(object):
+    """Value that only goes up"""
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """Adds to the counter of a set of labels"""
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """Yields tuples of name, labels and value"""
+        for key, value in sorted(self._values.items()):
+            yield self.name, dict(key), value
+
+
+class Histogram(object):
+    """Distribution of observed values over BUCKETS"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self._buckets = buckets
+        # Labels to bucket counts, sum and count
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """Records a value for a set of labels"""
+        key = tuple(sorted(labels.items()))
+        if key not in self._values:
+            self._values[key] = [[0] * len(self._buckets), 0.0, 0]
+        counts, _, _ = entry = self._values[key]
+        for idx, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[idx] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        """Yields tuples of name, labels and value"""
+        for key, (counts, total, count) in sorted(self._values.items()):
+            labels = dict(key)
+            for bound, bucket in zip(self._buckets, counts):
+                yield (self.name + '_bucket', dict(labels, le=bound), bucket)
+            yield self.name + '_bucket', dict(labels, le='+Inf'), count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Gauge(object):
+    """Values read from a callback when the metrics are rendered. The
+    callback returns a list of tuples of labels and value"""
+    kind = 'gauge'
+
+    def __init__(self, name, description, callback):
+        self.name = name
+        self.description = description
+        self._callback = callback
+
+    def samples(self):
+        """Yields tuples of name, labels and value"""
+        for labels, value in self._callback():
+            if value is not None:
+                yield self.name, labels, value
+
+
+class Registry(object):
+    """Holds every metric and renders them"""
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Adds a metric. Returns it for convenience"""
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Renders every metric in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name,
+                                               metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CALLS = REGISTRY.register(Histogram(
+    'treadmill_haproxy_call_seconds',
+    'Latency of treadmill_api and haproxy_cmd operations'))
+LOOPS = REGISTRY.register(Histogram(
+    'treadmill_haproxy_loop_seconds', 'Duration of a conductor loop'))
+RELOADS = REGISTRY.register(Counter(
+    'treadmill_haproxy_reloads_total', 'HAProxy reloads by reason'))
+
+
+def timed(func):
+    """Records the latency of every call of a function in CALLS. Functions
+    returning a Deferred are timed until it fires"""
+    operation = '{}.{}'.format(func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def _timed(*args, **kwargs):
+        """Calls the function and records how long it took"""
+        start = time.time()
+
+        def _observe(result):
+            """Records the latency"""
+            CALLS.observe(time.time() - start, operation=operation)
+            return result
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            _observe(None)
+            raise
+        if isinstance(result, defer.Deferred):
+            return result.addBoth(_observe)
+        return _observe(result)
+    return _timed
+
+
+class MetricsResource(resource.Resource):
+    """Serves the registry over HTTP"""
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return self._registry.render().encode('utf-8')
@@ -1,32 +1,58 @@
 """Treadmill orchestrator for HAProxy"""
 
 import collections
+import functools
 import logging
+import math
 import time
 
+import forecast
+import haproxy_cmd
+import history
+import inflight
+import process
+import recorder
 import treadmill_api
 
-HISTORY_QUEUE = 10
+# Default seconds of measurements considered by the policies
+HISTORY_WINDOW = 70
+# Seconds a container is assumed to take to become healthy before any launch
+# was observed
+LAUNCH_LATENCY = 60
+# Weight of a newly observed launch in the launch latency average
+LATENCY_WEIGHT = 0.3
+# Default bounds of the standby pool and seconds of scale-ups it is sized from
+STANDBY_MIN = 1
+STANDBY_MAX = 4
+STANDBY_WINDOW = 600
+# Global maxconn restored on a frontend that no longer holds connections
+MAXCONN = 2000
+# Default seconds a server is drained of sessions before it is deleted
+DRAIN_TIMEOUT = 60
+# Column of show stat each single metric method reads
+METHOD_METRICS = {'conn_rate': 'rate', 'queue': 'qtime', 'response': 'rtime'}
+# Keys of the elasticity config. Every other key is state of the orchestrator.
+SETTINGS = ('method', 'steps', 'scale', 'breakpoint', 'predict', 'window',
+            'hold_conns', 'cooldown', 'min_servers', 'max_servers', 'standby',
+            'drain_timeout', 'launch_timeout', 'metrics')
 _LOGGER = logging.getLogger(__name__)
 
 
-def find_max(num, history):
-    """Finds the max number in a list after appending the current number"""
-    # Only keep a specified amount of history
-    if len(history) > HISTORY_QUEUE:
-        history.popleft()
-    history.append(num)
-    return max(history)
-
-
 class Orchestrator(object):
     """Orchestrates treadmill containers"""
-    def __init__(self, service_name, service, haproxy):
-        """Setup necessary globals and registers cleanup for exit"""
+    def __init__(self, service_name, service, haproxy, haproxy_parser, stats,
+                 policy=None):
+        """Setup necessary globals and registers cleanup for exit. The
+        composite method reads its target from the shared policy"""
         self._service_name = service_name
-        self._haproxy = haproxy.backend(service_name)
-        service['elasticity']['history'] = collections.deque([])
-        service['elasticity']['conn_history'] = collections.deque([])
+        # Admin socket, only used for runtime commands. Metrics are read from
+        # the stats snapshot shared by all orchestrators.
+        self._haproxy = haproxy
+        self._haproxy_parser = haproxy_parser
+        self._stats = stats
+        self._policy = policy
+        service['elasticity']['history'] = history.MetricHistory(
+            service['elasticity'].get('window', HISTORY_WINDOW))
 
         self._elasticity = service['elasticity']
         self._treadmill = service['treadmill']
@@ -34,49 +60,252 @@ class Orchestrator(object):
         self._elasticity['target'] = self._elasticity['min_servers']
         self._elasticity['pending'] = 0
         self._elasticity['healthy'] = None
-
-        # If hold_conns is specified, the frontend is needed so connections
-        # can be restricted and the backend of the proxy is needed to know
-        # number of incoming connections before the reach the real backend.
-        # After connections are opened, the real backend stats would be
-        # equivalent to the proxy backend.
-        if 'hold_conns' in self._elasticity and self._elasticity['hold_conns']:
-            self._haproxy_front = haproxy.frontend(service_name)
-            self._haproxy_proxy = haproxy.backend(service_name + '_proxy')
-
-    def add_server(self):
-        """Starts a treadmill container"""
-        _LOGGER.info('Add pending server')
-        treadmill_api.start_container(self._treadmill['appname'],
-                                      self._treadmill['manifest'])
-
-    def delete_server(self, instance):
-        """Deletes a treadmill container"""
-        _LOGGER.info('Delete server')
-        treadmill_api.stop_container(self._treadmill['appname'], instance)
+        # Started containers kept drained until a scale-up needs them
+        self._elasticity['standby_servers'] = []
+        # Servers drained before deletion to the time they are deleted
+        # regardless of their sessions. None once the delete was requested.
+        self._elasticity['draining'] = {}
+        # Times of target increases, used to size the standby pool
+        self._scale_ups = collections.deque()
+        self._last_target = self._elasticity['target']
+        # Containers added by the last loop, negative for drained ones
+        self._decision = 0
+
+        # Schedule and delete requests that have not taken effect. Pending is
+        # the number of scheduled containers in there.
+        self._inflight = inflight.InFlight()
+        self._holt = None
+        self._setup()
+        self._default_latency()
+
+    def _setup(self):
+        """Prepares forecasts if they are configured"""
+        if 'predict' in self._elasticity:
+            predict = self._elasticity['predict']
+            self._holt = forecast.Holt(predict.get('alpha', 0.5),
+                                       predict.get('beta', 0.3))
+        if self._elasticity.get('method') == 'composite':
+            self._policy.register(self._service_name, self._elasticity)
+
+    def _default_latency(self):
+        """Sets the launch latency forecasts and the standby pool rely on
+        until launches were measured"""
+        if 'predict' in self._elasticity:
+            self._elasticity.setdefault(
+                'launch_latency',
+                self._elasticity['predict'].get('latency', LAUNCH_LATENCY))
+        if 'standby' in self._elasticity:
+            # The pool has to cover scale-ups until a refill becomes healthy
+            self._elasticity.setdefault('launch_latency', LAUNCH_LATENCY)
+
+    def configure(self, elasticity):
+        """Applies changed elasticity settings in place. Servers, pending
+        containers and the history are kept"""
+        previous = dict(self._elasticity)
+        for key in SETTINGS:
+            if key == 'min_servers' and self._elasticity.get('hold_conns'):
+                # Driven by held connections
+                continue
+            if key in elasticity:
+                self._elasticity[key] = elasticity[key]
+            else:
+                self._elasticity.pop(key, None)
+        self._elasticity.setdefault('min_servers', 0)
+        self._elasticity.setdefault('max_servers', None)
+
+        window = self._elasticity.get('window', HISTORY_WINDOW)
+        if window != previous.get('window', HISTORY_WINDOW):
+            resized = history.MetricHistory(window)
+            for now, value in self._elasticity['history'].samples():
+                resized.push(value, now)
+            self._elasticity['history'] = resized
+        if self._elasticity.get('predict') != previous.get('predict'):
+            self._holt = None
+            self._setup()
+        elif self._elasticity.get('method') == 'composite':
+            # Samples of the metrics it keeps are kept
+            self._policy.register(self._service_name, self._elasticity)
+        if (previous.get('method') == 'composite' and
+                self._elasticity.get('method') != 'composite'):
+            self._policy.unregister(self._service_name)
+        # Forecasts or a standby pool may have been added
+        self._default_latency()
+
+    def close(self):
+        """Stops evaluating the service in the shared policy"""
+        if self._elasticity.get('method') == 'composite':
+            self._policy.unregister(self._service_name)
+
+    def add_servers(self, count):
+        """Starts count treadmill containers with one request and tracks them
+        by the instance ids it returns. Returns a Deferred"""
+        _LOGGER.info('Add %d pending servers', count)
+        entries = self._inflight.schedule(
+            count, time.time(),
+            self._elasticity.get('launch_timeout', inflight.LAUNCH_TIMEOUT))
+        self._elasticity['pending'] = self._inflight.pending()
+
+        def _failed(failure):
+            """Forgets the request, the next loop schedules again"""
+            self._inflight.failed(entries)
+            self._elasticity['pending'] = self._inflight.pending()
+            return failure
+
+        request = treadmill_api.start_containers_async(
+            self._treadmill['appname'], self._treadmill['manifest'], count)
+        return request.addCallbacks(
+            lambda instances: self._inflight.scheduled(entries, instances),
+            _failed)
+
+    def delete_servers(self, instances):
+        """Deletes treadmill containers in batches and tracks them until they
+        leave discovery. Returns a Deferred"""
+        _LOGGER.info('Delete %d servers', len(instances))
+        self._inflight.delete(instances, time.time())
+
+        def _failed(failure):
+            """Sends the delete again on the next loop"""
+            self._inflight.delete_failed(instances)
+            return failure
+
+        return treadmill_api.stop_containers_async(
+            self._treadmill['appname'], instances).addErrback(_failed)
+
+    def _servers(self, state):
+        """Returns the instance names and stats rows of the servers in an
+        haproxy state, the ones with the fewest sessions and lowest weight
+        first"""
+        servers = []
+        for server, row in self._stats.servers(self._service_name).items():
+            # Empty slots are not servers
+            instance = self._haproxy_parser.get_instance(self._service_name,
+                                                         server)
+            if (instance and self._haproxy_parser.server_state(
+                    self._service_name, instance) == state):
+                servers.append((instance, row))
+        return sorted(servers, key=lambda server: (server[1]['scur'],
+                                                   server[1]['weight'],
+                                                   server[0]))
 
     def healthy_servers(self):
-        """Checks for all servers considered healthy"""
-        healthy = []
-        for server in self._haproxy.servers():
-            # Status can be in the midway point between DOWN and UP. Just can't
-            # be down.
-            if server.status != 'DOWN':
-                healthy.append(server)
-        return healthy
-
-    def adjust_servers(self):
-        """Adjusts servers based on the elasticity configuration.
-        Uses the largest value stored in queue for calculations to avoid
-        random dips. Requires continuous levels of low activity to drop servers.
+        """Checks for all servers considered healthy. Returns their instance
+        names, the least loaded first"""
+        # Status can be in the midway point between DOWN and UP. Just can't
+        # be down or in maintenance, possibly through another server.
+        return [instance for instance, row in self._servers('ready')
+                if row['status'] != 'DOWN' and
+                not row['status'].startswith('MAINT')]
+
+    def standby_servers(self):
+        """Returns the instance names of the standby pool. Standby servers
+        are drained, or in maintenance after a reload. Servers drained for
+        deletion are not part of it"""
+        return [instance for instance, row in self._servers('drain')
+                if row['status'] != 'DOWN' and
+                instance not in self._elasticity['draining']]
+
+    def drain_servers(self, instances):
+        """Stops new connections to servers that are to be deleted. They are
+        deleted by finish_drains once their sessions ended"""
+        _LOGGER.info('Drain %d servers', len(instances))
+        deadline = time.time() + self._elasticity.get('drain_timeout',
+                                                      DRAIN_TIMEOUT)
+        # Standby servers are drained already
+        self._set_state([instance for instance in instances
+                         if self._haproxy_parser.server_state(
+                             self._service_name, instance) == 'ready'],
+                        'drain')
+        for instance in instances:
+            self._elasticity['draining'][instance] = deadline
+
+    def finish_drains(self):
+        """Deletes drained servers without sessions and the ones whose drain
+        timed out. Returns the list of Deferreds of the delete requests"""
+        now = time.time()
+        sessions = {instance: row['scur']
+                    for instance, row in self._servers('drain')}
+        drained = []
+        for instance, deadline in list(self._elasticity['draining'].items()):
+            if not self._haproxy_parser.server_exists(self._service_name,
+                                                      instance):
+                # Deleted, or gone from discovery on its own
+                del self._elasticity['draining'][instance]
+            elif deadline is not None and (not sessions.get(instance) or
+                                           deadline <= now):
+                drained.append(instance)
+                self._elasticity['draining'][instance] = None
+        if not drained:
+            return []
+        return [self.delete_servers(drained)]
+
+    def standby_size(self):
+        """Number of standby containers to keep. Sized to cover the scale-ups
+        of the recent window that arrive while a refill is launching"""
+        if 'standby' not in self._elasticity:
+            return 0
+        standby = self._elasticity['standby']
+        window = standby.get('window', STANDBY_WINDOW)
+        now = time.time()
+        while self._scale_ups and self._scale_ups[0] < now - window:
+            self._scale_ups.popleft()
+        size = int(math.ceil(len(self._scale_ups) *
+                             self._elasticity['launch_latency'] / window))
+        return max(standby.get('min', STANDBY_MIN),
+                   min(standby.get('max', STANDBY_MAX), size))
+
+    def _set_state(self, instances, state):
+        """Flips servers between serving and standby through the runtime API.
+        The config is written with the new state, so a reload fixes a flip
+        haproxy refused"""
+        for instance in instances:
+            server = self._haproxy_parser.set_server_state(self._service_name,
+                                                           instance, state)
+            if server is None:
+                # Not in the running haproxy yet, the pending reload has it
+                continue
+            if not haproxy_cmd.set_server_state(
+                    self._haproxy, self._service_name, server, state):
+                self._haproxy_parser.request_reload('runtime_failed')
+
+    def _set_maxconn(self, maxconn):
+        """Sets the maxconn of the service's frontend"""
+        haproxy_cmd.runtime_command(
+            self._haproxy,
+            'set maxconn frontend {} {}'.format(self._service_name, maxconn))
+
+    def adjust_servers(self, now=None):
+        """Adjusts servers based on the elasticity configuration. Reads the
+        measure of the method and evaluates the policy on it"""
+        now = now or time.time()
+        if self._elasticity['method'] == 'composite':
+            self.composite(now)
+            return
+        self.evaluate(self.read_measure(), now)
+
+    def read_measure(self):
+        """Reads the measure of the method from the stats snapshot"""
+        return self._stats.metric(self._service_name,
+                                  METHOD_METRICS[self._elasticity['method']])
+
+    def evaluate(self, measure, now):
+        """Sets the target from a measure taken at time now. Uses the
+        largest value measured in the window for calculations to avoid random
+        dips. Requires continuous levels of low activity to drop servers. Does
+        not touch haproxy or treadmill, so recorded traces can be replayed
+        through it.
         """
-        if self._elasticity['method'] == 'conn_rate':
-            measure = int(self._haproxy.metric('rate'))
-        elif self._elasticity['method'] == 'queue':
-            measure = int(self._haproxy.metric('qtime'))
-        elif self._elasticity['method'] == 'response':
-            measure = int(self._haproxy.metric('rtime'))
-        max_measure = find_max(measure, self._elasticity['history'])
+        # Kept for the metrics endpoint
+        self._elasticity['measure'] = measure
+        self._elasticity['history'].push(measure, now)
+        max_measure = self._elasticity['history'].max()
+
+        if 'predict' in self._elasticity:
+            # Act on where the measure will be once a container started now
+            # is healthy. Forecasts only ever raise the measure.
+            predicted = self.predict(measure, now)
+            _LOGGER.debug('Predicted Measure: %d', predicted)
+            measure = max(measure, predicted)
+            max_measure = max(max_measure, predicted)
 
         if 'steps' in self._elasticity:
             self.server_steps(max_measure)
@@ -85,6 +314,40 @@ class Orchestrator(object):
         elif 'scale' in self._elasticity:
             self.scale(max_measure)
 
+    def composite(self, now):
+        """Takes the target from the composite policy, which weighs several
+        metrics of every service at once after each stats refresh. The
+        measure is the unrounded number of servers it asks for"""
+        target = self._policy.target(self._service_name)
+        if target is None:
+            return
+        measure = self._policy.score(self._service_name)
+        self._elasticity['measure'] = measure
+        self._elasticity['history'].push(measure, now)
+        _LOGGER.debug('Composite Measure: %.2f', measure)
+        self._elasticity['target'] = target
+
+    def predict(self, measure, now):
+        """Forecasts the measure one launch latency ahead using either a
+        linear fit over the history or Holt's double exponential smoothing"""
+        horizon = self._elasticity['launch_latency']
+        if self._elasticity['predict'].get('model', 'holt') == 'linear':
+            return forecast.linear(self._elasticity['history'].samples(),
+                                   horizon)
+        self._holt.update(measure, now)
+        return self._holt.forecast(horizon)
+
+    def record_launches(self, latencies):
+        """Measures launch to healthy latency from the schedules that
+        resolved"""
+        for latency in latencies:
+            if 'launch_latency' in self._elasticity:
+                self._elasticity['launch_latency'] = (
+                    LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) *
+                    self._elasticity['launch_latency'])
+                _LOGGER.debug('Launch latency: %d',
+                              self._elasticity['launch_latency'])
+
     def server_steps(self, max_measure):
         """Adjusts servers based on a list of steps indicating when to add a
         servers.
@@ -162,11 +425,17 @@ class Orchestrator(object):
         Blocks connections to the service backend by setting max connections
         to 0. For now, it will reset the maxconn to 2000 which is the default
         global max.
+
+        The frontend of the service is restricted and the backend of the
+        proxy tells the number of incoming connections before they reach the
+        real backend. After connections are opened, the real backend stats
+        would be equivalent to the proxy backend.
         """
 
         # If cooldown time has passed or first run (shutdown_time defaults to 0)
         if self._elasticity['shutoff_time'] < time.time():
-            new_conns = int(self._haproxy_proxy.metric('scur'))
+            new_conns = self._stats.metric(self._service_name + '_proxy',
+                                           'scur')
             _LOGGER.debug('New Conns: %d', new_conns)
 
             # If there are more than 0 connections
@@ -184,75 +453,194 @@ class Orchestrator(object):
                 self._elasticity['target'] -= 1
 
             # Set max connections to 0 if there are no healthy_servers
-            if self._elasticity['healthy']:
-                self._haproxy_front.setmaxconn(2000)
-            else:
-                self._haproxy_front.setmaxconn(0)
+            self._set_maxconn(MAXCONN if self._elasticity['healthy'] else 0)
+
+    def bound_target(self):
+        """Make sure target is above minimum and below maximum"""
+        self._elasticity['target'] = max(self._elasticity['min_servers'],
+                                         self._elasticity['target'])
+        if self._elasticity['max_servers']:
+            self._elasticity['target'] = min(self._elasticity['max_servers'],
+                                             self._elasticity['target'])
 
     def keep_target(self):
         """Adds and removes servers to keep number of healthy servers level
         with the target number of servers
 
-        Keeps track of pending servers because treadmill containers do not
-        start and stop instantly
+        Keeps track of every schedule and delete request because treadmill
+        containers do not start and stop instantly. Pending is the exact
+        number of scheduled containers that are not serving yet. Deleted
+        servers are drained first and stop counting right away. Requests
+        that time out are deleted or sent again.
 
-        Pending deleted servers are counted as negative because they account
-        for healthy servers that do not count
+        With a standby pool, containers beyond the target are kept drained
+        and scale-ups are served from the pool by a runtime state flip while
+        the pool is refilled
 
-        Pending added servers are counted as positive because they accounted
-        for healthy servers that should count
+        Returns a Deferred that fires once every container request finished
         """
-        # Make sure target is above minimum and below maximum
-        self._elasticity['target'] = max(self._elasticity['min_servers'],
-                                         self._elasticity['target'])
-        if self._elasticity['max_servers']:
-            self._elasticity['target'] = min(self._elasticity['max_servers'],
-                                             self._elasticity['target'])
+        self.bound_target()
 
         _LOGGER.debug('Target %d', self._elasticity['target'])
-
-        new_healthy = self.healthy_servers()
-
-        # Can be empty list, but None specifically means initial loop
-        if self._elasticity['healthy'] != None:
-            # Resolves pending servers. Servers that change between loops were
-            # accounted for in the pending count. If there are new healthy
-            # servers, the pending added servers have resolved. Pending is
-            # subtracted. If there are fewer healthy servers, then
-            # pending deleted servers have resolved. Pending is added.
-            self._elasticity['pending'] -= (len(new_healthy) -
-                                            len(self._elasticity['healthy']))
+        # Every add or delete is a single batched request
+        requests = self.finish_drains()
+
+        rise = self._elasticity['target'] - self._last_target
+        self._scale_ups.extend([time.time()] * max(rise, 0))
+        self._last_target = self._elasticity['target']
+
+        # Containers given up on are not counted while they are deleted
+        new_healthy = [instance for instance in self.healthy_servers()
+                       if not self._inflight.deleting(instance)]
+        new_standby = [instance for instance in self.standby_servers()
+                       if not self._inflight.deleting(instance)]
+
+        # Schedules resolve once their containers serve, either healthy or
+        # in the standby pool. Deletes resolve once they left discovery.
+        now = time.time()
+        self.record_launches(self._inflight.resolve(
+            set(new_healthy + new_standby),
+            functools.partial(self._haproxy_parser.server_exists,
+                              self._service_name), now))
+        abandoned, retries = self._inflight.expire(now)
+        if abandoned or retries:
+            requests.append(self.delete_servers(abandoned + retries))
+        self._elasticity['pending'] = self._inflight.pending()
 
         self._elasticity['healthy'] = new_healthy
+        self._elasticity['standby_servers'] = new_standby
+        healthy = list(new_healthy)
+        standby = list(new_standby)
+        size = self.standby_size()
 
         _LOGGER.debug('Pending: %d', self._elasticity['pending'])
-        _LOGGER.debug('Healthy: %d', len(self._elasticity['healthy']))
+        _LOGGER.debug('Healthy: %d', len(healthy))
+        _LOGGER.debug('Standby: %d of %d', len(standby), size)
 
-        # Difference between the target and number of available servers + the
-        # pending number of added and deleted servers
-        diff = (self._elasticity['target'] - len(self._elasticity['healthy']) -
-                self._elasticity['pending'])
+        # Difference between the target plus the standby pool and number of
+        # available servers + the pending number of added and deleted servers
+        diff = (self._elasticity['target'] + size - len(healthy) -
+                len(standby) - self._elasticity['pending'])
         _LOGGER.debug('Diff: %d', + diff)
+        self._decision = 0
 
         # If there are more healthy + pending, delete servers and adjust
         if diff < 0:
             # Prevent attempting deletion of pending servers that can't
-            # be deleted yet.
-            diff = min(abs(diff), len(self._elasticity['healthy']))
-            for idx in range(diff):
-                self.delete_server(self._elasticity['healthy'][idx].name)
-                self._elasticity['pending'] -= 1
-        else:
-            for _ in range(abs(diff)):
-                self.add_server()
-                self._elasticity['pending'] += 1
+            # be deleted yet. Standby servers serve nothing and go first,
+            # then the servers with the fewest sessions. They are drained
+            # and stop counting right away but are deleted later.
+            victims = standby + healthy
+            diff = min(abs(diff), len(victims))
+            if diff:
+                self.drain_servers(victims[:diff])
+                self._decision = -diff
+                standby = [instance for instance in standby
+                           if instance not in victims[:diff]]
+                healthy = [instance for instance in healthy
+                           if instance not in victims[:diff]]
+        elif diff > 0:
+            requests.append(self.add_servers(diff))
+            self._decision = diff
+
+        # Serve a scale-up from the pool right away, and keep servers beyond
+        # the target drained in the pool rather than deleting them
+        short = self._elasticity['target'] - len(healthy)
+        if short > 0 and standby:
+            self._set_state(standby[:short], 'ready')
+            if self._elasticity.get('hold_conns') and not healthy:
+                # Let held connections through to the promoted server
+                self._set_maxconn(MAXCONN)
+        elif short < 0 and size > len(standby):
+            self._set_state(healthy[:min(-short, size - len(standby))],
+                            'drain')
+        return process.gather(requests)
+
+    def snapshot(self):
+        """Returns the state needed to carry on after a restart as a dict"""
+        return {
+            'target': self._elasticity['target'],
+            'min_servers': self._elasticity['min_servers'],
+            'healthy': self._elasticity['healthy'],
+            'standby_servers': self._elasticity['standby_servers'],
+            'draining': self._elasticity['draining'],
+            'shutoff_time': self._elasticity.get('shutoff_time'),
+            'launch_latency': self._elasticity.get('launch_latency'),
+            'history': list(self._elasticity['history'].samples()),
+            'inflight': self._inflight.snapshot(),
+            'scale_ups': list(self._scale_ups),
+        }
+
+    def restore(self, saved):
+        """Restores the state returned by snapshot. The target is kept within
+        the bounds of the current config"""
+        for key in ('target', 'healthy', 'standby_servers', 'draining'):
+            self._elasticity[key] = saved[key]
+        if self._elasticity.get('hold_conns'):
+            # Driven by held connections, otherwise it comes from the config
+            self._elasticity['min_servers'] = saved['min_servers']
+        for key in ('shutoff_time', 'launch_latency'):
+            if saved[key] is not None and key in self._elasticity:
+                self._elasticity[key] = saved[key]
+        for now, value in saved['history']:
+            self._elasticity['history'].push(value, now)
+        self._inflight.restore(saved['inflight'])
+        self._elasticity['pending'] = self._inflight.pending()
+        self._scale_ups.extend(saved['scale_ups'])
+        self.bound_target()
+        self._last_target = self._elasticity['target']
+
+    def status(self):
+        """Returns the service name, the target, pending, healthy, standby and
+        draining number of servers and the last measure"""
+        healthy = self._elasticity['healthy']
+        return {
+            'service': self._service_name,
+            'target': self._elasticity['target'],
+            'pending': self._elasticity['pending'],
+            'healthy': len(healthy) if healthy is not None else None,
+            'standby': len(self._elasticity['standby_servers']),
+            'draining': sum(1 for deadline in
+                            self._elasticity['draining'].values()
+                            if deadline is not None),
+            'measure': self._elasticity.get('measure'),
+        }
+
+    def trace_record(self, now):
+        """Returns what the last loop read and decided as a record of the
+        trace recorder"""
+        record = self.status()
+        record.update({
+            'time': now,
+            'healthy': record['healthy'] or 0,
+            'decision': self._decision,
+        })
+        for name in recorder.METRICS:
+            record[name] = self._stats.metric(self._service_name, name)
+        return record
+
+    def busy(self):
+        """Returns whether the service needs attention soon. It does while
+        containers are pending, draining or being deleted, while connections
+        are held waiting for a server and while the measure is rising"""
+        if (self._elasticity['pending'] or self._elasticity['draining'] or
+                self._inflight.deletes()):
+            return True
+        if ('hold_conns' in self._elasticity and
+                self._elasticity['hold_conns'] and
+                not self._elasticity['healthy'] and
+                self._stats.metric(self._service_name + '_proxy', 'scur')):
+            return True
+        last = self._elasticity['history'].last()
+        return last is not None and last[1] > self._elasticity['history'].ewma()
 
     def loop(self):
         """Main loop. Runs adjust server if method is configured. Holds
-        connections if configured. Always tries to keep target"""
+        connections if configured. Always tries to keep target. Returns a
+        Deferred that fires once every container request finished"""
         _LOGGER.info('Starting orchestrator loop for %s', self._service_name)
         if 'method' in self._elasticity:
             self.adjust_servers()
         if 'hold_conns' in self._elasticity and self._elasticity['hold_conns']:
             self.hold_conns()
-        self.keep_target()
+        return self.keep_target()
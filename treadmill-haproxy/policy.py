@@ -0,0 +1,147 @@
+"""Composite scaling policy evaluated for every service at once"""
+
+import logging
+import math
+
+import numpy
+
+import stats
+
+# Samples kept of every metric. Windows longer than this many loops only see
+# the latest samples.
+CAPACITY = 512
+# Default seconds of samples a metric's max is taken over
+WINDOW = 70
+# Most servers a sample of a time metric asks for, as a multiple of the ones
+# serving. Times grow without bound once servers saturate and do not tell how
+# many more are needed.
+MAX_GROWTH = 2
+_LOGGER = logging.getLogger(__name__)
+
+
+class CompositePolicy(object):
+    """Targets of every service with the composite method. Each service names
+    metrics with a weight, a threshold and a window. A sample of a metric asks
+    for as many servers as it is multiple of the threshold: summed metrics
+    like rate across the backend, times like rtime for every server serving
+    when it was taken. A metric asks for the most servers any of its samples
+    in the window did, and a service's target is the weighted mean of what
+    its metrics ask for.
+
+    Every (service, metric) pair is a row of one set of columns. evaluate
+    samples every row from the stats snapshot into a ring of columns and
+    computes the targets of all services in one pass over it."""
+    def __init__(self, capacity=CAPACITY):
+        self._capacity = capacity
+        # Elasticity of every service, to read the healthy servers from
+        self._services = {}
+        self._names = []
+        # Service and metric name of every row
+        self._rows = []
+        # Per row settings
+        self._owner = numpy.zeros(0, dtype=numpy.intp)
+        self._weight = numpy.zeros(0)
+        self._threshold = numpy.ones(0)
+        self._window = numpy.zeros(0)
+        self._summed = numpy.zeros(0, dtype=bool)
+        # Ring of the servers every sample asks for, one column per
+        # evaluation
+        self._times = numpy.full(capacity, -numpy.inf)
+        self._wanted = numpy.zeros((0, capacity))
+        self._seq = 0
+        # Whether services changed since the rows were laid out
+        self._dirty = False
+        # Latest results by service
+        self._targets = {}
+        self._scores = {}
+
+    def register(self, service_name, elasticity):
+        """Adds or replaces the metrics of a service. Samples of metrics it
+        keeps are kept"""
+        self._services[service_name] = elasticity
+        self._dirty = True
+
+    def unregister(self, service_name):
+        """Drops the metrics of a service"""
+        if self._services.pop(service_name, None) is not None:
+            self._targets.pop(service_name, None)
+            self._scores.pop(service_name, None)
+            self._dirty = True
+
+    def _rebuild(self):
+        """Lays the rows out again from the registered services"""
+        self._dirty = False
+        old = {row: idx for idx, row in enumerate(self._rows)}
+        names = sorted(self._services)
+        rows, owner, weight, threshold, window = [], [], [], [], []
+        for idx, service_name in enumerate(names):
+            # The schema requires metrics, but a config that failed
+            # validation at startup still runs
+            for metric in self._services[service_name].get('metrics', ()):
+                rows.append((service_name, metric['name']))
+                owner.append(idx)
+                weight.append(metric.get('weight', 1))
+                threshold.append(metric['threshold'])
+                window.append(metric.get('window', WINDOW))
+
+        wanted = numpy.zeros((len(rows), self._capacity))
+        for idx, row in enumerate(rows):
+            if row in old:
+                wanted[idx] = self._wanted[old[row]]
+        self._names = names
+        self._rows = rows
+        self._owner = numpy.array(owner, dtype=numpy.intp)
+        self._weight = numpy.array(weight, dtype=float)
+        self._threshold = numpy.array(threshold, dtype=float)
+        self._window = numpy.array(window, dtype=float)
+        self._summed = numpy.array([name in stats.SUMMED
+                                    for _, name in rows], dtype=bool)
+        self._wanted = wanted
+
+    def evaluate(self, snapshot, now):
+        """Samples every metric from the stats snapshot and computes the
+        target of every service"""
+        # Services are registered one by one, rows are laid out once
+        if self._dirty:
+            self._rebuild()
+        if not self._rows:
+            return
+        values = numpy.array([snapshot.metric(service_name, name)
+                              for service_name, name in self._rows],
+                             dtype=float)
+        healthy = numpy.array(
+            [len(self._services[name]['healthy'] or ())
+             for name in self._names], dtype=float)
+        serving = numpy.maximum(healthy[self._owner], 1)
+
+        pos = self._seq % self._capacity
+        self._seq += 1
+        self._times[pos] = now
+        ratio = values / self._threshold
+        self._wanted[:, pos] = numpy.where(
+            self._summed, ratio, serving * numpy.minimum(ratio, MAX_GROWTH))
+
+        # Max of every row over its own window
+        recent = self._times[numpy.newaxis, :] >= (
+            now - self._window[:, numpy.newaxis])
+        wanted = numpy.where(recent, self._wanted, -numpy.inf).max(axis=1)
+
+        count = len(self._names)
+        weights = numpy.bincount(self._owner, self._weight, count)
+        scores = (numpy.bincount(self._owner, self._weight * wanted, count) /
+                  numpy.maximum(weights, 1e-9))
+        _LOGGER.debug('Evaluated %d metrics of %d services', len(self._rows),
+                      count)
+        for service_name, score in zip(self._names, scores.tolist()):
+            self._scores[service_name] = score
+            # Rounded first so float noise does not add a server
+            self._targets[service_name] = int(math.ceil(round(score, 6)))
+
+    def target(self, service_name):
+        """Returns the number of servers a service needs. None before its
+        first evaluation"""
+        return self._targets.get(service_name)
+
+    def score(self, service_name):
+        """Returns the servers a service needs before rounding up"""
+        return self._scores.get(service_name)
@@ -0,0 +1,110 @@
+"""Runs commands through the Twisted reactor without blocking it"""
+
+import logging
+import os
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+
+# Maximum number of commands running at the same time
+MAX_CONCURRENT = 8
+# Maximum number of haproxy control commands running at the same time. They
+# have a limit of their own so hung treadmill commands do not hold up
+# reloads.
+MAX_CONTROL = 2
+# Seconds a command may run before it is killed
+TIMEOUT = 60
+_LOGGER = logging.getLogger(__name__)
+_LIMIT = defer.DeferredSemaphore(MAX_CONCURRENT)
+_CONTROL = defer.DeferredSemaphore(MAX_CONTROL)
+
+
+class CommandTimeout(Exception):
+    """A command ran longer than its timeout and was killed"""
+
+
+class _OutputProtocol(protocol.ProcessProtocol):
+    """Collects the output of a command and kills it once it runs past its
+    timeout"""
+    def __init__(self, cmd, timeout):
+        self._cmd = cmd
+        self._timeout = timeout
+        self._out = []
+        self._err = []
+        self._timer = None
+        self._timed_out = False
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+        self._timer = reactor.callLater(self._timeout, self._kill)
+
+    def _kill(self):
+        """Kills a command that ran past its timeout"""
+        self._timed_out = True
+        _LOGGER.error('Killing %s after %ds', ' '.join(self._cmd),
+                      self._timeout)
+        self.transport.signalProcess('KILL')
+
+    def outReceived(self, data):
+        self._out.append(data)
+
+    def errReceived(self, data):
+        self._err.append(data)
+
+    def processEnded(self, reason):
+        if self._timer.active():
+            self._timer.cancel()
+        if self._timed_out:
+            self.done.errback(CommandTimeout('{} timed out after {}s'.format(
+                ' '.join(self._cmd), self._timeout)))
+            return
+        # Like subprocess, a command killed by a signal exits with minus it
+        code = reason.value.exitCode
+        if code is None:
+            code = -reason.value.signal
+        self.done.callback((b''.join(self._out), b''.join(self._err), code))
+
+
+def _spawn(cmd, timeout):
+    """Starts a command. Returns a Deferred that fires with its output"""
+    proto = _OutputProtocol(cmd, timeout)
+    # Pass the environment through so PATH is used to find the executable
+    reactor.spawnProcess(proto, cmd[0], cmd, env=os.environ)
+    return proto.done
+
+
+def run(cmd, timeout=TIMEOUT, control=False):
+    """Runs a command in the reactor. Returns a Deferred that fires with a
+    tuple of stdout, stderr and the exit code, or fails with CommandTimeout
+    once the command was killed for running past timeout seconds. Commands
+    past MAX_CONCURRENT, or MAX_CONTROL for haproxy control commands, wait
+    for a running one to finish"""
+    _LOGGER.debug('Run: %s', ' '.join(cmd))
+    limit = _CONTROL if control else _LIMIT
+    return limit.run(_spawn, cmd, timeout)
+
+
+def call(cmd, timeout=TIMEOUT, control=False):
+    """Runs a command in the reactor. Returns a Deferred that fires with the
+    exit code, like subprocess.call"""
+    return run(cmd, timeout, control).addCallback(lambda result: result[2])
+
+
+def gather(deferreds):
+    """Waits for every Deferred side by side. Failures are logged and do not
+    stop the others. Returns a Deferred that fires with the list of results,
+    None in place of a failure"""
+    def _unpack(results):
+        """Logs failures and strips the success flags"""
+        values = []
+        for success, result in results:
+            if success:
+                values.append(result)
+            else:
+                _LOGGER.error('%s', result.getTraceback())
+                values.append(None)
+        return values
+    return defer.DeferredList(deferreds, consumeErrors=True).addCallback(
+        _unpack)
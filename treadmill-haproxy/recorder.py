@@ -0,0 +1,147 @@
+"""Binary trace of what the orchestrators read and decided every loop.
+
+A trace file is a header followed by fixed size records, one per
+orchestrator loop. The file is allocated at its full size and written
+through a memory map, so recording costs a struct pack per loop. Once full
+it is truncated to the records written and rotated to path.1, path.2 and so
+on. replay.py streams traces through any elasticity config offline.
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+import stats
+
+MAGIC = b'THTR'
+VERSION = 2
+# Default size of a trace file before it is rotated and rotated files kept
+MAX_SIZE = 64 * 1024 * 1024
+KEEP = 4
+# Columns of show stat of the backend recorded every loop. Every column of
+# the snapshot is, so a replay can evaluate any metric a policy reads.
+METRICS = stats.FIELDS
+# State of the orchestrator after the loop. decision is the number of
+# containers added, negative for drained ones.
+STATE = ('healthy', 'standby', 'pending', 'draining', 'target', 'decision')
+# Magic, version, record size and number of records written
+HEADER = struct.Struct('<4sHHQ')
+# Time, service name, metrics, state and measure. Longer service names are
+# cut to 32 bytes.
+RECORD = struct.Struct('<d32s{}id'.format(len(METRICS) + len(STATE)))
+_LOGGER = logging.getLogger(__name__)
+
+
+def pack(record):
+    """Packs a record dict into bytes"""
+    return RECORD.pack(record['time'],
+                       record['service'].encode('utf-8')[:32],
+                       *([int(record[name]) for name in METRICS + STATE] +
+                         [float(record['measure'] or 0)]))
+
+
+def unpack(data, offset=0):
+    """Unpacks a record dict from bytes"""
+    values = RECORD.unpack_from(data, offset)
+    record = {'time': values[0],
+              'service': values[1].rstrip(b'\0').decode('utf-8', 'replace'),
+              'measure': values[-1]}
+    record.update(zip(METRICS + STATE, values[2:-1]))
+    return record
+
+
+def files(path):
+    """Returns the rotated trace files of path and path itself, oldest
+    first, that exist"""
+    rotated = []
+    index = 1
+    while os.path.exists('{}.{}'.format(path, index)):
+        rotated.append('{}.{}'.format(path, index))
+        index += 1
+    return list(reversed(rotated)) + (
+        [path] if os.path.exists(path) else [])
+
+
+def read(path):
+    """Yields the records of a trace file in the order they were written"""
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+    if len(data) < HEADER.size:
+        raise ValueError('{} is not a trace file'.format(path))
+    magic, version, size, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise ValueError('{} is not a version {} trace file'.format(path,
+                                                                    VERSION))
+    # A crash can leave the count ahead of the data flushed to disk
+    count = min(count, (len(data) - HEADER.size) // RECORD.size)
+    for idx in range(count):
+        yield unpack(data, HEADER.size + idx * RECORD.size)
+
+
+class TraceWriter(object):
+    """Appends records to a memory mapped trace file and rotates it once
+    max_size is reached. Keeps the keep most recent rotated files"""
+    def __init__(self, path, max_size=MAX_SIZE, keep=KEEP):
+        self._path = path
+        self._keep = keep
+        # Room for the header and at least one record
+        self._capacity = max(1, (max_size - HEADER.size) // RECORD.size)
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._open()
+
+    def _open(self):
+        """Maps the trace file, continuing one left by a previous run"""
+        size = HEADER.size + self._capacity * RECORD.size
+        count = 0
+        if os.path.exists(self._path):
+            try:
+                count = sum(1 for _ in read(self._path))
+            except ValueError as err:
+                _LOGGER.error('Rotating unreadable trace: %s', err)
+                self._rotate_files()
+            if count >= self._capacity:
+                self._rotate_files()
+                count = 0
+        self._file = open(self._path, 'a+b')
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._count = count
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, count)
+
+    def _rotate_files(self):
+        """Shifts path to path.1, path.1 to path.2 and so on, dropping files
+        beyond keep"""
+        if os.path.exists('{}.{}'.format(self._path, self._keep)):
+            os.remove('{}.{}'.format(self._path, self._keep))
+        for index in range(self._keep - 1, 0, -1):
+            name = '{}.{}'.format(self._path, index)
+            if os.path.exists(name):
+                os.rename(name, '{}.{}'.format(self._path, index + 1))
+        if os.path.exists(self._path):
+            os.rename(self._path, self._path + '.1')
+
+    def write(self, record):
+        """Appends a record dict with the time, service, METRICS, STATE and
+        measure"""
+        if self._count >= self._capacity:
+            self.close()
+            self._rotate_files()
+            self._open()
+        offset = HEADER.size + self._count * RECORD.size
+        self._map[offset:offset + RECORD.size] = pack(record)
+        self._count += 1
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size,
+                         self._count)
+
+    def close(self):
+        """Flushes the records and trims the file to them"""
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(HEADER.size + self._count * RECORD.size)
+        self._file.close()
+        self._map = None
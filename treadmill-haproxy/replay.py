@@ -0,0 +1,216 @@
+"""Replays recorded traces through an elasticity config offline.
+
+Every record of the service in the trace is fed to an Orchestrator built
+from the config, in order and at its recorded time. Containers it asks for
+become healthy --launch-latency seconds later and the ones it drops go
+away right away. Reports the container-seconds used, the seconds spent
+below the capacity the recorded rate needed and how often the target
+changed direction, next to the same numbers of the recorded run, so
+thresholds can be chosen from real traffic. Run from the repository root:
+
+    python treadmill-haproxy/replay.py /var/log/haproxy.trace \\
+        --service web --capacity 50 \\
+        --elasticity '{"method": "conn_rate", "scale": 40}'
+
+The rate replays faithfully. Times like rtime were measured with the
+recorded number of servers and not the replayed one. Connection holding and
+the standby pool are not replayed.
+"""
+
+import json
+import math
+
+import click
+
+import orchestrator
+import policy
+import recorder
+
+
+class ReplayStats(object):
+    """Stands in for the stats snapshot, answering from the current record"""
+    def __init__(self, service_name):
+        self._service_name = service_name
+        self.record = {}
+
+    def metric(self, proxy, name, server='BACKEND'):
+        """Returns a metric of the backend in the current record. 0 if it is
+        unknown"""
+        if proxy != self._service_name or server != 'BACKEND':
+            return 0
+        return self.record.get(name, 0)
+
+
+class Tally(object):
+    """Container-seconds, seconds below capacity and direction changes of
+    the target of one run"""
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._last_target = None
+        self._direction = 0
+        self.container_seconds = 0.0
+        self.under_capacity_seconds = 0.0
+        self.flips = 0
+        self.scale_ups = 0
+        self.scale_downs = 0
+
+    def account(self, elapsed, rate, healthy, containers):
+        """Adds elapsed seconds of a state. rate is the recorded demand"""
+        needed = max(int(math.ceil(rate / float(self._capacity))), 1)
+        self.container_seconds += containers * elapsed
+        if healthy < needed:
+            self.under_capacity_seconds += elapsed
+
+    def target(self, target):
+        """Counts a change of the target"""
+        if self._last_target is not None and target != self._last_target:
+            direction = 1 if target > self._last_target else -1
+            if direction > 0:
+                self.scale_ups += 1
+            else:
+                self.scale_downs += 1
+            if self._direction and direction != self._direction:
+                self.flips += 1
+            self._direction = direction
+        self._last_target = target
+
+    def report(self):
+        """Returns the results as a dict"""
+        return {
+            'container_seconds': round(self.container_seconds),
+            'under_capacity_seconds': round(self.under_capacity_seconds),
+            'flips': self.flips,
+            'scale_ups': self.scale_ups,
+            'scale_downs': self.scale_downs,
+        }
+
+
+class Replay(object):
+    """Runs the records of a service through an Orchestrator with the given
+    elasticity and models the containers it asks for"""
+    def __init__(self, service_name, elasticity, capacity, launch_latency):
+        self._service_name = service_name
+        self._launch_latency = launch_latency
+        elasticity = dict(elasticity)
+        # Same defaults as the configurator
+        elasticity.setdefault('min_servers', 0)
+        elasticity.setdefault('max_servers', None)
+        self._elasticity = elasticity
+        self._stats = ReplayStats(service_name)
+        self._policy = policy.CompositePolicy()
+        self._orch = orchestrator.Orchestrator(
+            service_name, {'elasticity': elasticity, 'treadmill': {}}, None,
+            None, self._stats, self._policy)
+        self._healthy = 0
+        # Times the pending containers become healthy
+        self._pending = []
+        self._first = None
+        self._last = None
+        self.replayed = Tally(capacity)
+        self.recorded = Tally(capacity)
+
+    def feed(self, record):
+        """Replays one record"""
+        now = record['time']
+        if self._last is not None:
+            elapsed = now - self._last['time']
+            rate = self._last['rate']
+            self.replayed.account(elapsed, rate, self._healthy,
+                                  self._healthy + len(self._pending))
+            self.recorded.account(
+                elapsed, rate, self._last['healthy'],
+                sum(self._last[name] for name in
+                    ('healthy', 'standby', 'pending', 'draining')))
+        self._last = record
+        self.recorded.target(record['target'])
+
+        started = [ready for ready in self._pending if ready <= now]
+        self._healthy += len(started)
+        self._pending = [ready for ready in self._pending if ready > now]
+
+        self._stats.record = record
+        self._elasticity['healthy'] = [None] * self._healthy
+        if self._elasticity.get('method') == 'composite':
+            self._policy.evaluate(self._stats, now)
+        if 'method' in self._elasticity:
+            self._orch.adjust_servers(now)
+        self._orch.bound_target()
+        target = self._elasticity['target']
+        self.replayed.target(target)
+
+        # Like keep_target, pending containers can not be taken back
+        diff = target - self._healthy - len(self._pending)
+        if diff > 0:
+            self._pending.extend([now + self._launch_latency] * diff)
+        elif diff < 0:
+            self._healthy -= min(-diff, self._healthy)
+
+    def report(self):
+        """Returns the results of the replay and of the recorded run"""
+        duration = 0
+        if self._last is not None:
+            duration = self._last['time'] - self._first
+        return {
+            'duration': round(duration),
+            'replayed': self.replayed.report(),
+            'recorded': self.recorded.report(),
+        }
+
+    def run(self, records):
+        """Replays every record of the service"""
+        for record in records:
+            if record['service'] != self._service_name:
+                continue
+            if self._first is None:
+                self._first = record['time']
+            self.feed(record)
+
+
+def _records(paths):
+    """Yields the records of trace files, rotated files of each first"""
+    for path in paths:
+        for name in recorder.files(path):
+            for record in recorder.read(name):
+                yield record
+
+
+@click.command()
+@click.argument('traces', nargs=-1, required=True)
+@click.option('--service', 'service_name', default=None,
+              help='Service to replay, needed if the trace has several')
+@click.option('--elasticity', required=True,
+              help='Elasticity config as JSON, or @file holding it')
+@click.option('--capacity', type=float, required=True,
+              help='Connections per second one server handles')
+@click.option('--launch-latency', default=orchestrator.LAUNCH_LATENCY,
+              help='Seconds before a scheduled container is healthy')
+@click.option('--output', default=None, help='Write the report as JSON')
+def main(traces, service_name, elasticity, capacity, launch_latency,
+         output):
+    """Replays traces and prints the report"""
+    if elasticity.startswith('@'):
+        with open(elasticity[1:], 'r') as config_file:
+            elasticity = config_file.read()
+    elasticity = json.loads(elasticity)
+
+    if service_name is None:
+        services = set(record['service'] for record in _records(traces))
+        if len(services) != 1:
+            raise click.UsageError('Pick a service with --service: {}'.format(
+                ', '.join(sorted(services))))
+        service_name = services.pop()
+
+    replay = Replay(service_name, elasticity, capacity, launch_latency)
+    replay.run(_records(traces))
+    report = replay.report()
+    click.echo('duration: {}'.format(report['duration']))
+    for run in ('replayed', 'recorded'):
+        for name, value in sorted(report[run].items()):
+            click.echo('{}_{}: {}'.format(run, name, value))
+    if output:
+        with open(output, 'w') as report_out:
+            json.dump(report, report_out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Per service loop intervals that adapt to how busy a service is"""
+
+import random
+
+# Seconds between loops of a busy service and the most an idle one backs off
+MIN_INTERVAL = 2
+MAX_INTERVAL = 30
+# Longest interval of a service that holds connections. A connection waiting
+# for a first server is only noticed when the service runs.
+HOLD_INTERVAL = 2
+# Seconds between the first loops, before a service is known to be busy
+START_INTERVAL = 7
+# Growth of the interval for every idle loop
+BACKOFF = 1.5
+# Fraction of the interval added or removed at random, so services do not
+# all hit the admin socket and treadmill at the same moment
+JITTER = 0.1
+
+
+class ServiceSchedule(object):
+    """Decides when a service runs next. The interval drops to min_interval
+    while the service is busy and grows by BACKOFF for every idle loop, up to
+    max_interval"""
+    def __init__(self, now, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self.interval = min(max(START_INTERVAL, min_interval), max_interval)
+        # Spread the first runs over one interval
+        self.next_run = now + random.uniform(0, self.interval)
+
+    def due(self, now):
+        """Returns whether the service should run"""
+        return now >= self.next_run
+
+    def done(self, now, busy):
+        """Records a finished loop and schedules the next one"""
+        if busy:
+            self.interval = self._min_interval
+        else:
+            self.interval = min(self.interval * BACKOFF, self._max_interval)
+        jitter = random.uniform(-JITTER, JITTER)
+        self.next_run = now + self.interval * (1 + jitter)
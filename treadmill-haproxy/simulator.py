@@ -0,0 +1,233 @@
+"""Runs the conductor offline against a fake haproxy and a fake treadmill.
+
+Every service gets a traffic trace. Containers take --start-delay seconds to
+become healthy and every healthy server handles --capacity connections per
+second. Reports how the control loop and the scaling policies performed so
+regressions show up before deploy. Run from the repository root:
+
+    python treadmill-haproxy/simulator.py --services 10 --trace spike
+"""
+
+import atexit
+import csv
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+
+import click
+from twisted.internet import reactor
+from twisted.internet import task
+
+import conductor
+import fake_haproxy
+import treadmill_api
+import treadmill_stub
+
+# Seconds between samples of demand and capacity
+SAMPLE_TIME = 1
+# Connections per second of the steady trace and the bottom of spikes
+BASE_RATE = 40
+# Connections per second at the top of spikes and ramps
+PEAK_RATE = 400
+
+
+def trace(name, duration):
+    """Returns a function of seconds since start to connections per second.
+    name is spike, ramp, steady or a CSV file of seconds,rate rows that is
+    held constant between rows"""
+    if name == 'steady':
+        return lambda now: BASE_RATE
+    if name == 'ramp':
+        return lambda now: BASE_RATE + (PEAK_RATE - BASE_RATE) * min(
+            now / duration, 1)
+    if name == 'spike':
+        return lambda now: (PEAK_RATE if duration / 4 <= now < duration * 3 / 4
+                            else BASE_RATE)
+    with open(name, 'r') as trace_file:
+        points = sorted((float(row[0]), float(row[1]))
+                        for row in csv.reader(trace_file) if row)
+
+    def _replay(now):
+        """Rate of the last row at or before now"""
+        rate = 0
+        for start, value in points:
+            if start > now:
+                break
+            rate = value
+        return rate
+    return _replay
+
+
+def config(services, capacity, standby=0):
+    """Builds the conductor config of services that scale by connection
+    rate, one server per capacity connections, with up to standby containers
+    kept drained"""
+    elasticity = {'method': 'conn_rate', 'scale': capacity, 'min_servers': 1}
+    if standby:
+        elasticity['standby'] = {'max': standby}
+    return {
+        'haproxy': {
+            'global': [],
+            'defaults': ['timeout connect 5000ms', 'timeout client 5000ms',
+                         'timeout server 5000ms', 'balance roundrobin'],
+        },
+        'services': {
+            'svc{}'.format(idx): {
+                'elasticity': dict(elasticity),
+                'haproxy': {
+                    'server': ['check'],
+                    'listen': ['mode http'],
+                    'port': 10000 + idx,
+                    'slots': 4,
+                },
+                'treadmill': {
+                    'appname': 'sim.svc{}'.format(idx),
+                    'manifest': 'manifest.yaml',
+                    'port': 10000 + idx,
+                    'endpoint': 'http',
+                },
+            } for idx in range(services)
+        },
+    }
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list of values. 0 if it is empty"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Simulation(object):
+    """Samples demand, healthy servers and scheduled containers of every
+    service once per SAMPLE_TIME and accumulates the report"""
+    def __init__(self, services, haproxy, stub, model, capacity):
+        self._services = services
+        self._haproxy = haproxy
+        self._stub = stub
+        self._model = model
+        self._capacity = capacity
+        self._demand = {}
+        # Service to the time its demand last exceeded its capacity
+        self._short_since = {}
+        self.loops = []
+        self.time_to_capacity = []
+        self.under_capacity = 0
+        self.over_provisioned = 0
+
+    def timed(self, loop):
+        """Wraps the conductor loop to record how long each one takes"""
+        def _loop():
+            """Runs a loop and records its latency once it finished"""
+            start = time.time()
+            done = loop()
+            done.addBoth(self._record, start)
+            return done
+        return _loop
+
+    def _record(self, result, start):
+        """Records the latency of a finished loop"""
+        self.loops.append(time.time() - start)
+        return result
+
+    def sample(self):
+        """Compares the demand of every service with what is running"""
+        now = time.time()
+        for service in self._services:
+            demand = self._model.demand(service)
+            needed = max(int(math.ceil(demand / self._capacity)), 1)
+            healthy = self._haproxy.healthy(service)
+            scheduled = self._stub.count('sim.' + service)
+
+            # A rise in demand that outgrows the servers starts a spike
+            if healthy < needed:
+                self.under_capacity += SAMPLE_TIME
+                if (demand > self._demand.get(service, 0) and
+                        service not in self._short_since):
+                    self._short_since[service] = now
+            elif service in self._short_since:
+                self.time_to_capacity.append(
+                    now - self._short_since.pop(service))
+            self.over_provisioned += max(scheduled - needed, 0) * SAMPLE_TIME
+            self._demand[service] = demand
+
+    def report(self):
+        """Returns the results as a dict"""
+        return {
+            'loops': len(self.loops),
+            'loop_p50': percentile(self.loops, 0.5),
+            'loop_p95': percentile(self.loops, 0.95),
+            'loop_max': max(self.loops or [0]),
+            'reloads': self._haproxy.reloads,
+            'time_to_capacity': self.time_to_capacity,
+            'unrecovered_spikes': len(self._short_since),
+            'under_capacity_seconds': self.under_capacity,
+            'over_provisioned_container_seconds': self.over_provisioned,
+        }
+
+
+@click.command()
+@click.option('--services', default=3, help='Number of services')
+@click.option('--duration', default=120.0, help='Seconds to simulate')
+@click.option('--trace', 'trace_name', default='spike',
+              help='spike, ramp, steady or a CSV file of seconds,rate')
+@click.option('--start-delay', default=5.0,
+              help='Seconds before a scheduled container is healthy')
+@click.option('--capacity', default=fake_haproxy.CAPACITY,
+              help='Connections per second one server handles')
+@click.option('--standby', default=0,
+              help='Largest standby pool of every service, 0 disables it')
+@click.option('--state-file', default=None,
+              help='State file of the conductor, kept between runs')
+@click.option('--record', default=None,
+              help='Record a trace of the orchestrators for replay.py')
+@click.option('--output', default=None, help='Write the report as JSON')
+def main(services, duration, trace_name, start_delay, capacity, standby,
+         state_file, record, output):
+    """Runs the simulation and prints the report"""
+    workdir = tempfile.mkdtemp(prefix='treadmill-haproxy-sim-')
+    atexit.register(shutil.rmtree, workdir, True)
+    config_file = os.path.join(workdir, 'config.json')
+    haproxy_file = os.path.join(workdir, 'haproxy.conf')
+    settings = config(services, capacity, standby)
+    if record:
+        settings['trace'] = {'file': record}
+    with open(config_file, 'w') as config_out:
+        json.dump(settings, config_out)
+
+    names = ['svc{}'.format(idx) for idx in range(services)]
+    load = trace(trace_name, duration)
+    model = fake_haproxy.LoadModel({name: load for name in names},
+                                   capacity=capacity)
+    stub = treadmill_stub.TreadmillStub(start_delay=start_delay)
+    treadmill_api.use_backend(treadmill_stub.StubBackend(stub))
+    haproxy = fake_haproxy.FakeHAProxy(workdir, haproxy_file, model,
+                                       stub.running)
+    haproxy.install()
+    # The conductor connects to the socket on creation
+    haproxy.serve()
+
+    simulated = conductor.Conductor(workdir, config_file, haproxy_file,
+                                    state_file=state_file)
+    simulation = Simulation(names, haproxy, stub, model, capacity)
+    simulated.loop = simulation.timed(simulated.loop)
+    simulated.start()
+    task.LoopingCall(simulation.sample).start(SAMPLE_TIME)
+    reactor.callLater(duration, reactor.stop)
+    reactor.run()
+    haproxy.shutdown()
+
+    report = simulation.report()
+    for name, value in sorted(report.items()):
+        click.echo('{}: {}'.format(name, value))
+    if output:
+        with open(output, 'w') as report_out:
+            json.dump(report, report_out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
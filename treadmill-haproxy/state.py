@@ -0,0 +1,71 @@
+"""Snapshot of the daemon state that survives a restart.
+
+The conductor saves known servers, discovery results and orchestrator state
+after every commit that changed servers and on a timer. On boot the snapshot
+is restored before the first config is written, so haproxy starts with the
+servers it had and a restart does not drop traffic while discovery catches up.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+# Bumped when the layout of the snapshot changes. Other versions are ignored.
+VERSION = 2
+# Snapshots older than this many seconds are ignored, their servers are
+# likely gone
+MAX_AGE = 3600
+# Seconds after which an unchanged snapshot is written again, so a steady
+# deployment does not age out
+REFRESH_AGE = MAX_AGE / 2
+_LOGGER = logging.getLogger(__name__)
+
+
+def load(path):
+    """Reads the state saved by StateFile. Returns None if there is no usable
+    one"""
+    try:
+        with open(path, 'r') as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        _LOGGER.error('Unable to read state %s: %s', path, err)
+        return None
+    if state.get('version') != VERSION:
+        _LOGGER.info('Ignoring state of version %s', state.get('version'))
+        return None
+    if state.get('time', 0) < time.time() - MAX_AGE:
+        _LOGGER.info('Ignoring state older than %ds', MAX_AGE)
+        return None
+    return state['state']
+
+
+class StateFile(object):
+    """Writes snapshots atomically, skipping ones that did not change until
+    the file is REFRESH_AGE old"""
+    def __init__(self, path):
+        self._path = path
+        self._last = None
+        self._saved = 0
+
+    def save(self, state):
+        """Writes a snapshot if it differs from the last one written or that
+        one is due for a refresh"""
+        content = json.dumps(state, sort_keys=True, separators=(',', ':'))
+        now = time.time()
+        if content == self._last and now - self._saved < REFRESH_AGE:
+            return
+        # Same directory so the swap is an atomic rename
+        handle, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self._path)),
+            prefix='.state-', suffix='.json')
+        with os.fdopen(handle, 'w') as state_file:
+            state_file.write(json.dumps({'version': VERSION,
+                                         'time': now,
+                                         'state': state}))
+        os.replace(tmp_path, self._path)
+        self._last = content
+        self._saved = now
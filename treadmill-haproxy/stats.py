@@ -0,0 +1,105 @@
+"""Snapshot of haproxy statistics shared by every orchestrator"""
+
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Columns of show stat kept in the snapshot. Everything else is dropped to
+# keep the table small.
+FIELDS = ('scur', 'smax', 'slim', 'stot', 'qcur', 'weight', 'rate', 'qtime',
+          'ctime', 'rtime', 'ttime')
+# Rows of show stat that describe a whole proxy instead of a server
+PROXY_ROWS = ('FRONTEND', 'BACKEND')
+# Columns that add up across haproxy processes. The rest are times averaged
+# by every process or settings that are the same in all of them.
+SUMMED = ('scur', 'smax', 'slim', 'stot', 'qcur', 'rate')
+
+
+def parse_stat(lines):
+    """Parses the CSV output of show stat into a dict keyed by proxy and then
+    by server name. Each row holds the status and the FIELDS as integers"""
+    table = {}
+    header = None
+    for line in lines:
+        if line.startswith('# '):
+            header = line[2:].split(',')
+            continue
+        if not line or header is None:
+            continue
+        values = dict(zip(header, line.split(',')))
+        row = {'status': values.get('status', '')}
+        for field in FIELDS:
+            value = values.get(field, '')
+            # Empty columns do not apply to the row, e.g. rtime on a frontend
+            row[field] = int(value) if value else 0
+        table.setdefault(values['pxname'], {})[values['svname']] = row
+    return table
+
+
+def merge_stat(tables):
+    """Combines the parsed show stat of every haproxy process into one table
+    as if a single process served all the traffic. The status is the one of
+    the first process that reports the row"""
+    merged = {}
+    # Number of processes reporting each row, to average the other columns
+    counts = {}
+    for table in tables:
+        for proxy, rows in table.items():
+            for server, row in rows.items():
+                key = (proxy, server)
+                counts[key] = counts.get(key, 0) + 1
+                total = merged.setdefault(proxy, {}).get(server)
+                if total is None:
+                    merged[proxy][server] = dict(row)
+                    continue
+                for field in FIELDS:
+                    total[field] += row[field]
+    for (proxy, server), count in counts.items():
+        row = merged[proxy][server]
+        for field in FIELDS:
+            if field not in SUMMED:
+                row[field] //= count
+    return merged
+
+
+def parse_info(lines):
+    """Parses the output of show info into a dict"""
+    info = {}
+    for line in lines:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            info[name] = value.strip()
+    return info
+
+
+class StatsSnapshot(object):
+    """Reads show stat and show info once per loop over the admin sockets and
+    answers every orchestrator's metric reads from that copy. With several
+    haproxy processes the stats of all of them are combined"""
+    def __init__(self, haproxy):
+        self._haproxy = haproxy
+        self._stats = {}
+        self._info = {}
+
+    def refresh(self):
+        """Replaces the snapshot with the current statistics"""
+        # Command returns the output of every haproxy process
+        results = sorted(self._haproxy.command('show stat'))
+        self._stats = merge_stat([parse_stat(lines) for _, lines in results])
+        _, lines = sorted(self._haproxy.command('show info'))[0]
+        self._info = parse_info(lines)
+
+    def metric(self, proxy, name, server='BACKEND'):
+        """Returns a metric of a server or a proxy. 0 if it is unknown"""
+        return self._stats.get(proxy, {}).get(server, {}).get(name, 0)
+
+    def servers(self, proxy):
+        """Returns the rows of every server of a proxy keyed by server name"""
+        return {server: row
+                for server, row in self._stats.get(proxy, {}).items()
+                if server not in PROXY_ROWS}
+
+    def info(self, name):
+        """Returns a field of show info of the first process. None if it is
+        unknown"""
+        return self._info.get(name)
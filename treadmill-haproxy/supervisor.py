@@ -0,0 +1,141 @@
+"""Runs a conductor per shard of the services in worker processes.
+
+Every worker owns the services of its shard with its own haproxy, config
+file, admin socket directory, pid file and state file, so a reload only
+disturbs its shard and every shard loops on its own core. The supervisor
+starts the workers, restarts the ones that exit and kills the ones whose
+loop stopped beating. A restarted worker takes its running haproxy over.
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+
+# Seconds between health checks of the workers
+HEALTH_TIME = 5
+# Seconds without a loop before a worker is considered hung. Startup gets
+# the same grace.
+HEALTH_TIMEOUT = 60
+# Seconds before restarting a worker that exited, doubled while it keeps
+# exiting within STABLE_TIME of its start, up to MAX_RESTART_DELAY
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+STABLE_TIME = 60
+_LOGGER = logging.getLogger(__name__)
+
+
+def shard_path(path, index):
+    """Returns the file of a shard, path with the shard before its
+    extension"""
+    root, ext = os.path.splitext(path)
+    return '{}-shard{}{}'.format(root, index, ext)
+
+
+def shard_dir(path, index):
+    """Returns the directory of a shard inside path, created if missing"""
+    directory = os.path.join(path, 'shard{}'.format(index))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """Reports the exit of a worker to the supervisor"""
+    def __init__(self, supervisor, index):
+        self._supervisor = supervisor
+        self._index = index
+
+    def processEnded(self, reason):
+        self._supervisor.ended(self._index, reason)
+
+
+class Supervisor(object):
+    """Starts count workers running command with --shard and --heartbeat
+    added. Workers touch their heartbeat file after every loop"""
+    def __init__(self, count, command):
+        self._count = count
+        self._command = command
+        self._heartbeats = tempfile.mkdtemp(prefix='treadmill-haproxy-')
+        # Running worker processes, start times and restart delays by shard
+        self._workers = {}
+        self._started = {}
+        self._delays = {}
+        self._stopping = False
+
+    def _heartbeat(self, index):
+        """Path of the heartbeat file of a shard"""
+        return os.path.join(self._heartbeats, 'shard{}'.format(index))
+
+    def spawn(self, index):
+        """Starts the worker of a shard"""
+        if self._stopping:
+            return
+        cmd = self._command + ['--shard', str(index),
+                               '--heartbeat', self._heartbeat(index)]
+        _LOGGER.info('Starting shard %d', index)
+        self._started[index] = time.time()
+        # Workers log to the supervisor's output
+        self._workers[index] = reactor.spawnProcess(
+            _WorkerProtocol(self, index), cmd[0], cmd, env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2})
+
+    def ended(self, index, reason):
+        """Restarts a worker that exited, backing off if it keeps exiting"""
+        self._workers.pop(index, None)
+        if self._stopping:
+            return
+        delay = self._delays.get(index, RESTART_DELAY)
+        if time.time() - self._started[index] >= STABLE_TIME:
+            delay = RESTART_DELAY
+        _LOGGER.error('Shard %d exited, restarting in %ds: %s', index, delay,
+                      reason.getErrorMessage())
+        self._delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+        reactor.callLater(delay, self.spawn, index)
+
+    def check(self):
+        """Kills workers whose loop has not run for HEALTH_TIMEOUT. They are
+        restarted once they exited"""
+        now = time.time()
+        for index, worker in list(self._workers.items()):
+            try:
+                beat = os.stat(self._heartbeat(index)).st_mtime
+            except FileNotFoundError:
+                beat = 0
+            if now - max(beat, self._started[index]) > HEALTH_TIMEOUT:
+                _LOGGER.error('Shard %d stopped looping, killing it', index)
+                self._signal(worker, 'KILL')
+
+    @staticmethod
+    def _signal(worker, signal):
+        """Signals a worker unless it exited already"""
+        try:
+            worker.signalProcess(signal)
+        except error.ProcessExitedAlready:
+            pass
+
+    def stop(self):
+        """Stops every worker. They stop their haproxy on the way out"""
+        self._stopping = True
+        for worker in self._workers.values():
+            self._signal(worker, 'TERM')
+        shutil.rmtree(self._heartbeats, True)
+
+    def run(self):
+        """Starts every worker and supervises them until stopped"""
+        for index in range(self._count):
+            self.spawn(index)
+        task.LoopingCall(self.check).start(HEALTH_TIME, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        reactor.run()
+
+
+def worker_command():
+    """Command line that runs this program again, for the workers"""
+    return [sys.executable] + sys.argv
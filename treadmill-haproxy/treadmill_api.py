@@ -1,42 +1,125 @@
-"""Temporary solution to starting and stopping treadmill containers"""
+"""Starting, stopping and discovering treadmill containers.
 
-import subprocess
+Every command runs inside the Twisted reactor and returns a Deferred. The
+commands go through a pluggable backend, the command line by default or the
+REST API (see treadmill_rest).
+"""
 
-def start_container(app, manifest):
-    """Starts a container through the command line"""
-    cmd = ['treadmill', 'admin', 'master', 'app', 'schedule', '-m', manifest,
-           '--env', 'prod', '--proid', 'treadmld', app]
-    subprocess.call(cmd)
+import re
 
-def stop_container(app, instance):
-    """Stops a container through the command line"""
-    cmd = ['treadmill', 'admin', 'master', 'app', 'delete', app + '#' + instance]
-    subprocess.call(cmd)
+from twisted.internet import defer
 
-def discover_container(app, instance=None):
-    """Performs discovery of a containers endpoints. Filters based on instance
-    if parameter specified. Formats results into a dict keyed by instance and
+import metrics
+import process
+
+# Maximum instances deleted by one command, keeps the command line short
+DELETE_BATCH = 50
+
+def _start_cmd(app, manifest, count=1):
+    """Command line that schedules count containers"""
+    return ['treadmill', 'admin', 'master', 'app', 'schedule', '-m', manifest,
+            '--env', 'prod', '--proid', 'treadmld', '--count', str(count),
+            app]
+
+def _stop_cmd(app, *instances):
+    """Command line that deletes containers"""
+    return (['treadmill', 'admin', 'master', 'app', 'delete'] +
+            [app + '#' + instance for instance in instances])
+
+def _batches(instances):
+    """Splits instances into lists of at most DELETE_BATCH"""
+    instances = list(instances)
+    return [instances[idx:idx + DELETE_BATCH]
+            for idx in range(0, len(instances), DELETE_BATCH)]
+
+def _discover_cmd(pattern):
+    """Command line that discovers the endpoints of an app pattern"""
+    return ['treadmill', 'admin', 'discovery', pattern]
+
+
+class TreadmillError(Exception):
+    """A request to treadmill failed"""
+
+
+def _checked(result, action):
+    """Returns the decoded output of a command. Raises TreadmillError if it
+    exited with an error"""
+    out, err, code = result
+    if code:
+        raise TreadmillError('{} failed: {}'.format(
+            action, err.decode('utf-8').strip()))
+    return out.decode('utf-8')
+
+
+def parse_instances(output):
+    """Finds the instance ids of scheduled containers in the output of the
+    schedule command"""
+    return re.findall(r'#(\d+)', output)
+
+
+class CliBackend(object):
+    """Runs the treadmill command line inside the reactor"""
+    def start_containers(self, app, manifest, count):
+        """Schedules count containers. Returns a Deferred that fires with the
+        list of scheduled instance ids"""
+        cmd = _start_cmd(app, manifest, count)
+        return process.run(cmd).addCallback(
+            _checked, 'Schedule of ' + app).addCallback(parse_instances)
+
+    def stop_containers(self, app, instances):
+        """Deletes containers, DELETE_BATCH per command. The commands run
+        concurrently. Returns a Deferred that fires once all are deleted"""
+        deletes = [process.run(_stop_cmd(app, *batch)).addCallback(
+            _checked, 'Delete of ' + app) for batch in _batches(instances)]
+        return defer.gatherResults(deletes, consumeErrors=True)
+
+    def discover(self, pattern):
+        """Discovers every container matching an app pattern. Returns a
+        Deferred that fires with the results of parse_endpoints"""
+        return process.run(_discover_cmd(pattern)).addCallback(
+            _checked, 'Discovery of ' + pattern).addCallback(parse_endpoints)
+
+
+_BACKEND = CliBackend()
+
+
+def use_backend(backend):
+    """Sets the backend the commands go through"""
+    global _BACKEND
+    _BACKEND = backend
+
+@metrics.timed
+def start_containers_async(app, manifest, count):
+    """Starts count containers with a single request to the backend. Returns a
+    Deferred that fires with the list of scheduled instance ids"""
+    return _BACKEND.start_containers(app, manifest, count)
+
+@metrics.timed
+def stop_containers_async(app, instances):
+    """Stops many containers through the backend in as few requests as it
+    allows. Returns a Deferred"""
+    return _BACKEND.stop_containers(app, instances)
+
+def parse_endpoints(output):
+    """Formats discovery results into a dict keyed by app, then by instance and
     then by name of endpoint.
     """
-    # Give more specific appname to discovery
-    if instance:
-        app += '#' + instance
-    cmd = ['treadmill', 'admin', 'discovery', app]
-    # Popen to allow access to results
-    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    # Decode to utf-8 to make working with results easier
+    endpoints_fmt = {}
     # Strip to remove trailing new line
     # Split by new line to separate results
-    endpoints = proc.communicate()[0].decode('utf-8').strip().split('\n')
-    endpoints_fmt = {}
-    for endpoint in endpoints:
+    for endpoint in output.strip().split('\n'):
         if endpoint:
             name, address = endpoint.split(' ')
             app, _, name = name.split(':')
-            instance = app.split('#')[1]
-            endpoints_fmt.setdefault(instance, {})
-            endpoints_fmt[instance][name] = address
-        else:
-            return None
+            app, instance = app.split('#')
+            endpoints_fmt.setdefault(app, {}).setdefault(instance, {})
+            endpoints_fmt[app][instance][name] = address
     return endpoints_fmt
+
+@metrics.timed
+def discover_async(pattern):
+    """Performs discovery of every container matching an app pattern such as
+    proid.* in a single call through the backend. Returns a Deferred that
+    fires with the results formatted by parse_endpoints or fails if the
+    backend returns an error"""
+    return _BACKEND.discover(pattern)
@@ -0,0 +1,182 @@
+"""Treadmill REST API backend for treadmill_api.
+
+Keeps a pool of keep-alive connections to the REST endpoints so requests do
+not pay for starting the treadmill command line every time.
+"""
+
+import io
+import json
+import logging
+
+from twisted.internet import error
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.web.client import Agent
+from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import readBody
+from twisted.web.http_headers import Headers
+import yaml
+
+import treadmill_api
+
+# Seconds before a request is abandoned
+TIMEOUT = 10
+# Attempts after the first one. Each waits twice as long as the last.
+RETRIES = 3
+BACKOFF = 0.5
+# Persistent connections kept per host
+POOL_SIZE = 8
+# Methods that can be sent again without changing the result
+IDEMPOTENT = (b'GET',)
+# Failures of requests that never reached the REST API. Only these are sent
+# again or handed to the fallback for methods that are not idempotent, a
+# timeout may hide a request the API carried out.
+UNSENT = (error.ConnectionRefusedError, error.DNSLookupError)
+_LOGGER = logging.getLogger(__name__)
+
+
+class RequestRejected(treadmill_api.TreadmillError):
+    """The REST API rejected a request. Retrying will not help"""
+
+
+def parse_endpoints(endpoints):
+    """Formats the endpoint API results the same way as
+    treadmill_api.parse_endpoints"""
+    endpoints_fmt = {}
+    for endpoint in endpoints:
+        app, instance = endpoint['name'].split('#')
+        endpoints_fmt.setdefault(app, {}).setdefault(instance, {})
+        endpoints_fmt[app][instance][endpoint['endpoint']] = '{}:{}'.format(
+            endpoint['host'], endpoint['port'])
+    return endpoints_fmt
+
+
+class RestBackend(object):
+    """Schedules, deletes and discovers containers through the treadmill REST
+    API. Requests that still fail after every retry are handed to the
+    fallback backend if there is one"""
+    def __init__(self, url, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 fallback=None):
+        self._url = url.rstrip('/')
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._fallback = fallback
+        # Manifests are only read once
+        self._manifests = {}
+
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = POOL_SIZE
+        self._agent = Agent(reactor, connectTimeout=timeout, pool=self._pool)
+
+    def _attempt(self, method, path, body):
+        """Sends a single request. Returns a Deferred that fires with the
+        decoded JSON response"""
+        headers = Headers({b'Content-Type': [b'application/json']})
+        producer = None
+        if body is not None:
+            producer = FileBodyProducer(io.BytesIO(
+                json.dumps(body).encode('utf-8')))
+        url = (self._url + path).encode('utf-8')
+        request = self._agent.request(method, url, headers, producer)
+        timeout = reactor.callLater(self._timeout, request.cancel)
+
+        def _stop_timeout(result):
+            """Cancels the timeout once the request finished"""
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        def _read(response):
+            """Reads the response body and checks the status"""
+            body = readBody(response)
+            if response.code >= 400:
+                return body.addCallback(lambda data: _failed(response, data))
+            return body.addCallback(
+                lambda data: json.loads(data.decode('utf-8')) if data else None)
+
+        def _failed(response, data):
+            """Raises the error returned by the REST API"""
+            error = treadmill_api.TreadmillError
+            if response.code < 500:
+                error = RequestRejected
+            raise error('{} {} returned {}: {}'.format(
+                method.decode('utf-8'), path, response.code,
+                data.decode('utf-8').strip()))
+
+        request.addCallback(_read)
+        request.addBoth(_stop_timeout)
+        return request
+
+    @staticmethod
+    def _retriable(method, failure):
+        """Returns whether a failed request can be sent again"""
+        if failure.check(RequestRejected):
+            return False
+        return method in IDEMPOTENT or bool(failure.check(*UNSENT))
+
+    def _request(self, method, path, body=None, attempt=0):
+        """Sends a request, retrying with exponential backoff. Returns a
+        Deferred that fires with the decoded JSON response"""
+        def _retry(failure):
+            """Waits and tries again until out of retries"""
+            if (attempt >= self._retries or
+                    not self._retriable(method, failure)):
+                return failure
+            delay = self._backoff * 2 ** attempt
+            _LOGGER.warning('%s %s failed, retrying in %.1fs: %s',
+                            method.decode('utf-8'), path, delay,
+                            failure.getErrorMessage())
+            return task.deferLater(reactor, delay, self._request, method,
+                                   path, body, attempt + 1)
+        return self._attempt(method, path, body).addErrback(_retry)
+
+    def _with_fallback(self, request, method, name, *args):
+        """Hands a request that failed for good to the fallback backend, if
+        it can be sent again"""
+        if self._fallback is None:
+            return request
+
+        def _fallback(failure):
+            """Retries through the fallback backend"""
+            if not self._retriable(method, failure):
+                # Discovery reconciles whatever the API did
+                return failure
+            _LOGGER.error('REST API failed, falling back: %s',
+                          failure.getErrorMessage())
+            return getattr(self._fallback, name)(*args)
+        return request.addErrback(_fallback)
+
+    def _manifest(self, path):
+        """Loads a YAML manifest"""
+        if path not in self._manifests:
+            with open(path, 'r') as manifest:
+                self._manifests[path] = yaml.safe_load(manifest)
+        return self._manifests[path]
+
+    def start_containers(self, app, manifest, count):
+        """Schedules count containers. Returns a Deferred that fires with the
+        list of scheduled instance ids"""
+        path = '/instance/{}?count={}'.format(app, count)
+        request = self._request(b'POST', path, self._manifest(manifest))
+        request.addCallback(lambda result: [
+            instance.split('#')[1] for instance in result['instances']])
+        return self._with_fallback(request, b'POST', 'start_containers', app,
+                                   manifest, count)
+
+    def stop_containers(self, app, instances):
+        """Deletes containers with a single bulk request. Returns a Deferred
+        that fires once they are deleted"""
+        body = {'instances': [app + '#' + instance for instance in instances]}
+        request = self._request(b'POST', '/instance/_bulk/delete', body)
+        return self._with_fallback(request, b'POST', 'stop_containers', app,
+                                   instances)
+
+    def discover(self, pattern):
+        """Discovers every container matching an app pattern. Returns a
+        Deferred that fires with the same format as
+        treadmill_api.parse_endpoints"""
+        request = self._request(b'GET', '/endpoint/{}'.format(pattern))
+        request.addCallback(parse_endpoints)
+        return self._with_fallback(request, b'GET', 'discover', pattern)
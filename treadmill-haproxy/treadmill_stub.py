@@ -0,0 +1,127 @@
+"""Local stand-in for the treadmill REST endpoints used by treadmill_rest.
+
+Keeps scheduled instances in memory and reports them through the endpoint
+API once they have been running for a configurable number of seconds. The
+same model can be used in process through StubBackend.
+"""
+
+import fnmatch
+import json
+import time
+
+import click
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.web import resource
+from twisted.web import server
+
+import treadmill_rest
+
+
+class TreadmillStub(resource.Resource):
+    """Serves /instance and /endpoint like the treadmill REST API"""
+    isLeaf = True
+
+    def __init__(self, host='localhost', base_port=20000, start_delay=0):
+        resource.Resource.__init__(self)
+        self._host = host
+        self._start_delay = start_delay
+        self._next_port = base_port
+        self._next_id = 1
+        # Instance name to its endpoint port and the time it becomes healthy
+        self.instances = {}
+
+    def schedule(self, app, count):
+        """Schedules count instances of an app. Returns their names"""
+        names = []
+        for _ in range(count):
+            name = '{}#{:010d}'.format(app, self._next_id)
+            self._next_id += 1
+            self.instances[name] = (self._next_port,
+                                    time.time() + self._start_delay)
+            self._next_port += 1
+            names.append(name)
+        return names
+
+    def delete(self, names):
+        """Deletes instances by name"""
+        for name in names:
+            self.instances.pop(name, None)
+
+    def running(self, port):
+        """Returns whether the instance listening on a port has started"""
+        return any(instance_port == port and ready <= time.time()
+                   for instance_port, ready in self.instances.values())
+
+    def count(self, app):
+        """Number of scheduled instances of an app, started or not"""
+        return sum(1 for name in self.instances
+                   if name.split('#')[0] == app)
+
+    def endpoints(self, pattern):
+        """Endpoints of the running instances matching an app pattern"""
+        now = time.time()
+        return [{'name': name, 'endpoint': 'http', 'proto': 'tcp',
+                 'host': self._host, 'port': port}
+                for name, (port, ready) in sorted(self.instances.items())
+                if fnmatch.fnmatchcase(name.split('#')[0], pattern) and
+                ready <= now]
+
+    def render_GET(self, request):
+        """Discovery through /endpoint/<pattern>"""
+        parts = request.path.decode('utf-8').strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'endpoint':
+            request.setResponseCode(404)
+            return b''
+        return json.dumps(self.endpoints(parts[1])).encode('utf-8')
+
+    def render_POST(self, request):
+        """Scheduling through /instance/<app>?count=N and bulk deletes
+        through /instance/_bulk/delete"""
+        parts = request.path.decode('utf-8').strip('/').split('/')
+        if parts[0] != 'instance' or len(parts) < 2:
+            request.setResponseCode(404)
+            return b''
+        body = json.loads(request.content.read().decode('utf-8') or 'null')
+        if parts[1:] == ['_bulk', 'delete']:
+            self.delete(body['instances'])
+            return b''
+        count = int(request.args.get(b'count', [b'1'])[0])
+        names = self.schedule(parts[1], count)
+        return json.dumps({'instances': names}).encode('utf-8')
+
+
+class StubBackend(object):
+    """treadmill_api backend answering from an in process TreadmillStub"""
+    def __init__(self, stub):
+        self.stub = stub
+
+    def start_containers(self, app, manifest, count):
+        """Schedules count containers. The manifest is ignored"""
+        names = self.stub.schedule(app, count)
+        return defer.succeed([name.split('#')[1] for name in names])
+
+    def stop_containers(self, app, instances):
+        """Deletes containers"""
+        self.stub.delete([app + '#' + instance for instance in instances])
+        return defer.succeed(None)
+
+    def discover(self, pattern):
+        """Discovers started containers matching an app pattern"""
+        return defer.succeed(
+            treadmill_rest.parse_endpoints(self.stub.endpoints(pattern)))
+
+
+@click.command()
+@click.option('--port', default=8080, help='Port to serve on')
+@click.option('--start-delay', default=0.0,
+              help='Seconds before a scheduled instance is discoverable')
+def main(port, start_delay):
+    """Serves the stub until interrupted"""
+    stub = TreadmillStub(start_delay=start_delay)
+    reactor.listenTCP(port, server.Site(stub))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 
 import logging
 
-import treadmill_api
+import haproxy_cmd
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -10,23 +10,29 @@ _LOGGER = logging.getLogger(__name__)
 class Watcher(object):
     """Watches for treadmill instances and adds/removes corresponding servers
     in the haproxy config"""
-    def __init__(self, service_name, service, haproxy_parser):
+    def __init__(self, service_name, service, haproxy_parser, haproxy,
+                 discovery):
         self._service_name = service_name
         self._haproxy_parser = haproxy_parser
+        self._haproxy = haproxy
+        self._discovery = discovery
 
         self._treadmill = service['treadmill']
         self._haproxy_conf = service['haproxy']
+        self._elasticity = service.get('elasticity', {})
+
+        self._discovery.register(self._treadmill['appname'])
 
     def discover_servers(self):
-        """Parses through treadmill discovery to find valid endpoints"""
-        servers = treadmill_api.discover_container(self._treadmill['appname'])
+        """Parses through this app's slice of the shared treadmill discovery
+        to find valid endpoints"""
+        servers = self._discovery.endpoints(self._treadmill['appname'])
         valid = {}
 
-        if servers:
-            for instance, server in servers.items():
-                # Checks for the endpoint specified in the config
-                if self._treadmill['endpoint'] in server:
-                    valid[instance] = server[self._treadmill['endpoint']]
+        for instance, server in servers.items():
+            # Checks for the endpoint specified in the config
+            if self._treadmill['endpoint'] in server:
+                valid[instance] = server[self._treadmill['endpoint']]
 
         return valid
 
@@ -34,9 +40,30 @@ class Watcher(object):
         """Confirms that a new treadmill instance is available and adds to
         haproxy config"""
         _LOGGER.info("Confirm pending server")
-        self._haproxy_parser.add_server(
+        # New instances of services with a standby pool join it drained, the
+        # orchestrator puts them into service
+        state = 'drain' if 'standby' in self._elasticity else 'ready'
+        slot = self._haproxy_parser.add_server(
             self._service_name, instance, address,
-            self._haproxy_conf['server'])
+            self._haproxy_conf['server'], state)
+        if not slot:
+            return
+        # Slotted servers are enabled in place, at the IP address discovery
+        # resolved. Fall back to a reload if that failed or haproxy refuses.
+        ip_address = self._discovery.resolved(address)
+        if ip_address is None or not haproxy_cmd.enable_server(
+                self._haproxy, self._service_name, slot, ip_address, state):
+            self._haproxy_parser.request_reload('runtime_failed')
+
+    def remove_server(self, instance):
+        """Removes a treadmill instance that is no longer available from the
+        haproxy config"""
+        _LOGGER.info("Remove server")
+        slot = self._haproxy_parser.delete_server(self._service_name,
+                                                  instance)
+        if slot and not haproxy_cmd.disable_server(self._haproxy,
+                                                   self._service_name, slot):
+            self._haproxy_parser.request_reload('runtime_failed')
 
     def loop(self):
         """Main loop. checks all treadmill instances available and compares it
@@ -61,7 +88,7 @@ class Watcher(object):
         for instance in all_servers.keys():
             # If no longer available, then delete
             if instance not in up_servers:
-                self._haproxy_parser.delete_server(self._service_name, instance)
+                self.remove_server(instance)
                 changes = True
 
         # Return whether there are any changes that need to be committed